@@ -1,20 +1,12 @@
 import logging
 import os
-import re
-import subprocess
 import vtk
 
 import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
-import nrrd
-import nibabel as nib
-import numpy as np
-import cv2
-import SimpleITK as sitk
-import fire
-import time
-import einops
+from PredictIceballLib import DependencyChecker, LogSink, ModelRegistry, TerminologyIndex
+
 #
 # PredictIceball
 #
@@ -121,6 +113,11 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self._updatingGUIFromParameterNode = False
         self._processingState = PredictIceballWidget.PROCESSING_IDLE
         self._segmentationProcessInfo = None
+        # Log lines are collected and displayed in frames, at most once per logFrameIntervalSec
+        self.logFrameIntervalSec = 0.1
+        self._logSink = LogSink(maxLines=2000)
+        self._lastLogFrameTime = 0.0
+        self._logFrameTimer = None
 
     def setup(self):
         """
@@ -137,6 +134,13 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         import qt
         self.ui.downloadSampleDataToolButton.setIcon(qt.QIcon(self.resourcePath("Icons/radiology.svg")))
 
+        # Limit scrollback of the status panel (the full log is written to file in the processing folder)
+        self.ui.statusLabel.maximumBlockCount = self._logSink.maxLines
+        self._logFrameTimer = qt.QTimer()
+        self._logFrameTimer.setSingleShot(True)
+        self._logFrameTimer.setInterval(int(self.logFrameIntervalSec * 1000))
+        self._logFrameTimer.connect("timeout()", self.renderLogFrame)
+
         self.inputNodeSelectors = [self.ui.inputNodeSelector0]
         self.inputNodeLabels = [self.ui.inputNodeLabel0]
 
@@ -194,6 +198,10 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        if self._logFrameTimer:
+            self._logFrameTimer.stop()
+        self.logic.clearIncrementalState()
+        self.logic.stopInferenceWarmup()
 
     def enter(self):
         """
@@ -202,6 +210,9 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         # Make sure parameter node exists and observed
         self.initializeParameterNode()
 
+        # Prepare the inference script in the background so that the first processing starts faster
+        self.logic.startInferenceWarmup()
+
     def exit(self):
         """
         Called each time the user opens a different module.
@@ -215,6 +226,8 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        # Previous inputs must not be compared to the next scene's images
+        self.logic.clearIncrementalState()
 
     def onSceneEndClose(self, caller, event):
         """
@@ -415,10 +428,46 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self._parameterNode.EndModify(wasModified)
 
     def addLog(self, text):
-        """Append text to log window
+        """Append text to log window.
+        The log window is not updated immediately but at most once per logFrameIntervalSec.
         """
-        self.ui.statusLabel.appendPlainText(text)
-        slicer.app.processEvents()  # force update
+        import time
+        self._logSink.write(text)
+        if time.time() - self._lastLogFrameTime >= self.logFrameIntervalSec:
+            self.renderLogFrame()
+            slicer.app.processEvents()  # force update
+        elif not self._logFrameTimer.isActive():
+            # Make sure the remaining lines are displayed even if no more log messages arrive
+            self._logFrameTimer.start()
+
+    def renderLogFrame(self):
+        """Display log lines that were added since the last frame.
+        """
+        import time
+        self._lastLogFrameTime = time.time()
+        frame = self._logSink.takeFrame()
+        if not frame:
+            return
+        reset, replaceLastLine, lines = frame
+        if reset:
+            self.ui.statusLabel.plainText = "\n".join(lines)
+            lines = []
+        elif replaceLastLine:
+            # Only the last block is replaced (for example, by an updated progress line), the rest of the text is not rendered again
+            import qt
+            cursor = self.ui.statusLabel.textCursor()
+            cursor.movePosition(qt.QTextCursor.End)
+            cursor.select(qt.QTextCursor.BlockUnderCursor)
+            # Selection includes the separator before the block (except for the first block), it has to be kept
+            cursor.insertText(("\n" if cursor.blockNumber() > 0 else "") + lines[0])
+            lines = lines[1:]
+        if lines:
+            self.ui.statusLabel.appendPlainText("\n".join(lines))
+        self.ui.statusLabel.verticalScrollBar().setValue(self.ui.statusLabel.verticalScrollBar().maximum)
+
+    def clearLog(self):
+        self._logSink.clear()
+        self.renderLogFrame()
 
     def setProcessingState(self, state):
         self._processingState = state
@@ -436,7 +485,7 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
             self.onCancel()
 
     def onApply(self):
-        self.ui.statusLabel.plainText = ""
+        self.clearLog()
 
         self.setProcessingState(PredictIceballWidget.PROCESSING_STARTING)
 
@@ -458,7 +507,8 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 for inputNodeSelector in self.inputNodeSelectors:
                     if inputNodeSelector.visible:
                         inputNodes.append(inputNodeSelector.currentNode())
-                self._segmentationProcessInfo = self.logic.process(inputNodes, self.ui.outputSegmentationSelector.currentNode(),
+                process = self.logic.processProgressive if self.logic.progressivePrediction else self.logic.process
+                self._segmentationProcessInfo = process(inputNodes, self.ui.outputSegmentationSelector.currentNode(),
                     self._currentModelId(), self.ui.cpuCheckBox.checked, waitForCompletion=False)
 
                 self.setProcessingState(PredictIceballWidget.PROCESSING_IN_PROGRESS)
@@ -483,7 +533,8 @@ class PredictIceballWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         slicer.app.processEvents()
 
     def onProcessingCompleted(self, returnCode, customData):
-        self.ui.statusLabel.appendPlainText("\nProcessing finished.")
+        self.addLog("\nProcessing finished.")
+        self.renderLogFrame()
         self.setProcessingState(PredictIceballWidget.PROCESSING_IDLE)
         self._segmentationProcessInfo = None
 
@@ -585,16 +636,44 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         import pathlib
         self.fileCachePath = pathlib.Path.home().joinpath(".PredictIceball")
 
+        # Manifest of installed models, allows finding models without scanning the models folder
+        self.modelRegistry = ModelRegistry(self.modelsPath())
+
         self.dependenciesInstalled = False  # we don't know yet if dependencies have been installed
 
+        # Python distributions that are installed by setupPythonRequirements.
+        # Checking them does not require running pip and the result is cached until the Python environment changes.
+        self.minimumTorchVersion = "1.12"
+        self.pythonRequirements = [f"torch>={self.minimumTorchVersion}", "monai>=1.3",
+            "fire", "PyYAML", "nibabel", "pynrrd", "psutil", "tensorboard", "scikit-image", "itk", "tqdm", "einops"]
+        self.dependencyChecker = DependencyChecker(self.pythonRequirements, str(self.fileCachePath.joinpath("dependencies.json")))
+
+        # Background process that prepares the inference script for fast startup (started once per session)
+        self.warmupProcess = None
+        # Persistent inference process that keeps the models loaded (InferenceWorker), used for processing series
+        # in a watched folder, models run in new processes if it is not started (see startInferenceWorker)
+        self.inferenceWorker = None
+        # Process a new series in a watched folder as soon as its files do not change between two polls,
+        # instead of waiting for the settle time (see watchFolder)
+        self.earlySeriesPrediction = True
+
         self.moduleDir = os.path.dirname(slicer.util.getModule('PredictIceball').path)
 
         self.logCallback = None
+        # Complete log of the current processing, written to the processing folder
+        self.logFile = None
         self.processingCompletedCallback = None
         self.startResultImportCallback = None
         self.endResultImportCallback = None
         self.useStandardSegmentNames = True
 
+        # Index of the MONAIAuto3DSeg terminology and anatomic context, for fast lookup of codes, labels, and colors.
+        # The index is cached on disk and rebuilt only if the terminology files change.
+        self.terminologyIndex = TerminologyIndex.load(
+            [os.path.join(self.moduleDir, "Resources", "SegmentationCategoryTypeModifier-PredictIceball.term.json")],
+            [os.path.join(self.moduleDir, "Resources", "AnatomicRegionAndModifier-PredictIceball.term.json")],
+            str(self.fileCachePath.joinpath("terminology-index.json")))
+
         # List of property type codes that are specified by in the MONAIAuto3DSeg terminology.
         #
         # Codes are stored as a list of strings containing coding scheme designator and code value of the property type,
@@ -613,6 +692,60 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         self.models = self.loadModelsDescription()
         self.defaultModel = self.models[0]["id"]
 
+        # Number of workers that evaluate sliding windows in parallel in the inference script (0 = one worker per CPU core).
+        # If None then MONAI SlidingWindowInfererAdapt is used. Peak memory usage grows with the number of workers.
+        self.slidingWindowWorkers = None
+        # Sliding window results can be aggregated directly into a label map ("labels") instead of a full logits volume ("logits"),
+        # which reduces memory usage. "logits" with default settings uses MONAI SlidingWindowInfererAdapt.
+        # Accumulator data type can be set to "float16" to halve the memory usage. This changes the results: labels differ
+        # where the class scores are close (on a test volume 6 voxels at class boundaries were different than with "float32").
+        self.slidingWindowAggregation = "logits"
+        self.slidingWindowAccumulatorDtype = "float32"
+        # Sliding windows that contain no foreground are not evaluated (background is used as their output).
+        # Foreground is where the normalized intensity is above foregroundThreshold (None = no thresholding).
+        # If skipWindowsOutsideProstate is enabled then the iceball model only evaluates windows that overlap with the dilated prostate.
+        self.foregroundThreshold = None
+        self.skipWindowsOutsideProstate = False
+        # Memory budget of inference (in bytes, None = no limit). Inference settings (window batch size, accumulator precision,
+        # CPU offload) are chosen to fit into the budget, and if a stage runs out of memory then it is retried with lower memory usage.
+        self.memoryBudget = None
+        # Inference settings that were found to be the fastest on this machine (see tuneInference).
+        # Only settings that do not change the output (window batch size, number of workers) are used, unless
+        # inferenceTuningAccuracySettings is enabled (then the tuned overlap and blending mode are used, too).
+        self.inferenceTuningFilePath = self.fileCachePath.joinpath("inference-tuning.json")
+        self.inferenceTuningAccuracySettings = False
+        # Models that use the same input volume and preprocessing share the preprocessed volume (stored in the temporary folder)
+        self.preprocessingCacheEnabled = True
+        # Incremental prediction (disabled by default): each model only re-evaluates the sliding windows where its input changed
+        # since the previous run on the same study (for example, when only a probe was moved). The changed region is dilated
+        # by incrementalMargin voxels. This is an approximation: labels outside the region are taken from the previous run,
+        # which is only exact if the margin is at least the receptive field radius of the network (in preprocessed voxels)
+        # and the preprocessing is local. Intensity normalization that uses statistics of the whole volume (such as "meanstd")
+        # changes all voxels slightly, these changes are ignored up to the tolerance of the inference script.
+        # The previous inputs and labels contain patient images, they are stored in a temporary folder of the session
+        # (separately for each study) and deleted by clearIncrementalState, when the scene is closed.
+        self.incrementalPrediction = False
+        self.incrementalMargin = 16
+        self.incrementalStateDir = None
+        # Diameter of cryoprobes (in mm) when the needle mask is created from known probe positions
+        self.probeDiameter = 1.5
+        # Prostate and urethra segmentations are reused for later scans of the same study and frame of reference
+        # if the intensities around the prostate are similar (correlation is at least anatomyCacheMinimumCorrelation).
+        # Disabled by default (opt-in), as a cache hit skips the segmentation of the new scan.
+        self.anatomyCacheEnabled = False
+        self.anatomyCacheMinimumCorrelation = 0.8
+        # Cache key -> {"segmentationNode", "sampleRas", "sampleValues"}
+        self.anatomyCache = {}
+        # Progressive prediction: a quick preview is computed at coarser resolution (previewResolutionScale times the
+        # resample resolution of the models, with previewOverlap sliding window overlap) and shown while the full-quality
+        # prediction is running.
+        self.progressivePrediction = False
+        self.previewResolutionScale = 2.0
+        self.previewOverlap = 0.1
+        # Segmentation results of the inference script only contain the bounding box of the segmented structures
+        # (see CroppedLabelmap)
+        self.cropOutputEnabled = True
+
         # Timer for checking the output of the segmentation process that is running in the background
         self.processOutputCheckTimerIntervalMsec = 1000
 
@@ -620,6 +753,10 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         # which can be useful for troubleshooting.
         self.clearOutputFolder = True
 
+        # The result is imported into the output segmentation directly. If a file path is set here
+        # then the refined result is written into this file as well.
+        self.resultFilePath = None
+
         # For testing the logic without actually running inference, set self.debugSkipInferenceTempDir to the location
         # where inference result is stored and set self.debugSkipInference to True.
         self.debugSkipInference = False
@@ -648,6 +785,8 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
                 deprecated = False
                 for version in model["versions"]:
                     url = version["url"]
+                    # Optional SHA-256 hash of the model package, used for verifying the downloaded file
+                    sha256 = version.get("sha256")
                     # URL format: <path>/<filename>-v<version>.zip
                     # Example URL: https://github.com/lassoan/SlicerMONAIAuto3DSeg/releases/download/Models/17-segments-TotalSegmentator-v1.0.3.zip
                     match = re.search(r"(?P<filename>[^/]+)-v(?P<version>\d+\.\d+\.\d+)", url)
@@ -685,6 +824,7 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
                             f"<p><b>Subject:</b> {model['subject']}\n"
                             f"<p><b>Segments:</b> {', '.join(segmentNames)}",
                         "url": url,
+                        "sha256": sha256,
                         "deprecated": deprecated
                         })
                     # First version is not deprecated, all subsequent versions are deprecated
@@ -719,130 +859,97 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
             os.makedirs(modelsDir)
 
     def modelPath(self, modelName):
-        import pathlib
-        modelRoot = self.modelsPath().joinpath(modelName)
-        # find labels.csv file within the modelRoot folder and subfolders
-        for path in pathlib.Path(modelRoot).rglob("labels.csv"):
-            return path.parent
-        raise RuntimeError(f"Model {modelName} path not found")
+        """Get folder that contains labels.csv and model files of an installed model."""
+        modelPath = self.modelRegistry.modelPath(modelName)
+        if not modelPath:
+            raise RuntimeError(f"Model {modelName} path not found")
+        return modelPath
+
+    def isModelInstalled(self, modelName):
+        return self.modelRegistry.isInstalled(modelName)
+
+    def registerModelVariants(self, modelName):
+        """Record optimized model files that the inference script created (memory-mappable weights cache)
+        in the model registry.
+        """
+        modelEntry = self.modelRegistry.entry(modelName)
+        if not modelEntry:
+            return
+        modelPath = self.modelPath(modelName)
+        for fileName in modelEntry["files"]:
+            if not fileName.endswith(".pt") or fileName.endswith(".mmap.pt"):
+                continue
+            if self.modelRegistry.variantFilePath(modelName, fileName, "mmap"):
+                # already registered
+                continue
+            variantFileName = fileName[:-len(".pt")] + ".mmap.pt"
+            if modelPath.joinpath(variantFileName).exists():
+                self.modelRegistry.addVariant(modelName, fileName, "mmap", variantFileName)
 
     def deleteAllModels(self):
         if self.modelsPath().exists():
             import shutil
             shutil.rmtree(self.modelsPath())
+        self.modelRegistry.clear()
 
     def downloadModel(self, modelName):
-
-        url = self.model(modelName)["url"]
-
-        import zipfile
-        import requests
-        import pathlib
-
-        tempDir = pathlib.Path(slicer.util.tempDirectory())
-        modelDir = self.modelsPath().joinpath(modelName)
-        if not os.path.exists(modelDir):
-            os.makedirs(modelDir)
-
-        modelZipFile = tempDir.joinpath("autoseg3d_model.zip")
-        self.log(f"Downloading model '{modelName}' from {url}...")
-        logging.debug(f"Downloading from {url} to {modelZipFile}...")
-
-        try:
-            with open(modelZipFile, 'wb') as f:
-                with requests.get(url, stream=True) as r:
-                    r.raise_for_status()
-                    total_size = int(r.headers.get('content-length', 0))
-                    reporting_increment_percent = 1.0
-                    last_reported_download_percent = -reporting_increment_percent
-                    downloaded_size = 0
-                    for chunk in r.iter_content(chunk_size=8192 * 16):
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        downloaded_percent = 100.0 * downloaded_size / total_size
-                        if downloaded_percent - last_reported_download_percent > reporting_increment_percent:
-                            self.log(f"Downloading model: {downloaded_size/1024/1024:.1f}MB / {total_size/1024/1024:.1f}MB ({downloaded_percent:.1f}%)")
-                            last_reported_download_percent = downloaded_percent
-
-            self.log(f"Download finished. Extracting to {modelDir}...")
-            with zipfile.ZipFile(modelZipFile, 'r') as zip_f:
-                zip_f.extractall(modelDir)
-        except Exception as e:
-            raise e
-        finally:
-            if self.clearOutputFolder:
-                self.log("Cleaning up temporary model download folder...")
-                if os.path.isdir(tempDir):
-                    import shutil
-                    shutil.rmtree(tempDir)
-            else:
-                self.log(f"Not cleaning up temporary model download folder: {tempDir}")
-
+        """Download and install model. Interrupted downloads are resumed on the next call.
+        The model folder is only created when the model package is completely downloaded, verified, and extracted.
+        """
+        from PredictIceballLib import ModelDownloader
+        model = self.model(modelName)
+        downloader = ModelDownloader(self.modelsPath(), logCallback=self.log)
+        modelDir = downloader.install(modelName, model["url"], model.get("sha256"))
+        self.log("Registering model...")
+        self.modelRegistry.register(modelName, model["version"], modelDir)
 
     def _PredictIceballTerminologyPropertyTypes(self):
         """Get label terminology property types defined in from MONAI Auto3DSeg terminology.
         Terminology entries are either in DICOM or MONAI Auto3DSeg "Segmentation category and type".
         """
-
-        terminologiesLogic = slicer.util.getModuleLogic("Terminologies")
-        PredictIceballTerminologyName = slicer.modules.PredictIceballInstance.terminologyName
-
-        # Get anatomicalStructureCategory from the MONAI Auto3DSeg terminology
-        anatomicalStructureCategory = slicer.vtkSlicerTerminologyCategory()
-        numberOfCategories = terminologiesLogic.GetNumberOfCategoriesInTerminology(PredictIceballTerminologyName)
-        for i in range(numberOfCategories):
-            terminologiesLogic.GetNthCategoryInTerminology(PredictIceballTerminologyName, i, anatomicalStructureCategory)
-            if anatomicalStructureCategory.GetCodingSchemeDesignator() == "SCT" and anatomicalStructureCategory.GetCodeValue() == "123037004":
-                # Found the (123037004, SCT, "Anatomical Structure") category within DICOM master list
-                break
-
-        # Retrieve all anatomicalStructureCategory property type codes
-        terminologyPropertyTypes = []
-        terminologyType = slicer.vtkSlicerTerminologyType()
-        numberOfTypes = terminologiesLogic.GetNumberOfTypesInTerminologyCategory(PredictIceballTerminologyName, anatomicalStructureCategory)
-        for i in range(numberOfTypes):
-            if terminologiesLogic.GetNthTypeInTerminologyCategory(PredictIceballTerminologyName, anatomicalStructureCategory, i, terminologyType):
-                terminologyPropertyTypes.append(terminologyType.GetCodingSchemeDesignator() + "^" + terminologyType.GetCodeValue())
-
+        # Property types in the (123037004, SCT, "Anatomical Structure") category
+        terminologyPropertyTypes = set()
+        for (codingSchemeDesignator, codeValue), typeEntry in self.terminologyIndex.types.items():
+            if ("SCT", "123037004") in typeEntry["categories"]:
+                terminologyPropertyTypes.add(codingSchemeDesignator + "^" + codeValue)
         return terminologyPropertyTypes
 
     def _PredictIceballAnatomicRegions(self):
         """Get anatomic regions defined in from MONAI Auto3DSeg terminology.
         Terminology entries are either in DICOM or MONAI Auto3DSeg "Anatomic codes".
         """
-        anatomicRegions = []
-
-        terminologiesLogic = slicer.util.getModuleLogic("Terminologies")
-        if not hasattr(terminologiesLogic, "GetNumberOfRegionsInAnatomicContext"):
-            # This Slicer version does not have GetNumberOfRegionsInAnatomicContext method,
-            # do not add the region modifier (the only impact is that the modifier will not be selectable
-            # when editing the terminology on the GUI)
-            return anatomicRegions
-
-        PredictIceballAnatomicContextName = slicer.modules.PredictIceballInstance.anatomicContextName
-
-        # Retrieve all anatomical region codes
-
-        regionObject = slicer.vtkSlicerTerminologyType()
-        numberOfRegions = terminologiesLogic.GetNumberOfRegionsInAnatomicContext(PredictIceballAnatomicContextName)
-        for i in range(numberOfRegions):
-            if terminologiesLogic.GetNthRegionInAnatomicContext(PredictIceballAnatomicContextName, i, regionObject):
-                anatomicRegions.append(regionObject.GetCodingSchemeDesignator() + "^" + regionObject.GetCodeValue())
+        return set(codingSchemeDesignator + "^" + codeValue for codingSchemeDesignator, codeValue in self.terminologyIndex.regions)
 
-        return anatomicRegions
+    # Parsed label descriptions, shared between all logic instances (widget, tests, scripts).
+    # Maps model name to (labels file stamp, label descriptions).
+    _labelDescriptionsCache = {}
 
     def labelDescriptions(self, modelName):
         """Return mapping from label value to label description.
         Label description is a dict containing "name" and "terminology".
         Terminology string uses Slicer terminology entry format - see specification at
         https://slicer.readthedocs.io/en/latest/developer_guide/modules/segmentations.html#terminologyentry-tag
+        Parsed descriptions are cached until the model version or the labels file changes.
         """
+        labelsFilePath = self.modelPath(modelName).joinpath("labels.csv")
+        modelEntry = self.modelRegistry.entry(modelName)
+        labelsFileStat = os.stat(labelsFilePath)
+        stamp = (modelEntry["version"] if modelEntry else None, str(labelsFilePath), labelsFileStat.st_mtime_ns, labelsFileStat.st_size)
+        cachedStamp, cachedLabelDescriptions = PredictIceballLogic._labelDescriptionsCache.get(modelName, (None, None))
+        if cachedStamp != stamp:
+            cachedLabelDescriptions = self._readLabelDescriptions(labelsFilePath)
+            PredictIceballLogic._labelDescriptionsCache[modelName] = (stamp, cachedLabelDescriptions)
+        # Return a copy so that callers cannot modify the cache
+        return {labelValue: dict(labelDescription) for labelValue, labelDescription in cachedLabelDescriptions.items()}
+
+    def _readLabelDescriptions(self, labelsFilePath):
+        """Parse label descriptions from labels.csv file."""
 
         # Helper function to get code string from CSV file row
-        def getCodeString(field, columnNames, row):
+        def getCodeString(field, columnIndices, row):
             columnValues = []
             for fieldName in ["CodingSchemeDesignator", "CodeValue", "CodeMeaning"]:
-                columnIndex = columnNames.index(f"{field}.{fieldName}")
+                columnIndex = columnIndices[f"{field}.{fieldName}"]
                 try:
                     columnValue = row[columnIndex]
                 except IndexError:
@@ -852,19 +959,19 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
             return columnValues
 
         labelDescriptions = {}
-        labelsFilePath = self.modelPath(modelName).joinpath("labels.csv")
         import csv
         with open(labelsFilePath, "r") as f:
             reader = csv.reader(f)
             columnNames = next(reader)
-            data = {}
+            # Map column name to column index
+            columnIndices = {columnName: columnIndex for columnIndex, columnName in enumerate(columnNames)}
             # Loop through the rows of the csv file
             for row in reader:
 
                 # Determine segmentation category (DICOM or MONAIAuto3DSeg)
                 terminologyPropertyTypeStr = (  # Example: SCT^23451007
-                    row[columnNames.index("SegmentedPropertyTypeCodeSequence.CodingSchemeDesignator")]
-                    + "^" + row[columnNames.index("SegmentedPropertyTypeCodeSequence.CodeValue")])
+                    row[columnIndices["SegmentedPropertyTypeCodeSequence.CodingSchemeDesignator"]]
+                    + "^" + row[columnIndices["SegmentedPropertyTypeCodeSequence.CodeValue"]])
                 if terminologyPropertyTypeStr in self.PredictIceballTerminologyPropertyTypes:
                     terminologyName = slicer.modules.PredictIceballInstance.terminologyName
                 else:
@@ -872,8 +979,8 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
 
                 # Determine the anatomic context name (DICOM or MONAIAuto3DSeg)
                 anatomicRegionStr = (  # Example: SCT^279245009
-                    row[columnNames.index("AnatomicRegionSequence.CodingSchemeDesignator")]
-                    + "^" + row[columnNames.index("AnatomicRegionSequence.CodeValue")])
+                    row[columnIndices["AnatomicRegionSequence.CodingSchemeDesignator"]]
+                    + "^" + row[columnIndices["AnatomicRegionSequence.CodeValue"]])
                 if anatomicRegionStr in self.PredictIceballAnatomicRegions:
                     anatomicContextName = slicer.modules.PredictIceballInstance.anatomicContextName
                 else:
@@ -883,26 +990,26 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
                     terminologyName
                     +"~"
                     # Property category: "SCT^123037004^Anatomical Structure" or "SCT^49755003^Morphologically Altered Structure"
-                    + "^".join(getCodeString("SegmentedPropertyCategoryCodeSequence", columnNames, row))
+                    + "^".join(getCodeString("SegmentedPropertyCategoryCodeSequence", columnIndices, row))
                     + "~"
                     # Property type: "SCT^23451007^Adrenal gland", "SCT^367643001^Cyst", ...
-                    + "^".join(getCodeString("SegmentedPropertyTypeCodeSequence", columnNames, row))
+                    + "^".join(getCodeString("SegmentedPropertyTypeCodeSequence", columnIndices, row))
                     + "~"
                     # Property type modifier: "SCT^7771000^Left", ...
-                    + "^".join(getCodeString("SegmentedPropertyTypeModifierCodeSequence", columnNames, row))
+                    + "^".join(getCodeString("SegmentedPropertyTypeModifierCodeSequence", columnIndices, row))
                     + "~"
                     + anatomicContextName
                     + "~"
                     # Anatomic region (set if category is not anatomical structure): "SCT^64033007^Kidney", ...
-                    + "^".join(getCodeString("AnatomicRegionSequence", columnNames, row))
+                    + "^".join(getCodeString("AnatomicRegionSequence", columnIndices, row))
                     + "~"
                     # Anatomic region modifier: "SCT^7771000^Left", ...
-                    + "^".join(getCodeString("AnatomicRegionModifierSequence", columnNames, row))
+                    + "^".join(getCodeString("AnatomicRegionModifierSequence", columnIndices, row))
                     )
 
                 # Store the terminology string for this structure
-                labelValue = int(row[columnNames.index("LabelValue")])
-                name = row[columnNames.index("Name")]
+                labelValue = int(row[columnIndices["LabelValue"]])
+                name = row[columnIndices["Name"]]
                 labelDescriptions[labelValue] = { "name": name, "terminology": terminologyEntryStr }
 
         return labelDescriptions
@@ -910,6 +1017,17 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
     def getSegmentLabelColor(self, terminologyEntryStr):
         """Get segment label and color from terminology"""
 
+        # Terminology entry string: context~category~type~typeModifier~anatomicContext~region~regionModifier,
+        # each code is specified as codingSchemeDesignator^codeValue^codeMeaning
+        terminologyEntryFields = terminologyEntryStr.split("~")
+        if len(terminologyEntryFields) == 7 and terminologyEntryFields[0] in self.terminologyIndex.terminologyContextNames:
+            typeCode = (terminologyEntryFields[2].split("^") + ["", ""])[:2]
+            typeModifierCode = (terminologyEntryFields[3].split("^") + ["", ""])[:2]
+            labelColor = self.terminologyIndex.labelColor(typeCode[0], typeCode[1], typeModifierCode[0], typeModifierCode[1])
+            if labelColor:
+                return labelColor
+
+        # Not in the indexed terminology (e.g., DICOM master list), look up using terminology logic
         def labelColorFromTypeObject(typeObject):
             """typeObject is a terminology type or type modifier"""
             label = typeObject.GetSlicerLabel() if typeObject.GetSlicerLabel() else typeObject.GetCodeMeaning()
@@ -969,9 +1087,21 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
 
     def log(self, text):
         logging.info(text)
+        if self.logFile:
+            self.logFile.write(f"{text}\n")
         if self.logCallback:
             self.logCallback(text)
 
+    def openLogFile(self, logFilePath):
+        """Write all subsequent log messages to the specified file (in addition to the log callback)."""
+        self.closeLogFile()
+        self.logFile = open(logFilePath, "w", encoding="utf-8")
+
+    def closeLogFile(self):
+        if self.logFile:
+            self.logFile.close()
+            self.logFile = None
+
     def installedMONAIPythonPackageInfo(self):
         import shutil
         import subprocess
@@ -979,9 +1109,11 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         return versionInfo
 
     def setupPythonRequirements(self, upgrade=False):
-        import importlib.metadata
-        import importlib.util
-        import packaging
+        # Fast path: all required packages are already installed (pip is not invoked)
+        if not upgrade and self.dependencyChecker.isReady():
+            self.dependenciesInstalled = True
+            self.log("Dependencies are already installed.")
+            return
 
         # Install PyTorch
         try:
@@ -990,7 +1122,7 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
           raise RuntimeError("This module requires PyTorch extension. Install it from the Extensions Manager.")
 
         self.log("Initializing PyTorch...")
-        minimumTorchVersion = "1.12"
+        minimumTorchVersion = self.minimumTorchVersion
         torchLogic = PyTorchUtils.PyTorchUtilsLogic()
         if not torchLogic.torchInstalled():
             self.log("PyTorch Python package is required. Installing... (it may take several minutes)")
@@ -1007,18 +1139,686 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
 
         # Install MONAI with required components
         self.log("Initializing MONAI...")
-        # Specify minimum version 1.3, as this is a known working version (it is possible that an earlier version works, too).
-        # Without this, for some users monai-0.9.0 got installed, which failed with this error:
-        # "ImportError: cannot import name ‘MetaKeys’ from 'monai.utils'"
-        monaiInstallString = "monai[fire,pyyaml,nibabel,pynrrd,psutil,tensorboard,skimage,itk,tqdm,einops]>=1.3"
-        if upgrade:
-            monaiInstallString += " --upgrade"
-        slicer.util.pip_install(monaiInstallString)
+        missingRequirements = [requirement for requirement in self.dependencyChecker.missingRequirements() if not requirement.startswith("torch")]
+        if missingRequirements or upgrade:
+            if missingRequirements:
+                self.log(f"Missing Python packages: {', '.join(missingRequirements)}")
+            # Specify minimum version 1.3, as this is a known working version (it is possible that an earlier version works, too).
+            # Without this, for some users monai-0.9.0 got installed, which failed with this error:
+            # "ImportError: cannot import name ‘MetaKeys’ from 'monai.utils'"
+            monaiInstallString = "monai[fire,pyyaml,nibabel,pynrrd,psutil,tensorboard,skimage,itk,tqdm,einops]>=1.3"
+            if upgrade:
+                monaiInstallString += " --upgrade"
+            slicer.util.pip_install(monaiInstallString)
+
+        if not self.dependencyChecker.isReady():
+            raise RuntimeError(f"Failed to install required Python packages: {', '.join(self.dependencyChecker.missingRequirements())}")
 
         self.dependenciesInstalled = True
         self.log("Dependencies are set up successfully.")
 
 
+    def startInferenceWarmup(self, model=None):
+        """Run the inference script in warmup mode in the background: it imports all required modules
+        (loading them into the file cache), compiles Python bytecode, and creates weights caches of the model files.
+        Nothing is done if the dependencies or the model are not installed yet, or warmup has been already started.
+        Warmup runs only once for each logic instance and it does not keep a worker process running: it makes the startup
+        of the inference processes faster, but they still load the model each time (see startInferenceWorker for that).
+        """
+        if self.warmupProcess is not None:
+            return
+        if not self.dependencyChecker.isReady():
+            return
+        if model is None:
+            model = self.defaultModel
+        if not self.isModelInstalled(model):
+            return
+        import shutil
+        pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+        if not pythonSlicerExecutablePath:
+            return
+        modelPath = self.modelPath(model)
+        modelFiles = [str(modelPath.joinpath(fileName)) for fileName in ["needle_model.pt", "urethra_model.pt", "prostatemodel.pt", "model.pt"]]
+        inferenceScriptPyFile = os.path.join(self.moduleDir, "Scripts", "auto3dseg_segresnet_inference.py")
+        warmupCommand = [pythonSlicerExecutablePath, inferenceScriptPyFile, "--warmup", "--model-file", ",".join(modelFiles)]
+        logging.debug(f"Starting inference warmup: {warmupCommand}")
+        self.warmupProcess = slicer.util.launchConsoleProcess(warmupCommand)
+        # Output must be read, otherwise the process blocks when the pipe is full
+        self.startProcessMonitoring({"proc": self.warmupProcess},
+            lambda processInfo: logging.debug(f"Inference warmup completed (return code {processInfo['procReturnCode']})"),
+            logCallback=logging.debug)
+
+    def stopInferenceWarmup(self):
+        """Stop inference warmup if it is still running and wait for its process to exit"""
+        if self.warmupProcess is None:
+            return
+        if self.warmupProcess.poll() is None:
+            # Stopping only the launcher would leave the Python process running
+            import psutil
+            try:
+                psProcess = psutil.Process(self.warmupProcess.pid)
+                for psChildProcess in psProcess.children(recursive=True):
+                    psChildProcess.terminate()
+                psProcess.terminate()
+            except psutil.NoSuchProcess:
+                # Already exited
+                pass
+        self.warmupProcess.wait()
+
+    def startInferenceWorker(self, model=None, cpu=False):
+        """Start a persistent inference process (see InferenceWorker) and load the models into it in the background.
+        While it is running, the models are run in it when the processing waits for completion, instead of starting
+        a new process for each model. Returns True if the worker is running.
+        """
+        if self.inferenceWorker is not None and self.inferenceWorker.isRunning():
+            return True
+        if model is None:
+            model = self.defaultModel
+        if not self.dependencyChecker.isReady() or not self.isModelInstalled(model):
+            return False
+        import shutil
+        from PredictIceballLib import InferenceWorker
+        pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+        if not pythonSlicerExecutablePath:
+            return False
+        self.log("Starting inference worker...")
+        workerCommand = [pythonSlicerExecutablePath, os.path.join(self.moduleDir, "Scripts", "inference_worker.py")]
+        inferenceWorker = InferenceWorker(lambda command, environment: slicer.util.launchConsoleProcess(command, updateEnvironment=environment))
+        try:
+            inferenceWorker.start(workerCommand, {"CUDA_VISIBLE_DEVICES": "-1"} if cpu else None, logCallback=self.log)
+        except RuntimeError as e:
+            self.log(f"Failed to start inference worker, models run in separate processes: {e}")
+            return False
+        inferenceWorker.cpu = cpu
+        modelPath = self.modelPath(model)
+        inferenceWorker.loadModels([modelPath.joinpath(fileName) for fileName in ["needle_model.pt", "urethra_model.pt", "prostatemodel.pt", "model.pt"]])
+        self.inferenceWorker = inferenceWorker
+        return True
+
+    def stopInferenceWorker(self):
+        """Stop the persistent inference process if it is running"""
+        if self.inferenceWorker is None:
+            return
+        self.inferenceWorker.stop()
+        self.inferenceWorker = None
+
+    def runInferenceScript(self, args, cpu=False):
+        """Run the inference script with command-line arguments (list of str, without the script path) and wait for its completion.
+        The inference worker is used if it is running (and uses the same device), otherwise a new process is started.
+        Output is forwarded to the log. CalledProcessError is raised if the script fails.
+        """
+        from subprocess import CalledProcessError
+        if self.inferenceWorker is not None and self.inferenceWorker.isRunning() and self.inferenceWorker.cpu == cpu:
+            returnCode = self.inferenceWorker.run(args, self.log)
+            if returnCode != 0:
+                raise CalledProcessError(returnCode, args)
+            return
+        import shutil
+        pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+        if not pythonSlicerExecutablePath:
+            raise RuntimeError("Python was not found")
+        inferenceScriptPyFile = os.path.join(self.moduleDir, "Scripts", "auto3dseg_segresnet_inference.py")
+        proc = slicer.util.launchConsoleProcess([pythonSlicerExecutablePath, inferenceScriptPyFile] + list(args),
+            updateEnvironment={"CUDA_VISIBLE_DEVICES": "-1"} if cpu else None)
+        self.logProcessOutputUntilCompleted({"proc": proc})
+
+    def predictSeries(self, seriesPath, model=None, cpu=False):
+        """Predict the iceball for a series (volume file or DICOM series folder) without loading it into the scene.
+        :return: iceball labelmap (CroppedLabelmap), prediction time in seconds
+        """
+        import time
+        startTime = time.time()
+        segmentationProcessInfo = self.process([seriesPath], None, model, cpu, waitForCompletion=True)
+        if "resultLabelmap" not in segmentationProcessInfo:
+            raise RuntimeError(f"Processing failed with return code {segmentationProcessInfo['procReturnCode']}")
+        return segmentationProcessInfo["resultLabelmap"], round(time.time() - startTime, 2)
+
+    def processSeries(self, seriesPath, model=None, cpu=False, detectedTime=None, prediction=None):
+        """Predict the iceball for a series and write the segmentation and a timing report (JSON) next to it.
+        The series (volume file or DICOM series folder) is not loaded into the scene: its path is passed to the inference
+        scripts, which read the files directly, and the segmentation file is written without creating nodes.
+        :param detectedTime: time when the series first appeared, for reporting the total latency
+        :param prediction: output of predictSeries() for the current files of the series, if it is already computed
+        :return: True if processing was successful
+        """
+        import json
+        import time
+        from PredictIceballLib import FolderWatcher
+        segmentationFilePath, timingFilePath = FolderWatcher.resultPaths(seriesPath)
+        timing = {"input": seriesPath, "model": model if model else self.defaultModel}
+        startTime = time.time()
+        try:
+            if prediction is None:
+                self.log(f"Processing series {seriesPath}")
+                prediction = self.predictSeries(seriesPath, model, cpu)
+            else:
+                self.log(f"Using the prediction of series {seriesPath} that was computed before its files settled")
+                timing["earlyPrediction"] = True
+            resultLabelmap, timing["predictionTimeSec"] = prediction
+
+            stageStartTime = time.time()
+            self.writeSegmentationFile(resultLabelmap, segmentationFilePath, timing["model"])
+            timing["savingTimeSec"] = round(time.time() - stageStartTime, 2)
+            timing["status"] = "completed"
+            self.log(f"Iceball segmentation saved to {segmentationFilePath}")
+        except Exception as e:
+            timing["status"] = "failed"
+            timing["error"] = str(e)
+            self.log(f"Processing of series {seriesPath} failed: {e}")
+
+        timing["totalTimeSec"] = round(time.time() - startTime, 2)
+        if detectedTime is not None:
+            timing["latencySec"] = round(time.time() - detectedTime, 2)
+        tempFilePath = f"{timingFilePath}.{os.getpid()}.tmp"
+        with open(tempFilePath, "w", encoding="utf-8") as f:
+            json.dump(timing, f, indent=2)
+        os.replace(tempFilePath, timingFilePath)
+        return timing["status"] == "completed"
+
+    def watchFolder(self, folderPath, model=None, cpu=False, pollIntervalSec=1.0, settleTimeSec=5.0, maximumSeriesCount=None, timeoutSec=None):
+        """Process each new series that appears in folderPath (see processSeries). Series that already have results are skipped.
+        Series that are already in the folder when watching starts and have no results are processed, too,
+        so this can be used for batch processing of a folder (with maximumSeriesCount or timeoutSec).
+        The inference worker (see startInferenceWorker) is started when watching starts, so that the models are loaded
+        while waiting for the first series and each model runs without starting a new process.
+        If earlySeriesPrediction is enabled then a new series is predicted as soon as its files have not changed
+        between two polls. The result is only written when the series has settled (its files have not changed
+        for settleTimeSec), and if the files have changed since the prediction then the series is predicted again.
+        Runs until maximumSeriesCount series are processed or timeoutSec is elapsed (None = no limit).
+        :return: number of processed series
+        """
+        import time
+        from PredictIceballLib import FolderWatcher
+        watcher = FolderWatcher(folderPath, settleTimeSec)
+        watcher.skipExisting()
+        detectedTimes = {}
+        # Series path -> (signature of the series files when prediction started, output of predictSeries or None if it failed)
+        earlyPredictions = {}
+        processedSeriesCount = 0
+        startTime = time.time()
+        self.log(f"Watching folder {folderPath} for new series")
+        self.startInferenceWorker(model, cpu)
+        try:
+            while True:
+                newSeries, readySeries = watcher.poll()
+                for seriesPath in newSeries:
+                    self.log(f"New series detected: {seriesPath}")
+                    detectedTimes[seriesPath] = time.time()
+                for seriesPath in readySeries:
+                    signature, prediction = earlyPredictions.pop(seriesPath, (None, None))
+                    if prediction is not None and signature != FolderWatcher.signature(seriesPath):
+                        self.log(f"Series {seriesPath} has changed since it was predicted")
+                        prediction = None
+                    self.processSeries(seriesPath, model, cpu, detectedTimes.pop(seriesPath, None), prediction)
+                    watcher.markProcessed(seriesPath)
+                    processedSeriesCount += 1
+                    if maximumSeriesCount is not None and processedSeriesCount >= maximumSeriesCount:
+                        return processedSeriesCount
+                if self.earlySeriesPrediction:
+                    # Only one series is predicted between polls, so that series that become ready are not delayed
+                    currentTime = time.time()
+                    for seriesPath, signature, changedTime in watcher.pendingSeries():
+                        if currentTime - changedTime < pollIntervalSec or earlyPredictions.get(seriesPath, (None, None))[0] == signature:
+                            continue
+                        self.log(f"Predicting series {seriesPath} before its files have settled")
+                        try:
+                            earlyPredictions[seriesPath] = (signature, self.predictSeries(seriesPath, model, cpu))
+                        except Exception as e:
+                            # Files may be incomplete, the series is predicted again when it has settled
+                            self.log(f"Prediction of series {seriesPath} before its files have settled failed: {e}")
+                            earlyPredictions[seriesPath] = (signature, None)
+                        break
+                if timeoutSec is not None and time.time() - startTime > timeoutSec:
+                    return processedSeriesCount
+                slicer.app.processEvents()
+                time.sleep(pollIntervalSec)
+        finally:
+            self.stopInferenceWorker()
+
+    def inferenceScriptOptions(self, tempDir=None, incrementalStateFile=None, preview=False):
+        """Get additional command-line arguments for the inference script.
+        If tempDir is specified then preprocessed inputs are cached in that folder.
+        If incrementalStateFile is specified then incremental prediction is used (see incrementalStateFile()).
+        If preview is True then options for a quick, coarse prediction are added (incremental prediction is not used).
+        """
+        options = []
+        if self.slidingWindowWorkers is not None:
+            options.extend(["--sw-workers", str(self.slidingWindowWorkers)])
+        options.extend(["--aggregation", self.slidingWindowAggregation, "--accumulator-dtype", self.slidingWindowAccumulatorDtype])
+        if self.foregroundThreshold is not None:
+            options.extend(["--foreground-threshold", str(self.foregroundThreshold)])
+        if self.memoryBudget is not None:
+            options.extend(["--memory-budget", str(int(self.memoryBudget))])
+        if self.inferenceTuningFilePath.exists():
+            options.extend(["--tuning-file", str(self.inferenceTuningFilePath)])
+            if self.inferenceTuningAccuracySettings:
+                options.append("--tuning-accuracy-settings")
+        if self.preprocessingCacheEnabled and tempDir is not None:
+            options.extend(["--preprocessing-cache-dir", os.path.join(tempDir, "preprocessing-cache")])
+        if self.cropOutputEnabled:
+            options.append("--crop-output")
+        if preview:
+            options.extend(["--resolution-scale", str(self.previewResolutionScale), "--overlap", str(self.previewOverlap)])
+        elif incrementalStateFile is not None:
+            options.extend(["--incremental-state-file", str(incrementalStateFile), "--incremental-margin", str(int(self.incrementalMargin))])
+        return options
+
+    def incrementalStateFile(self, inputNode, modelName):
+        """Get state file of a model for incremental prediction, None if incremental prediction is disabled.
+        Each study (or input volume, if it is not in a study) has its own state, so that a scan is only compared
+        to previous scans of the same study. Incremental prediction is not used if the input is not a volume node (see process()).
+        """
+        if not self.incrementalPrediction or isinstance(inputNode, str):
+            return None
+        import hashlib
+        if self.incrementalStateDir is None:
+            self.incrementalStateDir = slicer.util.tempDirectory("PredictIceballIncremental")
+        key = self.anatomyCacheKey(inputNode) or f"node:{inputNode.GetID()}"
+        return os.path.join(self.incrementalStateDir, f"{modelName}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.pt")
+
+    def clearIncrementalState(self):
+        """Delete stored inputs and labels of incremental prediction"""
+        if self.incrementalStateDir is None:
+            return
+        import shutil
+        shutil.rmtree(self.incrementalStateDir, ignore_errors=True)
+        self.incrementalStateDir = None
+
+    @staticmethod
+    def labelmapCropExtent(offsetField, sizesField):
+        """Get (offset, uncropped sizes) from the "crop_offset" and "uncropped_sizes" fields of a cropped labelmap file"""
+        return [int(value) for value in offsetField.split()], [int(value) for value in sizesField.split()]
+
+    def readLabelmapArray(self, labelmapFile):
+        """Read labelmap file written by the inference script as a numpy array (IJK voxel order).
+        Cropped labelmaps are restored to the full extent of the input volume.
+        """
+        import nrrd
+        import numpy as np
+        labelmapArray, header = nrrd.read(str(labelmapFile))
+        if "crop_offset" not in header:
+            return labelmapArray
+        offset, sizes = PredictIceballLogic.labelmapCropExtent(header["crop_offset"], header["uncropped_sizes"])
+        fullArray = np.zeros(sizes, dtype=labelmapArray.dtype)
+        fullArray[tuple(slice(start, start + size) for start, size in zip(offset, labelmapArray.shape))] = labelmapArray
+        return fullArray
+
+    def refineAnatomy(self, prostate, urethra, needle):
+        """Prepare the anatomy inputs of the iceball model (CroppedLabelmap objects, in the geometry of the input volume).
+        The prostate is dilated by 12 voxels in the IJ plane. The needle is kept inside the dilated prostate,
+        the urethra is kept inside the dilated prostate where there is no needle.
+        Only the box of the dilated prostate is processed, as the results are empty outside of it.
+        :return: dilated prostate, refined needle, refined urethra (CroppedLabelmap objects, in the box of the dilated prostate)
+        """
+        import cv2
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+        dilationKernel = np.ones((25, 25), np.uint8)
+        dilationMargin = np.array([dilationKernel.shape[0] // 2, dilationKernel.shape[1] // 2, 0])
+        prostateBox = prostate.cropped()
+        start = np.maximum(prostateBox.offset - dilationMargin, 0)
+        stop = np.minimum(prostateBox.offset + prostateBox.array.shape + dilationMargin, prostate.shape)
+        region = tuple(slice(int(first), int(last)) for first, last in zip(start, stop))
+        prostateArray = (prostate.arrayInRegion(region) > 0).astype(np.uint8)
+        # cv2 dilates the first two axes (IJ), the K axis is used as image channels (a single channel would be removed from the shape)
+        dilatedProstateArray = cv2.dilate(prostateArray, dilationKernel, iterations=1).reshape(prostateArray.shape) > 0
+        needleArray = np.logical_and(dilatedProstateArray, needle.arrayInRegion(region) == 1)
+        urethraArray = np.logical_and(np.logical_and(dilatedProstateArray, urethra.arrayInRegion(region) == 1), np.logical_not(needleArray))
+        return tuple(CroppedLabelmap(array.astype(np.uint8), start, prostate.shape, prostate.header)
+            for array in [dilatedProstateArray, needleArray, urethraArray])
+
+    def probeMaskLabelmap(self, probes, inputNode, inputHeader):
+        """Get needle mask created from probe positions, in the geometry of inputNode (cropped to the probes).
+        :param probes: markups node (pairs of tip and entry points) or list of (tip, entry) RAS positions
+        :param inputHeader: NRRD header of the input volume file (written from inputNode)
+        """
+        from PredictIceballLib import CroppedLabelmap, ProbeRasterizer
+        ijkToRas = vtk.vtkMatrix4x4()
+        inputNode.GetIJKToRASMatrix(ijkToRas)
+        rasterizer = ProbeRasterizer(inputNode.GetImageData().GetDimensions(), slicer.util.arrayFromVTKMatrix(ijkToRas))
+        if isinstance(probes, slicer.vtkMRMLMarkupsNode):
+            # Markups positions are in world coordinates, the input file is written without the parent transform of the volume
+            worldToVolumeRas = vtk.vtkMatrix4x4()
+            slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(None, inputNode.GetParentTransformNode(), worldToVolumeRas)
+            probes = ProbeRasterizer.probesFromMarkups(probes, slicer.util.arrayFromVTKMatrix(worldToVolumeRas))
+        mask = rasterizer.rasterize(probes, self.probeDiameter)
+        self.log(f"Needle mask created from {len(probes)} probe positions ({int(mask.sum())} voxels)")
+        return CroppedLabelmap(mask, header=inputHeader).cropped()
+
+    def segmentMaskArray(self, segment, referenceVolumeNode):
+        """Get uint8 mask of an existing segmentation, resampled to the geometry of referenceVolumeNode (KJI voxel order).
+        :param segment: segmentation node (union of all its segments is used) or (segmentation node, segment ID) tuple
+        """
+        import numpy as np
+        if isinstance(segment, (list, tuple)):
+            segmentationNode, segmentIds = segment[0], [segment[1]]
+        else:
+            segmentationNode = segment
+            segmentIds = list(segmentationNode.GetSegmentation().GetSegmentIDs())
+        if not segmentIds:
+            raise ValueError(f"Segmentation {segmentationNode.GetName()} does not contain any segments")
+        mask = None
+        for segmentId in segmentIds:
+            if not segmentationNode.GetSegmentation().GetSegment(segmentId):
+                raise ValueError(f"Segment {segmentId} is not found in segmentation {segmentationNode.GetName()}")
+            # Binary labelmap is resampled in memory to the reference volume geometry
+            segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentId, referenceVolumeNode)
+            mask = segmentArray > 0 if mask is None else np.logical_or(mask, segmentArray > 0)
+        return mask.astype(np.uint8)
+
+    def segmentMaskLabelmap(self, segment, inputNode, inputHeader):
+        """Get mask of an existing segmentation in the geometry of inputNode (cropped to the segment).
+        The mask replaces the output of a segmentation model, therefore it uses the same form.
+        :param inputHeader: NRRD header of the input volume file (written from inputNode)
+        """
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+        mask = self.segmentMaskArray(segment, inputNode)
+        # Labelmaps use IJK voxel order
+        return CroppedLabelmap(np.transpose(mask, (2, 1, 0)), header=inputHeader).cropped()
+
+    def anatomyCacheKey(self, volumeNode):
+        """Get key of the anatomy cache for a volume: DICOM study and frame of reference UIDs if the volume was loaded from DICOM,
+        otherwise the subject hierarchy study item. Returns None if the volume is not in a study.
+        """
+        instanceUIDs = volumeNode.GetAttribute("DICOM.instanceUIDs")
+        if instanceUIDs and slicer.dicomDatabase:
+            instanceUID = instanceUIDs.split()[0]
+            studyInstanceUID = slicer.dicomDatabase.instanceValue(instanceUID, "0020,000D")
+            frameOfReferenceUID = slicer.dicomDatabase.instanceValue(instanceUID, "0020,0052")
+            if studyInstanceUID and frameOfReferenceUID:
+                return f"dicom:{studyInstanceUID}:{frameOfReferenceUID}"
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        studyItem = shNode.GetItemParent(shNode.GetItemByDataNode(volumeNode))
+        if studyItem and studyItem != shNode.GetSceneItemID():
+            return f"study:{studyItem}"
+        return None
+
+    def anatomySampleValues(self, volumeNode, sampleRas):
+        """Get voxel values of volumeNode at RAS positions (nearest neighbor). Positions outside the volume are NaN."""
+        import numpy as np
+        rasToIjk = vtk.vtkMatrix4x4()
+        volumeNode.GetRASToIJKMatrix(rasToIjk)
+        rasToIjk = slicer.util.arrayFromVTKMatrix(rasToIjk)
+        ijk = np.round(sampleRas @ rasToIjk[:3, :3].T + rasToIjk[:3, 3]).astype(int)
+        volumeArray = slicer.util.arrayFromVolume(volumeNode)
+        inside = np.all((ijk >= 0) & (ijk < volumeArray.shape[::-1]), axis=1)
+        values = np.full(len(sampleRas), np.nan)
+        values[inside] = volumeArray[ijk[inside, 2], ijk[inside, 1], ijk[inside, 0]]
+        return values
+
+    def cachedAnatomy(self, volumeNode):
+        """Get (prostateSegment, urethraSegment) from the anatomy cache if they can be used for volumeNode, None otherwise.
+        Cached segmentations are used if the volume belongs to the same study and frame of reference,
+        and the intensities around the prostate are similar to the scan that the segmentations were computed from.
+        """
+        import numpy as np
+        key = self.anatomyCacheKey(volumeNode)
+        if not key:
+            self.log("Anatomy cache miss: input volume is not in a study")
+            return None
+        entry = self.anatomyCache.get(key)
+        if entry is None or not slicer.mrmlScene.IsNodePresent(entry["segmentationNode"]):
+            self.log(f"Anatomy cache miss: no previous scan in this study ({key})")
+            return None
+        values = self.anatomySampleValues(volumeNode, entry["sampleRas"])
+        valid = ~np.isnan(values)
+        correlation = 0.0
+        if valid.sum() > 0.9 * len(values):
+            correlation = np.corrcoef(values[valid], entry["sampleValues"][valid])[0, 1]
+        if not correlation >= self.anatomyCacheMinimumCorrelation:
+            self.log(f"Anatomy cache miss: anatomy has changed (correlation {correlation:.2f} < {self.anatomyCacheMinimumCorrelation})")
+            return None
+        self.log(f"Anatomy cache hit: using prostate and urethra of a previous scan (correlation {correlation:.2f})")
+        segmentationNode = entry["segmentationNode"]
+        return (segmentationNode, "prostate"), (segmentationNode, "urethra")
+
+    def updateAnatomyCache(self, volumeNode, prostate, urethra, maximumSampleCount=20000, marginMm=10.0):
+        """Store prostate and urethra segmentations (CroppedLabelmap objects) of volumeNode for later scans of the same study"""
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+        key = self.anatomyCacheKey(volumeNode)
+        if not key:
+            return
+        prostate = CroppedLabelmap((prostate.array == 1).astype(np.uint8), prostate.offset, prostate.shape).cropped()
+        urethra = CroppedLabelmap((urethra.array == 1).astype(np.uint8), urethra.offset, urethra.shape).cropped()
+        if not prostate.array.any():
+            return
+
+        entry = self.anatomyCache.get(key)
+        if entry is None or not slicer.mrmlScene.IsNodePresent(entry["segmentationNode"]):
+            segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", slicer.mrmlScene.GenerateUniqueName("AnatomyCache"))
+            segmentationNode.SetHideFromEditors(True)
+            segmentationNode.SetSaveWithScene(False)
+            entry = {"segmentationNode": segmentationNode}
+            self.anatomyCache[key] = entry
+        segmentationNode = entry["segmentationNode"]
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentation = segmentationNode.GetSegmentation()
+        for segmentId, segmentLabelmap in [("prostate", prostate), ("urethra", urethra)]:
+            if not segmentation.GetSegment(segmentId):
+                segmentation.AddEmptySegment(segmentId, segmentId)
+            self.updateSegmentFromLabelmap(segmentationNode, segmentId, segmentLabelmap, volumeNode)
+
+        # Intensity samples in the bounding box of the prostate (with a margin), for checking if the anatomy has changed
+        ijkToRas = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRas)
+        ijkToRas = slicer.util.arrayFromVTKMatrix(ijkToRas)
+        margin = np.ceil(marginMm / np.array(volumeNode.GetSpacing())).astype(int)
+        ijkMin = np.maximum(prostate.offset - margin, 0)
+        ijkMax = np.minimum(prostate.offset + prostate.array.shape + margin, prostate.shape)
+        step = max(1, int(np.ceil((np.prod(ijkMax - ijkMin) / maximumSampleCount) ** (1 / 3))))
+        k, j, i = np.mgrid[ijkMin[2]:ijkMax[2]:step, ijkMin[1]:ijkMax[1]:step, ijkMin[0]:ijkMax[0]:step]
+        sampleIjk = np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1)
+        entry["sampleRas"] = sampleIjk @ ijkToRas[:3, :3].T + ijkToRas[:3, 3]
+        entry["sampleValues"] = slicer.util.arrayFromVolume(volumeNode)[k.ravel(), j.ravel(), i.ravel()].astype(float)
+        self.log(f"Anatomy cache updated ({key})")
+
+    def clearAnatomyCache(self):
+        for entry in self.anatomyCache.values():
+            if slicer.mrmlScene.IsNodePresent(entry["segmentationNode"]):
+                slicer.mrmlScene.RemoveNode(entry["segmentationNode"])
+        self.anatomyCache = {}
+
+    def segmentAnatomy(self, inputNode, inputFile, modelPath, tempDir, cpu=False, preview=False, names=("needle", "urethra", "prostate"),
+                       probes=None, segments=None, anatomyLabelmaps=None):
+        """Get needle, urethra and prostate labelmaps (CroppedLabelmap objects in the geometry of inputFile) for the iceball model.
+        Used by process() and evaluateProbeLayouts(). For each anatomy name, a labelmap that is already in anatomyLabelmaps is reused,
+        known probe positions (needle) or an existing segmentation is used if specified, prostate and urethra of a previous scan
+        are used if the anatomy cache is enabled and still valid, otherwise the segmentation model runs (in the foreground).
+        :param inputNode: input volume node, or path of the input volume file or DICOM series folder (see process())
+        :param inputFile: input volume file, written from inputNode
+        :param probes: known probe positions for the needle (see process())
+        :param segments: dict of anatomy name -> existing segmentation (see process()), None values are ignored
+        :param anatomyLabelmaps: dict of anatomy name -> CroppedLabelmap, computed labelmaps are added to it
+        :return: anatomyLabelmaps
+        """
+        import nrrd
+        from PredictIceballLib import CroppedLabelmap
+
+        if anatomyLabelmaps is None:
+            anatomyLabelmaps = {}
+        segments = {name: segment for name, segment in (segments or {}).items() if segment is not None}
+        if probes is not None and "needle" in segments:
+            raise ValueError("Only one of probes and needleSegment can be specified")
+        inputIsNode = not isinstance(inputNode, str)
+        if (probes is not None or segments) and not inputIsNode:
+            raise ValueError("Probes and existing segmentations can only be used if the input is a volume node")
+        # Only needed for probes and existing segmentations, the input of the inference scripts may be a DICOM folder
+        inputHeader = nrrd.read_header(inputFile) if inputIsNode else None
+
+        # Anatomy of a previous scan of the same study is used if it is still valid
+        anatomyFromModels = not any(name in segments or name in anatomyLabelmaps for name in ["prostate", "urethra"])
+        if anatomyFromModels and self.anatomyCacheEnabled and inputIsNode:
+            cachedAnatomy = self.cachedAnatomy(inputNode)
+            if cachedAnatomy:
+                segments["prostate"], segments["urethra"] = cachedAnatomy
+                anatomyFromModels = False
+
+        modelFileNames = {"needle": "needle_model.pt", "urethra": "urethra_model.pt", "prostate": "prostatemodel.pt"}
+        for name in names:
+            if name in anatomyLabelmaps:
+                self.log(f"Using the {name} segmentation that is already computed")
+            elif name == "needle" and probes is not None:
+                anatomyLabelmaps[name] = self.probeMaskLabelmap(probes, inputNode, inputHeader)
+            elif name in segments:
+                anatomyLabelmaps[name] = self.segmentMaskLabelmap(segments[name], inputNode, inputHeader)
+                self.log(f"Using existing segmentation for {name} ({int(anatomyLabelmaps[name].array.sum())} voxels)")
+            else:
+                segmentationFile = os.path.join(tempDir, f"{name}-segmentation.nrrd")
+                self.runInferenceScript([str(modelPath.joinpath(modelFileNames[name])), inputFile, segmentationFile]
+                    + self.inferenceScriptOptions(tempDir, self.incrementalStateFile(inputNode, name), preview), cpu)
+                anatomyLabelmaps[name] = CroppedLabelmap.read(segmentationFile)
+
+        if anatomyFromModels and self.anatomyCacheEnabled and inputIsNode and not preview:
+            self.updateAnatomyCache(inputNode, anatomyLabelmaps["prostate"], anatomyLabelmaps["urethra"])
+        return anatomyLabelmaps
+
+    def layoutLabelmap(self, refinedNeedle, refinedUrethra):
+        """Get probe layout labelmap (1 = needle, 2 = urethra) from the outputs of refineAnatomy().
+        The inference scripts composite it into the input of the iceball model as image + 1000 * layout.
+        """
+        from PredictIceballLib import CroppedLabelmap
+        return CroppedLabelmap(refinedNeedle.array + 2 * refinedUrethra.array, refinedNeedle.offset, refinedNeedle.shape,
+            refinedNeedle.header).cropped()
+
+    def refineIceball(self, iceball, refinedUrethra):
+        """Get iceball labelmap (CroppedLabelmap) that excludes the urethra (refined urethra is an output of refineAnatomy())"""
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+        # Ensure both labelmaps have the same shape
+        assert iceball.shape == refinedUrethra.shape, "Iceball prediction and urethra segmentation must have the same dimensions"
+        # Only the box of the iceball is processed
+        refinedArray = np.logical_and(iceball.array == 1, np.logical_not(refinedUrethra.arrayInRegion(iceball.region())))
+        return CroppedLabelmap(refinedArray.astype(np.uint8), iceball.offset, iceball.shape, iceball.header)
+
+    def evaluateProbeLayouts(self, inputNode, layouts, model=None, cpu=False, anatomyLabelmaps=None):
+        """Predict the iceball for multiple candidate probe layouts on the same scan.
+        Prostate and urethra are segmented once, and the iceball model runs once for all layouts
+        (composited inputs share the preprocessing, and each network call evaluates a window for all layouts).
+        Anatomy is segmented and refined, and results are refined the same way as in process() (same helper methods).
+        :param inputNode: input scalar volume
+        :param layouts: list of probe layouts, each is a markups node or a list of (tip, entry) RAS positions (see process())
+        :param anatomyLabelmaps: dict of prostate and urethra labelmaps (CroppedLabelmap) of inputNode. Labelmaps that are
+          in the dict are reused, computed labelmaps are added to it, so that they are computed only once for multiple calls.
+        :return: list of dicts, one for each layout:
+          "iceball" (uint8 array in KJI voxel order, urethra is excluded the same way as in process()),
+          "prostateCoverage" (fraction of the prostate inside the iceball),
+          "urethraOverlap" (fraction of the urethra inside the predicted iceball), "urethraOverlapVolume" (in mm3)
+        """
+        import shutil
+        import time
+        import nrrd
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+
+        if not layouts:
+            raise ValueError("No probe layouts are specified")
+        if model is None:
+            model = self.defaultModel
+        if not self.isModelInstalled(model):
+            self.downloadModel(model)
+        modelPath = self.modelPath(model)
+        pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+        if not pythonSlicerExecutablePath:
+            raise RuntimeError("Python was not found")
+        additionalEnvironmentVariables = {"CUDA_VISIBLE_DEVICES": "-1"} if cpu else None
+        startTime = time.time()
+        tempDir = slicer.util.tempDirectory()
+
+        inputImageFile = os.path.join(tempDir, "input-volume0.nrrd")
+        volumeStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
+        volumeStorageNode.SetFileName(inputImageFile)
+        volumeStorageNode.UseCompressionOff()
+        volumeStorageNode.WriteData(inputNode)
+        slicer.mrmlScene.RemoveNode(volumeStorageNode)
+        inputHeader = nrrd.read_header(inputImageFile)
+
+        # Anatomy does not depend on the probe layout, it is segmented only once
+        anatomyLabelmaps = self.segmentAnatomy(inputNode, inputImageFile, modelPath, tempDir, cpu, names=["urethra", "prostate"],
+            anatomyLabelmaps=anatomyLabelmaps)
+        prostate = anatomyLabelmaps["prostate"]
+        urethra = anatomyLabelmaps["urethra"]
+
+        layoutFiles = []
+        resultFiles = []
+        refinedUrethras = []
+        for layoutIndex, probes in enumerate(layouts):
+            needle = self.probeMaskLabelmap(probes, inputNode, inputHeader)
+            _, refinedNeedle, refinedUrethra = self.refineAnatomy(prostate, urethra, needle)
+            refinedUrethras.append(refinedUrethra)
+            layoutFiles.append(os.path.join(tempDir, f"layout{layoutIndex}.nrrd"))
+            resultFiles.append(os.path.join(tempDir, f"iceball{layoutIndex}.nrrd"))
+            self.layoutLabelmap(refinedNeedle, refinedUrethra).write(layoutFiles[-1])
+
+        layoutScriptPyFile = os.path.join(self.moduleDir, "Scripts", "layout_inference.py")
+        command = [pythonSlicerExecutablePath, layoutScriptPyFile, "--model-file", str(modelPath.joinpath("model.pt")),
+            "--image-file", inputImageFile, "--layout-files", ",".join(layoutFiles), "--result-files", ",".join(resultFiles)
+            ] + self.inferenceScriptOptions()
+        proc = slicer.util.launchConsoleProcess(command, updateEnvironment=additionalEnvironmentVariables)
+        slicer.util.logProcessOutput(proc)
+
+        voxelVolume = np.prod(inputNode.GetSpacing())
+        prostateVoxelCount = max(int((prostate.array == 1).sum()), 1)
+        urethraVoxelCount = max(int((urethra.array == 1).sum()), 1)
+        results = []
+        for resultFile, refinedUrethra in zip(resultFiles, refinedUrethras):
+            iceball = CroppedLabelmap.read(resultFile)
+            refinedIceball = self.refineIceball(iceball, refinedUrethra)
+            # Overlaps are only computed in the box of the iceball
+            iceballRegion = iceball.region()
+            urethraOverlapCount = int(np.logical_and(iceball.array == 1, urethra.arrayInRegion(iceballRegion) == 1).sum())
+            prostateCoveredCount = int(np.logical_and(refinedIceball.array > 0, prostate.arrayInRegion(iceballRegion) == 1).sum())
+            results.append({
+                "iceball": np.transpose(refinedIceball.toArray(), (2, 1, 0)),
+                "prostateCoverage": prostateCoveredCount / prostateVoxelCount,
+                "urethraOverlap": urethraOverlapCount / urethraVoxelCount,
+                "urethraOverlapVolume": urethraOverlapCount * voxelVolume,
+                })
+
+        if self.clearOutputFolder:
+            shutil.rmtree(tempDir)
+        self.log(f"Evaluated {len(layouts)} probe layouts in {time.time() - startTime:.2f} seconds")
+        return results
+
+    def tuneInference(self, model=None, imageFile=None, waitForCompletion=False, completedCallback=None):
+        """Find the fastest inference settings for each file of the model on this machine.
+        Results are stored in inferenceTuningFilePath and used automatically by process().
+        If imageFile is not specified then a synthetic volume is used for benchmarking.
+        Tuning takes several minutes, therefore by default it runs in the background and completedCallback(returnCode)
+        is called when it is finished.
+        """
+        import shutil
+        if model is None:
+            model = self.defaultModel
+        if not self.isModelInstalled(model):
+            self.downloadModel(model)
+        pythonSlicerExecutablePath = shutil.which("PythonSlicer")
+        if not pythonSlicerExecutablePath:
+            raise RuntimeError("Python was not found")
+        tuningScriptPyFile = os.path.join(self.moduleDir, "Scripts", "inference_tuning.py")
+        tuningCommand = [pythonSlicerExecutablePath, tuningScriptPyFile,
+            "--model-folder", str(self.modelPath(model)),
+            "--tuning-file", str(self.inferenceTuningFilePath)]
+        if imageFile:
+            tuningCommand.extend(["--image-file", imageFile])
+        self.log(f"Tuning inference settings for model {model}...")
+        proc = slicer.util.launchConsoleProcess(tuningCommand)
+
+        def onTuningCompleted(processInfo):
+            if processInfo["procReturnCode"] == 0:
+                self.log(f"Tuning results saved in {self.inferenceTuningFilePath}")
+            else:
+                self.log(f"Tuning inference settings failed (return code {processInfo['procReturnCode']})")
+            if completedCallback:
+                completedCallback(processInfo["procReturnCode"])
+
+        if waitForCompletion:
+            slicer.util.logProcessOutput(proc)
+            onTuningCompleted({"procReturnCode": proc.returncode})
+        else:
+            self.startProcessMonitoring({"proc": proc}, onTuningCompleted)
+
     def setDefaultParameters(self, parameterNode):
         """
         Initialize parameter node with default settings.
@@ -1049,33 +1849,43 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         if retcode != 0:
             raise CalledProcessError(retcode, proc.args, output=proc.stdout, stderr=proc.stderr)
 
-    def process(self, inputNodes, outputSegmentation, model=None, cpu=False, waitForCompletion=True, customData=None):
+    def process(self, inputNodes, outputSegmentation, model=None, cpu=False, waitForCompletion=True, customData=None, probes=None,
+                prostateSegment=None, urethraSegment=None, needleSegment=None, preview=False, anatomyLabelmaps=None):
 
         """
         Run the processing algorithm.
         Can be used without GUI widget.
-        :param inputNodes: input nodes in a list
-        :param outputVolume: thresholding result
+        :param inputNodes: input nodes in a list. Paths of volume files or DICOM series folders can be used instead of nodes,
+          they are passed to the inference scripts without loading them into the scene (probes, existing segmentations,
+          the anatomy cache and incremental prediction require a volume node).
+        :param outputSegmentation: segmentation node that the result is imported into. If None then the result is not imported,
+          it is stored in segmentationProcessInfo["resultLabelmap"] (CroppedLabelmap) instead.
         :param model: one of self.models
         :param cpu: use CPU instead of GPU
-        :param waitForCompletion: if True then the method waits for the processing to finish
+        :param waitForCompletion: if True then the method waits for the processing to finish (the completion callback
+          is called before the method returns), otherwise the processing runs in the background
         :param customData: any custom data to identify or describe this processing request, it will be returned in the process completed callback when waitForCompletion is False
+        :param probes: known probe positions, either a markups node or a list of (tip, entry) RAS positions.
+          If specified then the needle mask is created from the probe positions (with probeDiameter) instead of running the needle model.
+        :param prostateSegment: existing prostate segmentation, either a segmentation node (all segments are used)
+          or a (segmentation node, segment ID) tuple. If specified then the prostate model is not run.
+        :param urethraSegment: existing urethra segmentation (same format as prostateSegment), replaces the urethra model.
+        :param needleSegment: existing needle segmentation (same format as prostateSegment), replaces the needle model.
+        :param preview: if True then a quick, coarse prediction is computed (see previewResolutionScale and previewOverlap).
+          Segmentations computed for a preview are not stored in the anatomy cache.
+        :param anatomyLabelmaps: dict of anatomy name (needle, urethra, prostate) -> CroppedLabelmap in the geometry of the first input node.
+          Labelmaps in the dict are used instead of running the models, computed labelmaps are added to it (see segmentAnatomy()).
         """
 
         if not inputNodes:
             raise ValueError("Input nodes are invalid")
 
-        if not outputSegmentation:
-            raise ValueError("Output segmentation is invalid")
-
         if model == None:
             model = self.defaultModel
 
-        try:
-            modelPath = self.modelPath(model)
-        except:
+        if not self.isModelInstalled(model):
             self.downloadModel(model)
-            modelPath = self.modelPath(model)
+        modelPath = self.modelPath(model)
 
         segmentationProcessInfo = {}
 
@@ -1093,6 +1903,10 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         import pathlib
         tempDirPath = pathlib.Path(tempDir)
 
+        logFilePath = tempDirPath.joinpath("PredictIceball.log")
+        self.openLogFile(logFilePath)
+        segmentationProcessInfo["logFile"] = str(logFilePath)
+
         # Get Python executable path
         import shutil
         pythonSlicerExecutablePath = shutil.which("PythonSlicer")
@@ -1102,7 +1916,11 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         # Write input volume to file
         inputFiles = []
         for inputIndex, inputNode in enumerate(inputNodes):
-            if inputNode.IsA('vtkMRMLScalarVolumeNode'):
+            if isinstance(inputNode, str):
+                # Volume file or DICOM series folder, the inference scripts read it directly
+                self.log(f"Using input file {inputNode}")
+                inputFiles.append(inputNode)
+            elif inputNode.IsA('vtkMRMLScalarVolumeNode'):
                 inputImageFile = tempDir + f"/input-volume{inputIndex}.nrrd"
                 self.log(f"Writing input file to {inputImageFile}")
                 volumeStorageNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLVolumeArchetypeStorageNode")
@@ -1114,159 +1932,39 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
             else:
                 raise ValueError(f"Input node type {inputNode.GetClassName()} is not supported")
 
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        finalinputFile = os.path.join(script_dir, "final-input.nrrd")
-        finalinputFile1 = os.path.join(script_dir, "final-input.nii.gz")
-        outputSegmentationFile = os.path.join(script_dir, "output-segmentation.nrrd")
-        needleSegmentationFile = os.path.join(script_dir, "needle-segmentation.nrrd") 
-        prostateSegmentationFile = os.path.join(script_dir, "prostate-segmentation.nrrd")
-        urethraSegmentationFile = os.path.join(script_dir, "urethra-segmentation.nrrd")
-        prostatedilatedSegmentationFile = os.path.join(script_dir, "prostate-dilated-segmentation.nii.gz")
-        needleprocessed = os.path.join(script_dir, "needle-processed-segmentation.nii.gz")
+        # Intermediate results are cropped labelmaps (see CroppedLabelmap)
+        roiMaskFile = os.path.join(tempDir, "prostate-dilated-segmentation.nrrd")
+        layoutFile = os.path.join(tempDir, "layout.nrrd")
+        outputSegmentationFile = os.path.join(tempDir, "output-segmentation.nrrd")
         modelPtFile = modelPath.joinpath("model.pt")
-        needlemodelPtFile = modelPath.joinpath("needle_model.pt")
-        urethramodelPtFile = modelPath.joinpath("urethra_model.pt")
-        urethraprocessed = os.path.join(script_dir, "urethra-processed-segmentation.nii.gz")
-        prostatemodelPtFile = modelPath.joinpath("prostatemodel.pt")
         inferenceScriptPyFile = os.path.join(self.moduleDir, "Scripts", "auto3dseg_segresnet_inference.py")
 
         additionalEnvironmentVariables = None
         if cpu:
             additionalEnvironmentVariables = {"CUDA_VISIBLE_DEVICES": "-1"}
             self.log(f"Additional environment variables: {additionalEnvironmentVariables}")
-        
+
         start_time = time.time()
         timing_checkpoints = []  # list of (operation, time) tuples
-        # Part 1: Generate needle, urethra and prostate segmentations
-        command1 = [
-            pythonSlicerExecutablePath,        # invoking python interpreter
-            str(inferenceScriptPyFile),        # script to run
-            str(needlemodelPtFile),            # argument 1
-            inputFiles[0],                     # argument 2
-            str(needleSegmentationFile)        # argument 3
-        ]
-        command2 = [
-            pythonSlicerExecutablePath,         # invoking python interpreter
-            str(inferenceScriptPyFile),         # script to run
-            str(urethramodelPtFile),            # argument 1
-            inputFiles[0],                      # argument 2
-            str(urethraSegmentationFile)        # argument 3
-        ]
-        command3 = [
-            pythonSlicerExecutablePath,          # invoking python interpreter
-            str(inferenceScriptPyFile),          # script to run
-            str(prostatemodelPtFile),            # argument 1
-            inputFiles[0],                       # argument 2
-            str(prostateSegmentationFile)        # argument 3
-        ]
+        # Part 1: Generate needle, urethra and prostate segmentations (existing segmentations are used instead of running the models)
         self.log("Preprocessing Image with MONAIAuto3DSeg AI and others ...")
-
-        # Execute the command
-        proc1 = slicer.util.launchConsoleProcess(command1, updateEnvironment=additionalEnvironmentVariables)
-        slicer.util.logProcessOutput(proc1)
-        proc2 = slicer.util.launchConsoleProcess(command2, updateEnvironment=additionalEnvironmentVariables)
-        slicer.util.logProcessOutput(proc2)
-        proc3 = slicer.util.launchConsoleProcess(command3, updateEnvironment=additionalEnvironmentVariables)
-        slicer.util.logProcessOutput(proc3)
-
+        anatomyLabelmaps = self.segmentAnatomy(inputNodes[0], inputFiles[0], modelPath, tempDir, cpu, preview, probes=probes,
+            segments={"needle": needleSegment, "urethra": urethraSegment, "prostate": prostateSegment}, anatomyLabelmaps=anatomyLabelmaps)
         self.log("Finished")
-
         timing_checkpoints.append(("Generating urethra, needle and prostate segmentations", time.time()))
-        
-        # Part 2: Generate dilated prostate
-        prostate_img = sitk.ReadImage(str(prostateSegmentationFile))
-        sitk.WriteImage(prostate_img, str(prostateSegmentationFile)[:-4]+"nii.gz")
-        prostate_image = nib.load(str(prostateSegmentationFile)[:-4]+"nii.gz")
-        prostate_data = prostate_image.get_fdata()
-        kernel = np.ones((25,25),np.uint8) 
-        dilated_prostate = cv2.dilate(prostate_data, kernel, iterations=1)
-        rescaled_img = nib.Nifti1Image(dilated_prostate, prostate_image.affine)
-        # Convert values greater than 1 to 1
-        data = rescaled_img.get_fdata()
-        data[data>1] = 1
-        rescaled_img2 = nib.Nifti1Image(data, prostate_image.affine)
-        # Save the rescaled image to a new file
-        nib.save(rescaled_img2, str(prostatedilatedSegmentationFile))
-        timing_checkpoints.append(("Dilating prostate", time.time()))
-
-        # Part 3: Refine needle
-        needle_img = sitk.ReadImage(str(needleSegmentationFile))
-        sitk.WriteImage(needle_img, str(needleSegmentationFile)[:-4]+"nii.gz")
-        needle_image = nib.load(str(needleSegmentationFile)[:-4]+"nii.gz")
-        prostate_image = nib.load(str(prostatedilatedSegmentationFile))
-        # Extract data
-        prostate_data = prostate_image.get_fdata()
-        needle_data = needle_image.get_fdata()
-        # Ensure both datasets have the same shape
-        assert prostate_data.shape == needle_data.shape, "Prostate and needle segmentations must have the same shape."
-        # Perform logical AND operation
-        # This sets the needle to 1 only within the prostate region
-        modified_needle_data = np.logical_and(prostate_data == 1, needle_data == 1)
-        # Create a new NIfTI image with the modified data
-        new_image = nib.Nifti1Image(modified_needle_data, needle_image.affine, needle_image.header)
-        nib.save(new_image, str(needleprocessed))
-        
-        # Part 4: Refine urethra
-        urethra_img = sitk.ReadImage(str(urethraSegmentationFile))
-        sitk.WriteImage(urethra_img, str(urethraSegmentationFile)[:-4]+"nii.gz")
-        refined_needle_image = nib.load(str(needleprocessed))
-        urethra_image = nib.load(str(urethraSegmentationFile)[:-4]+"nii.gz")
-        # Extract data
-        new_needle_data = refined_needle_image.get_fdata()
-        urethra_data = urethra_image.get_fdata()
-        # Ensure both datasets have the same shape
-        assert prostate_data.shape == urethra_data.shape == new_needle_data.shape, "Prostate, needle and urethra segmentations must have the same shape."
-        # Perform logical AND operation
-        # This sets the urethra to 1 only within the prostate region and where needle is not present
-        modified_urethra_data = np.logical_and(np.logical_and(prostate_data == 1, urethra_data == 1), np.logical_not(np.logical_and(new_needle_data == 1, urethra_data == 1)))
-        # Create a new NIfTI image with the modified data
-        new_image1 = nib.Nifti1Image(modified_urethra_data, urethra_image.affine, urethra_image.header)
-        nib.save(new_image1, str(urethraprocessed))
-        timing_checkpoints.append(("Processing urethra", time.time()))
 
-        
-        # Part 5: Generate final processed input file
-        img = sitk.ReadImage(inputFiles[0])
-        sitk.WriteImage(img, inputFiles[0][:-4]+"nii.gz")
-        input_image = nib.load(inputFiles[0][:-4]+"nii.gz")
-        urethra_segmentation = nib.load(str(urethraprocessed))
-        # Ensure both images have the same shape
-        assert input_image.shape == urethra_segmentation.shape == refined_needle_image.shape, "Input image and segmentations must have the same dimensions"    
-        # Convert to arrays
-        input_array = input_image.get_fdata()
-        urethra_array = urethra_segmentation.get_fdata()
-        # Combine the input image and segmentations
-        combined_array = input_array + (urethra_array*2000) + (new_needle_data*1000)
-        # Create a new Nifti1Image object for the combined data
-        combined_image = nib.Nifti1Image(combined_array, input_image.affine)    
-        # Save the combined image as a new nifti file
-        nib.save(combined_image, str(finalinputFile1))
-
-        img = nib.load(str(finalinputFile1)) 
-        data = img.get_fdata()
-        header = img.header
-        x = img.header["srow_x"]
-        y = img.header["srow_y"]
-        z = img.header["srow_z"]
-        print(data.shape)
-        # Need to save as nrrd file
-        sitk_image = sitk.GetImageFromArray(np.transpose(data, (2, 1, 0)))
-        spacing = np.ones(3)
-        spacing[0] = -x[0]
-        spacing[1] = -y[1]
-        spacing[2] = z[2]
-        print(spacing)
-        sitk_image.SetSpacing(spacing)
-        origin = np.ones(3)
-        origin[0] = -header["qoffset_x"]
-        origin[1] = -header["qoffset_y"]
-        origin[2] = header["qoffset_z"]
-        print(origin)
-        sitk_image.SetOrigin(origin)
-        # Save the image to a new file
-        sitk.WriteImage(sitk_image, str(finalinputFile))
-
-        timing_checkpoints.append(("Generasting final processed input image", time.time()))
+        # Part 2: Dilate prostate, refine needle and urethra
+        dilatedProstate, refinedNeedle, refinedUrethra = self.refineAnatomy(
+            anatomyLabelmaps["prostate"], anatomyLabelmaps["urethra"], anatomyLabelmaps["needle"])
+        # Keep the urethra mask in memory for refining the iceball
+        segmentationProcessInfo["urethraMask"] = refinedUrethra
+        timing_checkpoints.append(("Processing prostate, needle and urethra", time.time()))
+
+        # Part 3: Write the layout (1 = needle, 2 = urethra), the inference script composites it into the input as image + 1000 * layout
+        self.layoutLabelmap(refinedNeedle, refinedUrethra).write(layoutFile)
+        if self.skipWindowsOutsideProstate:
+            dilatedProstate.write(roiMaskFile)
+        timing_checkpoints.append(("Writing iceball model inputs", time.time()))
 
         print("Computation time log:")
         previous_start_time = start_time
@@ -1274,19 +1972,24 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
             print(f"  {timing_checkpoint[0]}: {timing_checkpoint[1] - previous_start_time:.2f} seconds")
             previous_start_time = timing_checkpoint[1]
 
-        
         auto3DSegCommand = [ pythonSlicerExecutablePath, str(inferenceScriptPyFile),
             "--model-file", str(modelPtFile),
-            "--image-file", str(finalinputFile),
-            "--result-file", str(outputSegmentationFile) ]
+            "--image-file", inputFiles[0],
+            "--layout-file", layoutFile,
+            "--result-file", str(outputSegmentationFile) ] + self.inferenceScriptOptions(tempDir, self.incrementalStateFile(inputNodes[0], "iceball"), preview)
         for inputIndex in range(1, len(inputFiles)):
             auto3DSegCommand.append(f"--image-file-{inputIndex+1}")
             auto3DSegCommand.append(inputFiles[inputIndex])
+        if self.skipWindowsOutsideProstate:
+            auto3DSegCommand.extend(["--roi-mask-file", roiMaskFile])
 
         self.log("Creating segmentations with MONAIAuto3DSeg AI...")
         self.log(f"Auto3DSeg command: {auto3DSegCommand}")
 
-        if self.debugSkipInference:
+        # The inference worker is only used if the method waits for the completion, as it runs one request at a time
+        useInferenceWorker = (waitForCompletion and not self.debugSkipInference and self.inferenceWorker is not None
+            and self.inferenceWorker.isRunning() and self.inferenceWorker.cpu == cpu)
+        if self.debugSkipInference or useInferenceWorker:
             proc = None
         else:
             proc = slicer.util.launchConsoleProcess(auto3DSegCommand, updateEnvironment=additionalEnvironmentVariables)
@@ -1305,24 +2008,112 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         segmentationProcessInfo["outputSegmentationFile"] = outputSegmentationFile
         
 
-        if proc:
-            # if waitForCompletion:
-                # # Wait for the process to end before returning
-                # self.logProcessOutputUntilCompleted(segmentationProcessInfo)
-            
-                
-                # self.onSegmentationProcessCompleted(segmentationProcessInfo)
-                # else:
-                #     # Run the process in the background
-            self.startSegmentationProcessMonitoring(segmentationProcessInfo)
+        if useInferenceWorker:
+            segmentationProcessInfo["procReturnCode"] = self.inferenceWorker.run(auto3DSegCommand[2:], self.log)
+            self.onSegmentationProcessCompleted(segmentationProcessInfo)
+        elif proc:
+            if waitForCompletion:
+                # Wait for the process to end before returning
+                self.logProcessOutputUntilCompleted(segmentationProcessInfo)
+                self.onSegmentationProcessCompleted(segmentationProcessInfo)
+            else:
+                # Run the process in the background
+                self.startSegmentationProcessMonitoring(segmentationProcessInfo)
         else:
             # Debugging
             self.onSegmentationProcessCompleted(segmentationProcessInfo)
 
         return segmentationProcessInfo
 
+    def processProgressive(self, inputNodes, outputSegmentation, model=None, cpu=False, waitForCompletion=True, customData=None, **kwargs):
+        """Run the processing in two passes: a quick, coarse preview is imported into outputSegmentation first,
+        then it is replaced by the full-quality prediction when that is completed.
+        Arguments are the same as for process(). The processing completed callback is only called once, for the full-quality pass
+        (or when the preview is cancelled). Latency of the preview and of the full-quality result are logged when the processing is completed.
+
+        If waitForCompletion is False then the iceball model of the preview runs in the background and the full-quality pass
+        is started when the preview is completed. The returned dict can be passed to cancelProcessing().
+        The anatomy (needle, urethra, prostate) is only segmented in the preview pass, at the same coarse resolution
+        as the preview iceball, and the full-quality pass reuses these labelmaps, so that only the iceball model runs again.
+        The anatomy labelmaps are resampled to the input volume geometry by the inference script, and the refinement steps
+        (prostate dilation, needle and urethra exclusion) run at full resolution in both passes. Reused coarse anatomy
+        is not stored in the anatomy cache. Same as in process(), the anatomy models run in the foreground:
+        the application does not respond to user input while they are computed.
+        """
+        import time
+        # Filled by the preview pass, reused by the full-quality pass
+        kwargs.setdefault("anatomyLabelmaps", {})
+        startTime = time.time()
+        completedCallback = self.processingCompletedCallback
+        progressiveProcessInfo = {"startTime": startTime, "previewTimeSec": None, "cancelRequested": False, "currentProcessInfo": None}
+
+        def onPreviewCompleted(returnCode, previewCustomData):
+            self.processingCompletedCallback = completedCallback
+            if returnCode == 0:
+                progressiveProcessInfo["previewTimeSec"] = time.time() - startTime
+                self.log(f"Iceball preview was completed in {progressiveProcessInfo['previewTimeSec']:.2f} seconds.")
+            elif returnCode != PredictIceballLogic.EXIT_CODE_USER_CANCELLED:
+                # The full-quality prediction may still succeed
+                self.log(f"Iceball preview failed (return code {returnCode}).")
+            if returnCode == PredictIceballLogic.EXIT_CODE_USER_CANCELLED or progressiveProcessInfo["cancelRequested"]:
+                if completedCallback:
+                    completedCallback(PredictIceballLogic.EXIT_CODE_USER_CANCELLED, customData)
+                return
+            # Show the preview while the full-quality prediction is computed
+            slicer.app.processEvents()
+            self.log("Computing full-quality iceball...")
+            try:
+                segmentationProcessInfo = self.process(inputNodes, outputSegmentation, model, cpu, waitForCompletion, customData, **kwargs)
+            except Exception as e:
+                if waitForCompletion:
+                    raise
+                # Processing continues from a timer, the exception would not reach the caller
+                self.log(f"Full-quality iceball failed: {e}")
+                if completedCallback:
+                    completedCallback(PredictIceballLogic.EXIT_CODE_DID_NOT_RUN, customData)
+                return
+            segmentationProcessInfo["previewTimeSec"] = progressiveProcessInfo["previewTimeSec"]
+            progressiveProcessInfo["currentProcessInfo"] = segmentationProcessInfo
+            if waitForCompletion:
+                # The result is already imported, so the latencies are reported here
+                fullTimeSec = segmentationProcessInfo["stopTime"] - startTime
+                if progressiveProcessInfo["previewTimeSec"] is not None:
+                    self.log(f"Latency of the preview: {progressiveProcessInfo['previewTimeSec']:.2f} seconds, "
+                        f"full-quality result: {fullTimeSec:.2f} seconds.")
+                else:
+                    self.log(f"Full-quality iceball was completed in {fullTimeSec:.2f} seconds.")
+            else:
+                # Latencies are reported when the processing is completed
+                segmentationProcessInfo["startTime"] = startTime
+
+        self.log("Computing iceball preview...")
+        # The preview is not reported as a completed processing, its completion starts the full-quality pass instead
+        self.processingCompletedCallback = onPreviewCompleted
+        try:
+            previewProcessInfo = self.process(inputNodes, outputSegmentation, model, cpu, waitForCompletion,
+                customData=customData, preview=True, **kwargs)
+            if progressiveProcessInfo["currentProcessInfo"] is None:
+                # Full-quality pass is not started yet
+                progressiveProcessInfo["currentProcessInfo"] = previewProcessInfo
+        except Exception as e:
+            if self.processingCompletedCallback is not onPreviewCompleted:
+                # Preview was completed, the exception is from the full-quality pass
+                raise
+            self.log(f"Iceball preview failed: {e}")
+            onPreviewCompleted(PredictIceballLogic.EXIT_CODE_DID_NOT_RUN, customData)
+
+        if waitForCompletion:
+            return progressiveProcessInfo["currentProcessInfo"]
+        return progressiveProcessInfo
+
     def cancelProcessing(self, segmentationProcessInfo):
         self.log("Cancel is requested.")
+        if "currentProcessInfo" in segmentationProcessInfo:
+            # Progressive processing: cancel the current pass, the next pass is not started
+            segmentationProcessInfo["cancelRequested"] = True
+            segmentationProcessInfo = segmentationProcessInfo["currentProcessInfo"]
+            if segmentationProcessInfo is None:
+                return
         segmentationProcessInfo["cancelRequested"] = True
         proc = segmentationProcessInfo.get("proc")
         if proc:
@@ -1369,6 +2160,40 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         self.checkSegmentationProcessOutput(segmentationProcessInfo)
 
 
+    def startProcessMonitoring(self, processInfo, completedCallback, logCallback=None):
+        """Forward output of a process (processInfo["proc"]) to the log without blocking the application,
+        and call completedCallback(processInfo) when the process has exited (return code is in processInfo["procReturnCode"]).
+        :param logCallback: function that receives each output line (default: self.log).
+          Output is written to the log file as well, if a log file is open (see openLogFile).
+        """
+        import queue
+        import threading
+        processInfo["procReturnCode"] = PredictIceballLogic.EXIT_CODE_DID_NOT_RUN
+        processInfo["procOutputQueue"] = queue.Queue()
+        processInfo["procThread"] = threading.Thread(target=PredictIceballLogic._handleProcessOutputThreadProcess, args=[processInfo])
+        processInfo["procThread"].start()
+        self.checkProcessOutput(processInfo, completedCallback, logCallback if logCallback else self.log)
+
+    def checkProcessOutput(self, processInfo, completedCallback, logCallback):
+        import queue
+        # Return code is set after all output is queued, so it must be checked before the queue is emptied
+        completed = processInfo["procReturnCode"] != PredictIceballLogic.EXIT_CODE_DID_NOT_RUN
+        outputQueue = processInfo["procOutputQueue"]
+        while True:
+            try:
+                line = outputQueue.get_nowait()
+            except queue.Empty:
+                break
+            if self.logFile and logCallback != self.log:
+                # Output that is not displayed (for example, of the warmup process) is still needed in the full log
+                self.logFile.write(f"{line}\n")
+            logCallback(line)
+        if completed:
+            completedCallback(processInfo)
+            return
+        import qt
+        qt.QTimer.singleShot(self.processOutputCheckTimerIntervalMsec, lambda: self.checkProcessOutput(processInfo, completedCallback, logCallback))
+
     def checkSegmentationProcessOutput(self, segmentationProcessInfo):
 
         import queue
@@ -1406,49 +2231,43 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         else:
             if procReturnCode == 0:
 
+                self.registerModelVariants(model)
+
                 if self.startResultImportCallback:
                     self.startResultImportCallback(customData)
 
                 try:
-                    script_dir = os.path.dirname(os.path.abspath(__file__))
-                    urethraprocessed = os.path.join(script_dir, "urethra-processed-segmentation.nii.gz")
-                    refinedSegmentationFile = os.path.join(script_dir, "refined-segmentation.nii.gz")  
-                    iceball_img = sitk.ReadImage(str(outputSegmentationFile))
-                    sitk.WriteImage(iceball_img, str(outputSegmentationFile)[:-4]+"nii.gz")
-                    iceball_image = nib.load(str(outputSegmentationFile)[:-4]+"nii.gz")
-                    urethra_segmentation = nib.load(str(urethraprocessed))
-                    # Ensure both images have the same shape
-                    self.log(iceball_image.shape)
-                    self.log(urethra_segmentation.shape)
-                    assert iceball_image.shape == urethra_segmentation.shape, "Iceball prediction and urethra segmentation must have the same dimensions"    
-                    # Convert to arrays
-                    input_array = iceball_image.get_fdata()
-                    urethra_array = urethra_segmentation.get_fdata()
+                    from PredictIceballLib import CroppedLabelmap
+
                     # Iceball should exclude urethra
-                    modified_data = np.logical_and(input_array == 1, np.logical_not(np.logical_and(input_array == 1, urethra_array == 1)))
-                    # Create a new Nifti1Image object for the combined data
-                    new_image = nib.Nifti1Image(modified_data, iceball_image.affine, iceball_image.header)
-                    # Save the processed image as a new nifti file
-                    nib.save(new_image, str(refinedSegmentationFile))
-                    segmentationProcessInfo["outputSegmentationFile"] = refinedSegmentationFile
-                    outputSegmentationFile = segmentationProcessInfo["outputSegmentationFile"]
-                    # Load result
-                    self.log("Importing segmentation results...")
-                    self.readSegmentation(outputSegmentation, outputSegmentationFile, model)
-
-                    # Set source volume - required for DICOM Segmentation export
-                    inputVolume = inputNodes[0]
-                    if not inputVolume.IsA('vtkMRMLScalarVolumeNode'):
-                        raise ValueError("First input node must be a scalar volume")
-                    outputSegmentation.SetNodeReferenceID(outputSegmentation.GetReferenceImageGeometryReferenceRole(), inputVolume.GetID())
-                    outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
-
-                    # Place segmentation node in the same place as the input volume
-                    shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-                    inputVolumeShItem = shNode.GetItemByDataNode(inputVolume)
-                    studyShItem = shNode.GetItemParent(inputVolumeShItem)
-                    segmentationShItem = shNode.GetItemByDataNode(outputSegmentation)
-                    shNode.SetItemParent(segmentationShItem, studyShItem)
+                    refined = self.refineIceball(CroppedLabelmap.read(outputSegmentationFile), segmentationProcessInfo["urethraMask"])
+
+                    if self.resultFilePath:
+                        self.log(f"Writing result to {self.resultFilePath}")
+                        refined.write(self.resultFilePath, compress=True)
+
+                    if outputSegmentation is None:
+                        # Processing without scene nodes (see processSeries)
+                        segmentationProcessInfo["resultLabelmap"] = refined
+                    else:
+                        inputVolume = inputNodes[0]
+                        if isinstance(inputVolume, str) or not inputVolume.IsA('vtkMRMLScalarVolumeNode'):
+                            raise ValueError("First input node must be a scalar volume")
+
+                        # Load result
+                        self.log("Importing segmentation results...")
+                        self.importSegmentationFromLabelmap(outputSegmentation, refined, inputVolume, model)
+
+                        # Set source volume - required for DICOM Segmentation export
+                        outputSegmentation.SetNodeReferenceID(outputSegmentation.GetReferenceImageGeometryReferenceRole(), inputVolume.GetID())
+                        outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+
+                        # Place segmentation node in the same place as the input volume
+                        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+                        inputVolumeShItem = shNode.GetItemByDataNode(inputVolume)
+                        studyShItem = shNode.GetItemParent(inputVolumeShItem)
+                        segmentationShItem = shNode.GetItemByDataNode(outputSegmentation)
+                        shNode.SetItemParent(segmentationShItem, studyShItem)
 
                 finally:
 
@@ -1460,6 +2279,8 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
 
         if self.clearOutputFolder:
             self.log("Cleaning up temporary folder.")
+            # Log file is in the temporary folder, it must be closed before the folder can be removed
+            self.closeLogFile()
             if os.path.isdir(tempDir):
                 import shutil
                 shutil.rmtree(tempDir)
@@ -1476,43 +2297,106 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         else:
             if procReturnCode == 0:
                 self.log(f"Processing was completed in {elapsedTime:.2f} seconds.")
+                if segmentationProcessInfo.get("previewTimeSec") is not None:
+                    self.log(f"Latency of the preview: {segmentationProcessInfo['previewTimeSec']:.2f} seconds, "
+                        f"full-quality result: {elapsedTime:.2f} seconds.")
             else:
                 self.log(f"Processing failed after {elapsedTime:.2f} seconds.")
+        self.closeLogFile()
 
         if self.processingCompletedCallback:
             self.processingCompletedCallback(procReturnCode, customData)
 
 
-    def readSegmentation(self, outputSegmentation, outputSegmentationFile, model):
+    def importSegmentationFromLabelmap(self, outputSegmentation, labelmap, referenceVolumeNode, model):
+        """Replace content of outputSegmentation by segments created from a labelmap (CroppedLabelmap).
+        The labelmap must have the same geometry as referenceVolumeNode.
+        """
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
 
         labelValueToDescription = self.labelDescriptions(model)
-        # Get label descriptions
-        maxLabelValue = max(labelValueToDescription.keys())
         if min(labelValueToDescription.keys()) < 0:
             raise RuntimeError("Label values in class_map must be positive")
-        # create a new colorTableNode and set it's type
-        colorTableNode = slicer.vtkMRMLColorTableNode()
-        colorTableNode.SetTypeToWarm1()
-        slicer.mrmlScene.AddNode(colorTableNode)
-
-        # Load the segmentation
-        outputSegmentation.SetLabelmapConversionColorTableNodeID(colorTableNode.GetID())
-        outputSegmentation.AddDefaultStorageNode()
-        storageNode = outputSegmentation.GetStorageNode()
-        storageNode.SetFileName(outputSegmentationFile)
-        storageNode.ReadData(outputSegmentation)
-
-        slicer.mrmlScene.RemoveNode(colorTableNode)
-
-        # Set terminology and color
-        for labelValue in labelValueToDescription:
-            segmentName = labelValueToDescription[labelValue]["name"]
-            terminologyEntryStr = labelValueToDescription[labelValue]["terminology"]
-            segmentId = segmentName
-            # set the name of the segmentation
-            segment = outputSegmentation.GetSegmentation().GetNthSegment(0)
-            segment.SetName(segmentName)
-            self.setTerminology(outputSegmentation, segmentName, segmentId, terminologyEntryStr)
+
+        outputSegmentation.CreateDefaultDisplayNodes()
+        outputSegmentation.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
+        segmentation = outputSegmentation.GetSegmentation()
+        wasModified = outputSegmentation.StartModify()
+        try:
+            segmentation.RemoveAllSegments()
+            for labelValue, labelDescription in labelValueToDescription.items():
+                segmentName = labelDescription["name"]
+                segmentId = segmentName
+                segmentation.AddEmptySegment(segmentId, segmentName)
+                segmentLabelmap = CroppedLabelmap((labelmap.array == labelValue).astype(np.uint8), labelmap.offset, labelmap.shape).cropped()
+                self.updateSegmentFromLabelmap(outputSegmentation, segmentId, segmentLabelmap, referenceVolumeNode)
+                self.setTerminology(outputSegmentation, segmentName, segmentId, labelDescription["terminology"])
+        finally:
+            outputSegmentation.EndModify(wasModified)
+
+    def writeSegmentationFile(self, labelmap, filePath, model):
+        """Write a labelmap (CroppedLabelmap) to a segmentation file (.seg.nrrd) with the segments of the model,
+        without creating nodes in the scene. Same as Slicer does for cropped segmentations, only the box is written
+        and its offset is stored in the Segmentation_ReferenceImageExtentOffset field.
+        """
+        import nrrd
+        import numpy as np
+        header = dict(labelmap.header)
+        header["space origin"] = np.asarray(header["space origin"], dtype=float) + labelmap.offset @ np.asarray(header["space directions"], dtype=float)
+        header["encoding"] = "gzip"
+        header["Segmentation_MasterRepresentation"] = "Binary labelmap"
+        header["Segmentation_ContainedRepresentationNames"] = "Binary labelmap|"
+        header["Segmentation_ReferenceImageExtentOffset"] = " ".join(str(int(index)) for index in labelmap.offset)
+        extent = " ".join(f"0 {size - 1}" for size in labelmap.array.shape)
+        for segmentIndex, (labelValue, labelDescription) in enumerate(self.labelDescriptions(model).items()):
+            segmentName = labelDescription["name"]
+            color = (0.5, 0.5, 0.5)
+            tags = ""
+            if labelDescription["terminology"]:
+                tags = f"TerminologyEntry:{labelDescription['terminology']}|"
+                try:
+                    label, color = self.getSegmentLabelColor(labelDescription["terminology"])
+                    if self.useStandardSegmentNames:
+                        segmentName = label
+                except RuntimeError as e:
+                    self.log(str(e))
+            prefix = f"Segment{segmentIndex}_"
+            header[prefix + "ID"] = labelDescription["name"]
+            header[prefix + "Name"] = segmentName
+            header[prefix + "Color"] = " ".join(str(component) for component in color)
+            header[prefix + "LabelValue"] = str(labelValue)
+            header[prefix + "Layer"] = "0"
+            header[prefix + "Extent"] = extent
+            header[prefix + "Tags"] = tags
+        nrrd.write(str(filePath), np.ascontiguousarray(labelmap.array), header)
+
+    def updateSegmentFromLabelmap(self, segmentationNode, segmentId, labelmap, referenceVolumeNode):
+        """Set content of a segment from a labelmap (CroppedLabelmap) that has the same geometry as referenceVolumeNode.
+        The labelmap is imported at its offset (the image data has the extent of the box in the voxel grid of the volume),
+        so an array of the full volume size is not created.
+        """
+        import numpy as np
+        import vtk.util.numpy_support
+        start = labelmap.offset
+        stop = labelmap.offset + np.array(labelmap.array.shape) - 1
+        labelmapImage = slicer.vtkOrientedImageData()
+        labelmapImage.SetExtent(int(start[0]), int(stop[0]), int(start[1]), int(stop[1]), int(start[2]), int(stop[2]))
+        labelmapImage.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        # VTK image data uses KJI voxel order
+        scalars = vtk.util.numpy_support.vtk_to_numpy(labelmapImage.GetPointData().GetScalars())
+        scalars[:] = np.transpose(labelmap.array > 0, (2, 1, 0)).ravel()
+        # Segments are stored in the coordinate system of the segmentation node
+        ijkToRas = vtk.vtkMatrix4x4()
+        referenceVolumeNode.GetIJKToRASMatrix(ijkToRas)
+        volumeToSegmentation = vtk.vtkMatrix4x4()
+        slicer.vtkMRMLTransformNode.GetMatrixTransformBetweenNodes(referenceVolumeNode.GetParentTransformNode(),
+            segmentationNode.GetParentTransformNode(), volumeToSegmentation)
+        imageToSegmentation = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(volumeToSegmentation, ijkToRas, imageToSegmentation)
+        labelmapImage.SetImageToWorldMatrix(imageToSegmentation)
+        slicer.vtkSlicerSegmentationsModuleLogic.SetBinaryLabelmapToSegment(labelmapImage, segmentationNode, segmentId,
+            slicer.vtkSlicerSegmentationsModuleLogic.MODE_REPLACE)
 
     def setTerminology(self, segmentation, segmentName, segmentId, terminologyEntryStr):
         segment = segmentation.GetSegmentation().GetSegment(segmentId)
@@ -1553,6 +2437,33 @@ class PredictIceballLogic(ScriptedLoadableModuleLogic):
         with open(modelsDescriptionJsonFilePath, 'w', newline="\n") as f:
             json.dump(modelsDescription, f, indent=2)
 
+    def updateModelsDescriptionChecksums(self):
+        """Add SHA-256 hash of the model package to each model version in the models description file that does not have it yet.
+        Model packages are downloaded to a temporary folder. Run this after a new model version is published,
+        so that the downloaded packages are verified (see ModelDownloader).
+        """
+        import json
+        import pathlib
+        from PredictIceballLib import ModelDownloader
+
+        modelsDescriptionJsonFilePath = self.modelsDescriptionJsonFilePath()
+        with open(modelsDescriptionJsonFilePath) as f:
+            modelsDescription = json.load(f)
+
+        downloader = ModelDownloader(slicer.util.tempDirectory(), logCallback=self.log)
+        for model in modelsDescription["models"]:
+            for version in model["versions"]:
+                if version.get("sha256"):
+                    continue
+                packageFilePath = pathlib.Path(downloader.modelsPath).joinpath(version["url"].split("/")[-1])
+                downloader.downloadFile(version["url"], packageFilePath)
+                version["sha256"] = ModelDownloader.fileSha256(packageFilePath)
+                self.log(f"SHA-256 of {version['url']}: {version['sha256']}")
+                os.remove(packageFilePath)
+
+        with open(modelsDescriptionJsonFilePath, 'w', newline="\n") as f:
+            json.dump(modelsDescription, f, indent=2)
+
 #
 # PredictIceballTest
 #
@@ -1569,9 +2480,70 @@ class PredictIceballTest(ScriptedLoadableModuleTest):
         """
         slicer.mrmlScene.Clear()
 
-    def runTest(self):
+    # Tests that run inference scripts with test models take several minutes on CPU, therefore they are disabled by default
+    # to not overload automatic build machines. Set runModelTests to True (or call runTest(runModelTests=True)) to enable them.
+    runModelTests = False
+
+    def runTest(self, runModelTests=None):
         """Run as few or as many tests as needed here.
         """
+        if runModelTests is None:
+            runModelTests = self.runModelTests
+        self.setUp()
+        self.test_PredictIceballImportTime()
+        self.setUp()
+        self.test_PredictIceballLogSink()
+        self.setUp()
+        self.test_PredictIceballModelDownload()
+        self.setUp()
+        self.test_PredictIceballModelRegistry()
+        self.setUp()
+        self.test_PredictIceballDependencyChecker()
+        self.setUp()
+        self.test_PredictIceballTerminologyIndex()
+        self.setUp()
+        self.test_PredictIceballLabelDescriptions()
+        self.setUp()
+        self.test_PredictIceballFolderWatcher()
+        self.setUp()
+        self.test_PredictIceballWatchFolder()
+        self.setUp()
+        self.test_PredictIceballIncrementalPrediction()
+        self.setUp()
+        self.test_PredictIceballWeightsCache()
+        self.setUp()
+        self.test_PredictIceballAnatomyCache()
+        self.setUp()
+        self.test_PredictIceballProbeRasterizer()
+        self.setUp()
+        self.test_PredictIceballSegmentMask()
+        self.setUp()
+        self.test_PredictIceballCroppedLabelmap()
+        self.setUp()
+        self.test_PredictIceballParallelSlidingWindow()
+        self.setUp()
+        self.test_PredictIceballMemoryPlanner()
+        self.setUp()
+        self.test_PredictIceballInferenceTuning()
+        self.setUp()
+        self.test_PredictIceballProgressivePrediction()
+        if runModelTests:
+            self.setUp()
+            self.test_PredictIceballDicomSeries()
+            self.setUp()
+            self.test_PredictIceballWindowSkipping()
+            self.setUp()
+            self.test_PredictIceballPreprocessingCache()
+            self.setUp()
+            self.test_PredictIceballLayoutInference()
+            self.setUp()
+            self.test_PredictIceballProgressivePredictionModels()
+            self.setUp()
+            self.test_PredictIceballBlockingProcess()
+            self.setUp()
+            self.test_PredictIceballSeriesProcessing()
+            self.setUp()
+            self.test_PredictIceballInferenceWorker()
         self.setUp()
         self.test_PredictIceball1()
 
@@ -1710,6 +2682,1800 @@ class PredictIceballTest(ScriptedLoadableModuleTest):
 
         self.delayDisplay("Test passed")
 
+    def test_PredictIceballImportTime(self):
+        """Check that importing the module (which happens at every application startup)
+        only imports the module's own files and standard Python modules, and not heavy packages.
+        Modules imported by the module are listed in a separate process. The import time is only logged,
+        as it varies too much between computers and runs to be checked reliably.
+        """
+
+        self.delayDisplay("Starting import time test")
+
+        import json
+        import shutil
+        import subprocess
+        import sys
+        moduleDir = os.path.dirname(slicer.modules.predicticeball.path)
+        # Application modules (slicer, qt, vtk) and common Python packages are already loaded when the module is imported at startup,
+        # therefore they are replaced by empty modules or imported before the measurement.
+        importCode = "\n".join([
+            "import sys, time, types",
+            f"sys.path.insert(0, {moduleDir!r})",
+            "import json, logging, vtk",
+            "slicer = types.ModuleType('slicer')",
+            "slicer.ScriptedLoadableModule = types.ModuleType('slicer.ScriptedLoadableModule')",
+            "slicer.util = types.ModuleType('slicer.util')",
+            "for name in ['ScriptedLoadableModule', 'ScriptedLoadableModuleWidget', 'ScriptedLoadableModuleLogic', 'ScriptedLoadableModuleTest']:",
+            "    setattr(slicer.ScriptedLoadableModule, name, type(name, (), {}))",
+            "slicer.util.VTKObservationMixin = type('VTKObservationMixin', (), {})",
+            "sys.modules.update({'slicer': slicer, 'slicer.ScriptedLoadableModule': slicer.ScriptedLoadableModule, 'slicer.util': slicer.util})",
+            "modulesBefore = set(sys.modules)",
+            "startTime = time.perf_counter()",
+            "import PredictIceball",
+            "importTimeSec = time.perf_counter() - startTime",
+            "print(json.dumps({'modules': sorted(set(sys.modules) - modulesBefore), 'importTimeSec': importTimeSec}))",
+            ])
+        result = subprocess.run([shutil.which("PythonSlicer"), "-c", importCode], capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        importResult = json.loads(result.stdout.strip().splitlines()[-1])
+        importedModules = importResult["modules"]
+
+        self.delayDisplay(f"Import time of PredictIceball module: {importResult['importTimeSec'] * 1000.0:.1f}ms")
+        logging.info(f"Modules imported by PredictIceball module: {', '.join(importedModules)}")
+
+        for heavyModuleName in ["numpy", "nrrd", "nibabel", "cv2", "SimpleITK", "fire", "einops", "torch", "monai", "requests"]:
+            self.assertNotIn(heavyModuleName, [moduleName.split(".")[0] for moduleName in importedModules],
+                f"{heavyModuleName} must not be imported at module startup")
+        # List of standard modules is only available in Python 3.10 and later
+        standardModuleNames = getattr(sys, "stdlib_module_names", None)
+        if standardModuleNames is not None:
+            for moduleName in importedModules:
+                topLevelModuleName = moduleName.split(".")[0]
+                if topLevelModuleName in ["PredictIceball", "PredictIceballLib"]:
+                    continue
+                self.assertIn(topLevelModuleName, standardModuleNames, f"{moduleName} must not be imported at module startup")
+
+        self.delayDisplay("Import time test passed")
+
+    def test_PredictIceballLogSink(self):
+        """Test that progress updates only replace the last displayed line, the displayed text remains bounded,
+        and output of processes is written to the log file."""
+
+        self.delayDisplay("Starting log sink test")
+
+        from PredictIceballLib import LogSink
+        widget = slicer.util.getModuleWidget("PredictIceball")
+        originalLogSink = widget._logSink
+        logSink = LogSink(maxLines=50)
+        widget._logSink = logSink
+        widget.ui.statusLabel.maximumBlockCount = logSink.maxLines
+
+        # Count the lines that the widget renders in each frame
+        renderedLineCounts = []
+        takeFrame = logSink.takeFrame
+        def takeFrameCounted():
+            frame = takeFrame()
+            if frame:
+                renderedLineCounts.append(len(frame[2]))
+            return frame
+        logSink.takeFrame = takeFrameCounted
+
+        def displayedLines():
+            text = widget.ui.statusLabel.plainText
+            return text.split("\n") if text else []
+
+        try:
+            widget.clearLog()
+            logSink.write("Processing started")
+            widget.renderLogFrame()
+            for step in range(1000):
+                progressLine = f"{step // 10:3d}%|{'#' * (step // 100):10s}| {step}/1000 [00:01<00:10, 98.50it/s]"
+                logSink.write("\r" + progressLine)
+                widget.renderLogFrame()
+            self.assertEqual(len(displayedLines()), 2)
+            logSink.write("Processing finished\n")
+            widget.renderLogFrame()
+            self.assertEqual(displayedLines(), ["Processing started", progressLine, "Processing finished"])
+            # Only the first frame renders the full text, progress updates render a single line
+            self.assertEqual(max(renderedLineCounts[1:]), 1)
+
+            for lineIndex in range(200):
+                logSink.write(f"Line {lineIndex}")
+            widget.renderLogFrame()
+            self.assertEqual(displayedLines(), list(logSink.lines))
+            self.assertEqual(len(displayedLines()), logSink.maxLines)
+        finally:
+            widget._logSink = originalLogSink
+            widget.ui.statusLabel.maximumBlockCount = originalLogSink.maxLines
+            widget.clearLog()
+
+        # Process output that is forwarded to another log callback is written to the log file as well
+        import queue
+        import tempfile
+        logic = PredictIceballLogic()
+        with tempfile.TemporaryDirectory() as tempDir:
+            logFilePath = os.path.join(tempDir, "PredictIceball.log")
+            logic.openLogFile(logFilePath)
+            processInfo = {"procOutputQueue": queue.Queue(), "procReturnCode": 0}
+            processInfo["procOutputQueue"].put("Process output")
+            completedProcesses = []
+            logic.checkProcessOutput(processInfo, completedProcesses.append, logging.debug)
+            logic.log("Logic message")
+            logic.closeLogFile()
+            self.assertEqual(completedProcesses, [processInfo])
+            with open(logFilePath, encoding="utf-8") as f:
+                self.assertEqual(f.read().splitlines(), ["Process output", "Logic message"])
+
+        self.delayDisplay("Log sink test passed")
+
+    def test_PredictIceballFolderWatcher(self):
+        """Test that new series are only reported as ready when their files have not changed for the settle time."""
+
+        self.delayDisplay("Starting folder watcher test")
+
+        import tempfile
+        from PredictIceballLib import FolderWatcher
+
+        with tempfile.TemporaryDirectory() as folderPath:
+            watcher = FolderWatcher(folderPath, settleTimeSec=5.0)
+
+            # Files that are still being written or are results are ignored
+            with open(os.path.join(folderPath, "scan1.nrrd.part"), "wb") as f:
+                f.write(b"1234")
+            with open(os.path.join(folderPath, "scan0-timing.json"), "w") as f:
+                f.write("{}")
+            self.assertEqual(watcher.poll(currentTime=0.0), ([], []))
+
+            # Series is new when it appears, ready only when it has not changed for the settle time
+            seriesPath = os.path.join(folderPath, "scan1.nrrd")
+            os.replace(seriesPath + ".part", seriesPath)
+            self.assertEqual(watcher.poll(currentTime=1.0), ([seriesPath], []))
+            self.assertEqual(watcher.poll(currentTime=3.0), ([], []))
+            self.assertEqual(watcher.pendingSeries(), [(seriesPath, FolderWatcher.signature(seriesPath), 1.0)])
+            with open(seriesPath, "ab") as f:
+                f.write(b"5678")
+            self.assertEqual(watcher.poll(currentTime=7.0), ([], []))
+            self.assertEqual(watcher.pendingSeries(), [(seriesPath, FolderWatcher.signature(seriesPath), 7.0)])
+            self.assertEqual(watcher.poll(currentTime=12.0), ([], [seriesPath]))
+
+            # Processed series is not reported again
+            watcher.markProcessed(seriesPath)
+            self.assertEqual(watcher.pendingSeries(), [])
+            self.assertEqual(watcher.poll(currentTime=20.0), ([], []))
+            self.assertEqual(FolderWatcher.resultPaths(seriesPath),
+                (os.path.join(folderPath, "scan1-iceball.seg.nrrd"), os.path.join(folderPath, "scan1-timing.json")))
+
+        self.delayDisplay("Folder watcher test passed")
+
+    def test_PredictIceballWatchFolder(self):
+        """Test that a series is predicted before its files have settled and this prediction is written when the series is ready,
+        and that the series is predicted again if its files change after the early prediction started.
+        Prediction is simulated, so that only the sequencing of predictions and results is tested.
+        """
+
+        self.delayDisplay("Starting watch folder test")
+
+        import json
+        import tempfile
+        from PredictIceballLib import FolderWatcher
+
+        logic = PredictIceballLogic()
+        logic.logCallback = self._mylog
+        logic.startInferenceWorker = lambda model=None, cpu=False: False
+        predictedSignatures = []
+        writtenResults = []
+
+        def simulatedPredictSeries(seriesPath, model=None, cpu=False):
+            signature = FolderWatcher.signature(seriesPath)
+            predictedSignatures.append(signature)
+            if appendAfterFirstPrediction and len(predictedSignatures) == 1:
+                # More files arrive after the prediction has started
+                with open(seriesPath, "ab") as f:
+                    f.write(b"5678")
+            return signature, 0.0
+
+        def simulatedWriteSegmentationFile(labelmap, filePath, model):
+            writtenResults.append(labelmap)
+            with open(filePath, "w") as f:
+                f.write("")
+
+        logic.predictSeries = simulatedPredictSeries
+        logic.writeSegmentationFile = simulatedWriteSegmentationFile
+
+        for appendAfterFirstPrediction in [False, True]:
+            predictedSignatures.clear()
+            writtenResults.clear()
+            with tempfile.TemporaryDirectory() as folderPath:
+                seriesPath = os.path.join(folderPath, "scan1.nrrd")
+                with open(seriesPath, "wb") as f:
+                    f.write(b"1234")
+                self.assertEqual(logic.watchFolder(folderPath, pollIntervalSec=0.05, settleTimeSec=0.5, maximumSeriesCount=1, timeoutSec=10.0), 1)
+                with open(FolderWatcher.resultPaths(seriesPath)[1]) as f:
+                    timing = json.load(f)
+                self.assertEqual(timing["status"], "completed")
+                # The result is the prediction of the final files, computed before the series was ready
+                self.assertEqual(writtenResults, [FolderWatcher.signature(seriesPath)])
+                self.assertTrue(timing["earlyPrediction"])
+                # Changed files are predicted again
+                self.assertEqual(len(predictedSignatures), 2 if appendAfterFirstPrediction else 1)
+
+        self.delayDisplay("Watch folder test passed")
+
+    def test_PredictIceballInferenceWorker(self):
+        """Test that the inference worker gives the same result as running the inference script in a new process,
+        keeps the model loaded between runs, and keeps running after a failed run.
+        """
+
+        self.delayDisplay("Starting inference worker test")
+
+        self._setupPythonRequirements()
+        import shutil
+        import nrrd
+        import numpy as np
+        from PredictIceballLib import InferenceWorker
+
+        testDir, imageFile, header, modelFile = self._createTestInputs(self._createTestVolumeArray((48, 40, 24)))
+        expectedLabels, _, _ = self._predict(modelFile, imageFile, os.path.join(testDir, "expected.nrrd"))
+
+        worker = InferenceWorker(lambda command, environment: slicer.util.launchConsoleProcess(command, updateEnvironment=environment))
+        worker.start([shutil.which("PythonSlicer"), os.path.join(os.path.dirname(slicer.modules.predicticeball.path), "Scripts", "inference_worker.py")])
+        try:
+            worker.loadModels([modelFile])
+            for runIndex in range(2):
+                output = []
+                resultFile = os.path.join(testDir, f"result{runIndex}.nrrd")
+                self.assertEqual(worker.run(["--model-file", modelFile, "--image-file", imageFile, "--result-file", resultFile], output.append), 0)
+                labels, _ = nrrd.read(resultFile)
+                np.testing.assert_array_equal(labels, expectedLabels)
+                # Model was loaded in advance
+                self.assertIn("Using model that is already loaded", output)
+
+            output = []
+            self.assertNotEqual(worker.run(["--model-file", os.path.join(testDir, "missing.pt"), "--image-file", imageFile,
+                "--result-file", os.path.join(testDir, "missing.nrrd")], output.append), 0)
+            self.assertTrue(any("Cannot find model file" in line for line in output))
+            self.assertTrue(worker.isRunning())
+        finally:
+            worker.stop()
+        self.assertFalse(worker.isRunning())
+
+        shutil.rmtree(testDir)
+        self.delayDisplay("Inference worker test passed")
+
+    def test_PredictIceballModelRegistry(self):
+        """Test registering and looking up models, rebuilding a missing manifest, and lookups in a read-only models folder."""
+
+        self.delayDisplay("Starting model registry test")
+
+        import tempfile
+        from PredictIceballLib import ModelRegistry
+
+        with tempfile.TemporaryDirectory() as modelsPath:
+            modelFolder = os.path.join(modelsPath, "test-model-v1.2.0", "test-model")
+            os.makedirs(modelFolder)
+            with open(os.path.join(modelFolder, "labels.csv"), "w") as f:
+                f.write("1,iceball\n")
+            with open(os.path.join(modelFolder, "model.pt"), "wb") as f:
+                f.write(b"weights")
+            os.makedirs(os.path.join(modelsPath, "incomplete-model-v1.0.0"))
+
+            # Register and look up
+            registry = ModelRegistry(modelsPath)
+            registry.register("test-model-v1.2.0", "1.2.0", os.path.join(modelsPath, "test-model-v1.2.0"))
+            self.assertTrue(registry.isInstalled("test-model-v1.2.0"))
+            self.assertFalse(registry.isInstalled("other-model"))
+            self.assertEqual(str(registry.modelPath("test-model-v1.2.0")), modelFolder)
+            entry = registry.entry("test-model-v1.2.0")
+            self.assertEqual(entry["version"], "1.2.0")
+            self.assertEqual(sorted(entry["files"].keys()), ["labels.csv", "model.pt"])
+            self.assertEqual(len(entry["files"]["model.pt"]["sha256"]), 64)
+            # Lookup in another instance uses the manifest
+            self.assertEqual(ModelRegistry(modelsPath).installedModelIds(), ["test-model-v1.2.0"])
+
+            # Missing manifest is rebuilt by scanning the models folder (incomplete models are ignored)
+            os.remove(registry.manifestFilePath())
+            registry = ModelRegistry(modelsPath)
+            self.assertEqual(registry.installedModelIds(), ["test-model-v1.2.0"])
+            self.assertEqual(registry.entry("test-model-v1.2.0")["version"], "1.2.0")
+            self.assertTrue(registry.manifestFilePath().exists())
+
+            # Read-only models folder: lookup works without writing the manifest
+            os.remove(registry.manifestFilePath())
+            registry = ModelRegistry(modelsPath)
+
+            def readOnlyManifest():
+                raise PermissionError("Models folder is read-only")
+
+            registry._lockedManifest = readOnlyManifest
+            self.assertTrue(registry.isInstalled("test-model-v1.2.0"))
+            self.assertEqual(str(registry.modelPath("test-model-v1.2.0")), modelFolder)
+            self.assertFalse(registry.manifestFilePath().exists())
+
+        self.delayDisplay("Model registry test passed")
+
+    def test_PredictIceballDependencyChecker(self):
+        """Test that installed packages are checked the same way as pip reports them,
+        and that a successful check is only reused for the same requirements.
+        """
+
+        self.delayDisplay("Starting dependency checker test")
+
+        import json
+        import shutil
+        import subprocess
+        import tempfile
+        from packaging.requirements import Requirement
+        from PredictIceballLib import DependencyChecker
+
+        pipList = subprocess.check_output([shutil.which("PythonSlicer"), "-m", "pip", "list", "--format", "json"]).decode()
+        installedVersions = {package["name"].lower().replace("_", "-"): package["version"] for package in json.loads(pipList)}
+        pipVersion = installedVersions["pip"]
+        requirements = ["pip", f"pip>={pipVersion}", f"pip<{pipVersion}", f"PIP=={pipVersion}", "packaging",
+            "not-installed-package-for-predicticeball-test", "not-installed-package-for-predicticeball-test>=1.0"]
+
+        def missingAccordingToPip(requirementStr):
+            requirement = Requirement(requirementStr)
+            installedVersion = installedVersions.get(requirement.name.lower().replace("_", "-"))
+            return installedVersion is None or not requirement.specifier.contains(installedVersion, prereleases=True)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheFilePath = os.path.join(tempDir, "cache", "dependencies.json")
+            checker = DependencyChecker(requirements, cacheFilePath)
+            expectedMissing = [requirement for requirement in requirements if missingAccordingToPip(requirement)]
+            self.assertEqual(checker.missingRequirements(), expectedMissing)
+            self.assertEqual(expectedMissing, [f"pip<{pipVersion}", "not-installed-package-for-predicticeball-test",
+                "not-installed-package-for-predicticeball-test>=1.0"])
+            self.assertFalse(checker.isReady())
+            self.assertFalse(os.path.exists(cacheFilePath))
+
+            # Successful check is stored and reused while the environment and the requirements are the same
+            installedRequirements = [requirement for requirement in requirements if requirement not in expectedMissing]
+            checker = DependencyChecker(installedRequirements, cacheFilePath)
+            self.assertTrue(checker.isReady())
+            self.assertTrue(os.path.exists(cacheFilePath))
+            checker.missingRequirements = lambda: self.fail("Requirements must not be checked again if the check result is cached")
+            self.assertTrue(checker.isReady())
+
+            # Cached result is not used for different requirements
+            checker = DependencyChecker(installedRequirements + ["not-installed-package-for-predicticeball-test"], cacheFilePath)
+            self.assertNotEqual(checker.environmentFingerprint(), DependencyChecker(installedRequirements, cacheFilePath).environmentFingerprint())
+            self.assertFalse(checker.isReady())
+
+        self.delayDisplay("Dependency checker test passed")
+
+    def test_PredictIceballTerminologyIndex(self):
+        """Test that the terminology index finds the same labels and colors as the terminology files contain,
+        and that the index is read from the cache file until the terminology files change.
+        """
+
+        self.delayDisplay("Starting terminology index test")
+
+        import json
+        import shutil
+        import tempfile
+        from PredictIceballLib import TerminologyIndex
+
+        resourcesPath = os.path.join(os.path.dirname(slicer.modules.predicticeball.path), "Resources")
+        with tempfile.TemporaryDirectory() as tempDir:
+            terminologyFilePath = os.path.join(tempDir, "SegmentationCategoryTypeModifier-PredictIceball.term.json")
+            anatomicContextFilePath = os.path.join(tempDir, "AnatomicRegionAndModifier-PredictIceball.term.json")
+            shutil.copy(os.path.join(resourcesPath, os.path.basename(terminologyFilePath)), terminologyFilePath)
+            shutil.copy(os.path.join(resourcesPath, os.path.basename(anatomicContextFilePath)), anatomicContextFilePath)
+            cacheFilePath = os.path.join(tempDir, "cache", "terminology-index.json")
+            index = TerminologyIndex.load([terminologyFilePath], [anatomicContextFilePath], cacheFilePath)
+            self.assertTrue(os.path.exists(cacheFilePath))
+
+            with open(terminologyFilePath, encoding="utf-8") as f:
+                terminology = json.load(f)
+            with open(anatomicContextFilePath, encoding="utf-8") as f:
+                anatomicContext = json.load(f)
+            self.assertEqual(index.terminologyContextNames, [terminology["SegmentationCategoryTypeContextName"]])
+            self.assertEqual(index.anatomicContextNames, [anatomicContext["AnatomicContextName"]])
+
+            def expectedLabelColor(item):
+                rgb = item.get("recommendedDisplayRGBValue", TerminologyIndex.DEFAULT_COLOR)
+                return item.get("3dSlicerLabel") or item["CodeMeaning"], (rgb[0]/255.0, rgb[1]/255.0, rgb[2]/255.0)
+
+            def checkIndex(index):
+                numberOfModifiers = 0
+                for category in terminology["SegmentationCodes"]["Category"]:
+                    for typeItem in category["Type"]:
+                        typeCode = (typeItem["CodingSchemeDesignator"], typeItem["CodeValue"])
+                        self.assertTrue(index.hasType(*typeCode))
+                        self.assertTrue(index.hasType(*typeCode, category["CodingSchemeDesignator"], category["CodeValue"]))
+                        self.assertEqual(index.labelColor(*typeCode), expectedLabelColor(typeItem))
+                        for modifierItem in typeItem.get("Modifier", []):
+                            self.assertEqual(index.labelColor(*typeCode, modifierItem["CodingSchemeDesignator"], modifierItem["CodeValue"]),
+                                expectedLabelColor(modifierItem))
+                            numberOfModifiers += 1
+                self.assertGreater(numberOfModifiers, 0)
+                for regionItem in anatomicContext["AnatomicCodes"]["AnatomicRegion"]:
+                    self.assertTrue(index.hasRegion(regionItem["CodingSchemeDesignator"], regionItem["CodeValue"]))
+                # Codes that are not in the terminology
+                self.assertFalse(index.hasType("SCT", "0"))
+                self.assertFalse(index.hasType(typeCode[0], typeCode[1], "SCT", "0"))
+                self.assertIsNone(index.labelColor("SCT", "0"))
+                self.assertIsNone(index.labelColor(typeCode[0], typeCode[1], "SCT", "0"))
+                self.assertFalse(index.hasRegion("SCT", "0"))
+
+            checkIndex(index)
+
+            # Index is read from the cache, without parsing the terminology files
+            addTerminologyFile = TerminologyIndex.addTerminologyFile
+            TerminologyIndex.addTerminologyFile = lambda index, filePath: self.fail("Terminology must be read from the cache")
+            try:
+                checkIndex(TerminologyIndex.load([terminologyFilePath], [anatomicContextFilePath], cacheFilePath))
+            finally:
+                TerminologyIndex.addTerminologyFile = addTerminologyFile
+
+            # Index is rebuilt if a terminology file changes
+            typeItem = terminology["SegmentationCodes"]["Category"][0]["Type"][0]
+            typeItem["3dSlicerLabel"] = "changed label"
+            typeItem["recommendedDisplayRGBValue"] = [1, 2, 3]
+            with open(terminologyFilePath, "w", encoding="utf-8") as f:
+                json.dump(terminology, f)
+            index = TerminologyIndex.load([terminologyFilePath], [anatomicContextFilePath], cacheFilePath)
+            self.assertEqual(index.labelColor(typeItem["CodingSchemeDesignator"], typeItem["CodeValue"]),
+                ("changed label", (1/255.0, 2/255.0, 3/255.0)))
+            checkIndex(index)
+
+            # Invalid cache file is ignored
+            with open(cacheFilePath, "w", encoding="utf-8") as f:
+                f.write("invalid")
+            checkIndex(TerminologyIndex.load([terminologyFilePath], [anatomicContextFilePath], cacheFilePath))
+
+        self.delayDisplay("Terminology index test passed")
+
+    def test_PredictIceballLabelDescriptions(self):
+        """Test that label descriptions are parsed once per model and parsed again when the model or its labels file changes."""
+
+        self.delayDisplay("Starting label descriptions test")
+
+        import pathlib
+        from PredictIceballLib import ModelRegistry
+
+        modelsPath = pathlib.Path(slicer.util.tempDirectory())
+        modelId = "test-labels-v1.0.0"
+        modelDir = modelsPath.joinpath(modelId)
+        modelDir.mkdir()
+        codeSequences = ["SegmentedPropertyCategoryCodeSequence", "SegmentedPropertyTypeCodeSequence",
+            "SegmentedPropertyTypeModifierCodeSequence", "AnatomicRegionSequence", "AnatomicRegionModifierSequence"]
+        labelsHeader = ",".join(["LabelValue", "Name"] + [f"{codeSequence}.{fieldName}" for codeSequence in codeSequences
+            for fieldName in ["CodingSchemeDesignator", "CodeValue", "CodeMeaning"]]) + "\n"
+        with open(modelDir.joinpath("labels.csv"), "w") as f:
+            f.write(labelsHeader)
+            f.write("1,iceball,SCT,49755003,Morphologically Altered Structure,SCT,367643001,Cyst,,,,SCT,41216001,Prostate,,,\n")
+            f.write("2,prostate,SCT,123037004,Anatomical Structure,SCT,41216001,Prostate,,,,,,,,,\n")
+        logic = PredictIceballLogic()
+        logic.modelRegistry = ModelRegistry(modelsPath)
+        logic.modelRegistry.register(modelId, "1.0.0", modelDir)
+        PredictIceballLogic._labelDescriptionsCache.pop(modelId, None)
+
+        labelDescriptions = logic.labelDescriptions(modelId)
+        self.assertEqual({labelValue: labelDescription["name"] for labelValue, labelDescription in labelDescriptions.items()},
+            {1: "iceball", 2: "prostate"})
+        terminologyFields = labelDescriptions[1]["terminology"].split("~")
+        self.assertEqual(len(terminologyFields), 7)
+        self.assertEqual(terminologyFields[1:4], ["SCT^49755003^Morphologically Altered Structure", "SCT^367643001^Cyst", "^^"])
+        self.assertEqual(terminologyFields[5], "SCT^41216001^Prostate")
+
+        # Descriptions are parsed only once, also for other logic instances
+        readLabelDescriptions = PredictIceballLogic._readLabelDescriptions
+        PredictIceballLogic._readLabelDescriptions = lambda logic, labelsFilePath: self.fail("Label descriptions must be cached")
+        try:
+            self.assertEqual(logic.labelDescriptions(modelId), labelDescriptions)
+            otherLogic = PredictIceballLogic()
+            otherLogic.modelRegistry = logic.modelRegistry
+            self.assertEqual(otherLogic.labelDescriptions(modelId), labelDescriptions)
+            # Changing the returned descriptions does not change the cache
+            logic.labelDescriptions(modelId)[1]["name"] = "changed"
+            self.assertEqual(logic.labelDescriptions(modelId), labelDescriptions)
+        finally:
+            PredictIceballLogic._readLabelDescriptions = readLabelDescriptions
+
+        # Descriptions are parsed again if the labels file is changed
+        with open(modelDir.joinpath("labels.csv"), "w") as f:
+            f.write(labelsHeader)
+            f.write("1,ablation zone,SCT,49755003,Morphologically Altered Structure,SCT,367643001,Cyst,,,,SCT,41216001,Prostate,,,\n")
+        self.assertEqual([labelDescription["name"] for labelDescription in logic.labelDescriptions(modelId).values()], ["ablation zone"])
+
+        # Descriptions are parsed again if a new version of the model is installed, even if the labels file looks the same
+        readFilePaths = []
+        def readLabelDescriptionsLogged(logic, labelsFilePath):
+            readFilePaths.append(labelsFilePath)
+            return readLabelDescriptions(logic, labelsFilePath)
+        PredictIceballLogic._readLabelDescriptions = readLabelDescriptionsLogged
+        try:
+            logic.labelDescriptions(modelId)
+            self.assertEqual(readFilePaths, [])
+            logic.modelRegistry.register(modelId, "1.0.1", modelDir)
+            logic.labelDescriptions(modelId)
+            self.assertEqual(readFilePaths, [modelDir.joinpath("labels.csv")])
+        finally:
+            PredictIceballLogic._readLabelDescriptions = readLabelDescriptions
+            PredictIceballLogic._labelDescriptionsCache.pop(modelId, None)
+
+        self.delayDisplay("Label descriptions test passed")
+
+    def test_PredictIceballModelDownload(self):
+        """Test resumable, verified model download and install using a local HTTP server."""
+
+        self.delayDisplay("Starting model download test")
+
+        import hashlib
+        import http.server
+        import io
+        import pathlib
+        import threading
+        import zipfile
+        from PredictIceballLib import ModelDownloader
+
+        # Create model package
+        zipBuffer = io.BytesIO()
+        with zipfile.ZipFile(zipBuffer, "w") as zipFile:
+            zipFile.writestr("model/labels.csv", "LabelValue,Name\n1,Iceball\n")
+            zipFile.writestr("model/model.pt", os.urandom(300000))
+        packageData = zipBuffer.getvalue()
+        packageSha256 = hashlib.sha256(packageData).hexdigest()
+
+        class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+            # Number of bytes to send before simulating a broken connection (None = send all)
+            truncateAt = None
+            def do_GET(self):
+                start = 0
+                rangeHeader = self.headers.get("Range")
+                if rangeHeader:
+                    start = int(rangeHeader.split("=")[1].split("-")[0])
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{len(packageData)-1}/{len(packageData)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(packageData) - start))
+                self.end_headers()
+                end = RangeRequestHandler.truncateAt if RangeRequestHandler.truncateAt else len(packageData)
+                self.wfile.write(packageData[start:end])
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+        serverThread = threading.Thread(target=server.serve_forever, daemon=True)
+        serverThread.start()
+        url = f"http://127.0.0.1:{server.server_port}/test-model-v1.0.0.zip"
+
+        modelsPath = pathlib.Path(slicer.util.tempDirectory())
+        downloader = ModelDownloader(modelsPath, logCallback=self._mylog)
+        downloader.chunkSize = 16 * 1024
+        try:
+            # Interrupted download must not create the model folder
+            RangeRequestHandler.truncateAt = len(packageData) // 2
+            with self.assertRaises(Exception):
+                downloader.install("test-model-v1.0.0", url, packageSha256)
+            self.assertFalse(modelsPath.joinpath("test-model-v1.0.0").exists())
+            self.assertTrue(downloader.partialDownloadFilePath("test-model-v1.0.0").exists())
+
+            # Resumed download completes the model
+            RangeRequestHandler.truncateAt = None
+            modelDir = downloader.install("test-model-v1.0.0", url, packageSha256)
+            self.assertTrue(modelDir.joinpath("model", "labels.csv").exists())
+            self.assertFalse(downloader.partialDownloadFilePath("test-model-v1.0.0").exists())
+
+            # Checksum mismatch is detected and nothing is installed
+            with self.assertRaises(RuntimeError):
+                downloader.install("test-model-v2.0.0", url, "0" * 64)
+            self.assertFalse(modelsPath.joinpath("test-model-v2.0.0").exists())
+
+            # Reinstalling replaces the model folder, files of the previous installation are removed
+            modelDir.joinpath("outdated.txt").write_text("previous installation")
+            modelDir = downloader.install("test-model-v1.0.0", url, packageSha256)
+            self.assertTrue(modelDir.joinpath("model", "labels.csv").exists())
+            self.assertFalse(modelDir.joinpath("outdated.txt").exists())
+            self.assertFalse(downloader.replacedFolderPath("test-model-v1.0.0").exists())
+
+            # If the new folder cannot be moved into place then the previous model is restored
+            stagingDir = modelsPath.joinpath("staging")
+            replacedDir = modelsPath.joinpath("replaced")
+            with self.assertRaises(OSError):
+                ModelDownloader.replaceFolder(stagingDir, modelDir, replacedDir)
+            self.assertTrue(modelDir.joinpath("model", "labels.csv").exists())
+            self.assertFalse(replacedDir.exists())
+        finally:
+            server.shutdown()
+            import shutil
+            shutil.rmtree(modelsPath)
+
+        self.delayDisplay("Model download test passed")
+
+    def test_PredictIceballDicomSeries(self):
+        """Test that a DICOM series directory gives the same geometry and labels as the same volume in a NRRD file.
+        The series is oblique, its files are in random order and in subfolders, with rescaled voxel values.
+        """
+
+        self.delayDisplay("Starting DICOM series test")
+
+        self._setupPythonRequirements()
+        import nrrd
+        import numpy as np
+        from monai.transforms import LoadImaged
+        dicom_series = self._importScript("dicom_series")
+
+        testDir = slicer.util.tempDirectory()
+        # Oblique volume in LPS coordinate system, axis vectors are the columns of directions
+        rotation = np.array([[np.cos(0.3), -np.sin(0.3), 0.0], [np.sin(0.3), np.cos(0.3), 0.0], [0.0, 0.0, 1.0]])
+        directions = rotation * np.array([0.8, 0.9, 2.5])
+        origin = np.array([10.0, -20.0, 30.0])
+        rescaleSlope, rescaleIntercept = 0.5, -100.0
+        storedArray = self._createTestVolumeArray((48, 40, 24)).astype(np.int16)
+        nrrdFile = os.path.join(testDir, "volume.nrrd")
+        nrrd.write(nrrdFile, (storedArray * rescaleSlope + rescaleIntercept).astype(np.float32),
+            {"space": "left-posterior-superior", "space directions": directions.T, "space origin": origin})
+
+        dicomDir = os.path.join(testDir, "dicom")
+        self._writeTestDicomSeries(dicomDir, storedArray, directions, origin, rescaleSlope, rescaleIntercept)
+
+        # Same voxels and geometry as the NRRD file
+        dicomImage = dicom_series.load_dicom_image(dicomDir)
+        nrrdImage = LoadImaged(keys="image", ensure_channel_first=True, image_only=False)({"image": nrrdFile})["image"]
+        self.assertEqual(tuple(dicomImage.shape), tuple(nrrdImage.shape))
+        np.testing.assert_allclose(dicomImage.affine.numpy(), nrrdImage.affine.numpy(), atol=1e-4)
+        np.testing.assert_allclose(dicomImage.numpy(), nrrdImage.numpy())
+
+        # Same labels and result geometry
+        modelFile = self._createTestModelFile(os.path.join(testDir, "model.pt"))
+        results = []
+        for inputPath in [nrrdFile, dicomDir]:
+            results.append(self._predict(modelFile, inputPath, os.path.join(testDir, f"result{len(results)}.nrrd")))
+        np.testing.assert_array_equal(results[0][0], results[1][0])
+        np.testing.assert_allclose(results[0][1]["space directions"], results[1][1]["space directions"], atol=1e-4)
+        np.testing.assert_allclose(results[0][1]["space origin"], results[1][1]["space origin"], atol=1e-4)
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("DICOM series test passed")
+
+    def test_PredictIceballIncrementalPrediction(self):
+        """Test that incremental prediction gives the same labels as a full prediction if the margin covers the receptive field,
+        and that the state is kept separately for each input and is deleted when it is cleared.
+        """
+
+        self.delayDisplay("Starting incremental prediction test")
+
+        self._setupPythonRequirements()
+        import numpy as np
+        import torch
+        inference = self._importScript("auto3dseg_segresnet_inference")
+        incremental_prediction = self._importScript("incremental_prediction")
+
+        # Two 3x3x3 convolutions: receptive field radius is 2 voxels
+        torch.manual_seed(0)
+        network = torch.nn.Sequential(torch.nn.Conv3d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv3d(4, 2, 3, padding=1)).eval()
+        receptiveFieldRadius = 2
+        device = torch.device("cpu")
+        data1 = torch.as_tensor(self._createTestVolumeArray((64, 56, 40)), dtype=torch.float32)[None, None] / 1000.0
+        data2 = data1.clone()
+        data2[:, :, 40:44, 10:13, 20:22] += 0.5
+
+        def predict(data, region=None):
+            slidingInferrer = inference.make_sliding_inferrer([16, 16, 16], sw_workers=1, skip_windows=True)
+            with torch.no_grad():
+                return inference.predict_labels(slidingInferrer, data, network, device, False, [], region=region)
+
+        labels1 = predict(data1)
+        fullLabels2 = predict(data2)
+        region = incremental_prediction.update_region(data2, data1, margin=receptiveFieldRadius)
+        self.assertTrue(0 < int(region.sum()) < region.numel())
+        incrementalLabels2 = torch.where(region, predict(data2, region), labels1)
+        np.testing.assert_array_equal(incrementalLabels2.numpy(), fullLabels2.numpy())
+
+        # State is stored for each input separately, in the session temporary folder
+        logic = PredictIceballLogic()
+        volumeNode1 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        volumeNode2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+        self.assertIsNone(logic.incrementalStateFile(volumeNode1, "iceball"))
+        logic.incrementalPrediction = True
+        stateFile1 = logic.incrementalStateFile(volumeNode1, "iceball")
+        self.assertNotEqual(stateFile1, logic.incrementalStateFile(volumeNode2, "iceball"))
+        self.assertNotEqual(stateFile1, logic.incrementalStateFile(volumeNode1, "prostate"))
+        self.assertFalse(stateFile1.startswith(str(logic.fileCachePath)))
+        self.assertIn("--incremental-state-file", logic.inferenceScriptOptions(incrementalStateFile=stateFile1))
+        self.assertNotIn("--incremental-state-file", logic.inferenceScriptOptions(incrementalStateFile=stateFile1, preview=True))
+        with open(stateFile1, "w") as f:
+            f.write("state")
+        logic.clearIncrementalState()
+        self.assertFalse(os.path.exists(stateFile1))
+
+        self.delayDisplay("Incremental prediction test passed")
+
+    def test_PredictIceballWeightsCache(self):
+        """Test that the memory-mapped weights cache is created on first load, used afterwards,
+        and created again when the model file is replaced.
+        """
+
+        self.delayDisplay("Starting weights cache test")
+
+        self._setupPythonRequirements()
+        import tempfile
+        import torch
+        inference = self._importScript("auto3dseg_segresnet_inference")
+
+        def assertStateDictEqual(stateDict, expectedStateDict):
+            self.assertEqual(list(stateDict.keys()), list(expectedStateDict.keys()))
+            for name, tensor in expectedStateDict.items():
+                self.assertTrue(torch.equal(stateDict[name], tensor), f"Weights of {name} are different")
+
+        with tempfile.TemporaryDirectory() as testDir:
+            modelFile = self._createTestModelFile(os.path.join(testDir, "model.pt"), seed=0)
+            cacheFile = inference.weights_cache_file(modelFile)
+            self.assertEqual(cacheFile, os.path.join(testDir, "model.mmap.pt"))
+            expectedStateDict = torch.load(modelFile, map_location="cpu")["state_dict"]
+
+            if not inference._torch_load_supports_mmap():
+                # Original model file is used if memory mapping is not supported
+                checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+                self.assertFalse(mmapLoaded)
+                self.assertFalse(os.path.exists(cacheFile))
+                self.delayDisplay("Weights cache is not supported by this torch version")
+                return
+
+            # Cache is created when the model is first loaded, and it is used from then on
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+            self.assertFalse(mmapLoaded)
+            self.assertTrue(os.path.exists(cacheFile))
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+            self.assertTrue(mmapLoaded)
+            assertStateDictEqual(checkpoint["state_dict"], expectedStateDict)
+            # Convolution kernels are stored in the memory layout that is used for inference
+            convolutionKernels = [tensor for tensor in checkpoint["state_dict"].values() if tensor.dim() == 5]
+            self.assertTrue(convolutionKernels)
+            for tensor in convolutionKernels:
+                self.assertTrue(tensor.is_contiguous(memory_format=torch.channels_last_3d))
+            del checkpoint, convolutionKernels
+
+            # Cache is not used without the cache option
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile, use_weights_cache=False)
+            self.assertFalse(mmapLoaded)
+
+            # Cache that is older than the model file is not used, it is replaced by the weights of the new model
+            self._createTestModelFile(modelFile, seed=1)
+            # Modification times may have low resolution, make sure that the cache is older
+            cacheFileTime = os.path.getmtime(modelFile) - 10.0
+            os.utime(cacheFile, (cacheFileTime, cacheFileTime))
+            expectedStateDict = torch.load(modelFile, map_location="cpu")["state_dict"]
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+            self.assertFalse(mmapLoaded)
+            assertStateDictEqual(checkpoint["state_dict"], expectedStateDict)
+            self.assertGreaterEqual(os.path.getmtime(cacheFile), os.path.getmtime(modelFile))
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+            self.assertTrue(mmapLoaded)
+            assertStateDictEqual(checkpoint["state_dict"], expectedStateDict)
+            del checkpoint
+
+            # Damaged cache is ignored and the original model file is used
+            with open(cacheFile, "wb") as f:
+                f.write(b"damaged")
+            checkpoint, mmapLoaded = inference.load_checkpoint(modelFile)
+            self.assertFalse(mmapLoaded)
+            assertStateDictEqual(checkpoint["state_dict"], expectedStateDict)
+            del checkpoint
+
+            # Model that is loaded from the cache gives the same output as the model loaded from the original file
+            model, config, mmapLoaded = inference.load_model(modelFile, torch.device("cpu"))
+            self.assertTrue(mmapLoaded)
+            referenceModel, config, mmapLoaded = inference.load_model(modelFile, torch.device("cpu"), use_weights_cache=False)
+            self.assertFalse(mmapLoaded)
+            data = torch.rand((1, 1, 32, 32, 32))
+            with torch.no_grad():
+                output = model(data)
+                referenceOutput = referenceModel(data)
+            output = output[0] if isinstance(output, (list, tuple)) else output
+            referenceOutput = referenceOutput[0] if isinstance(referenceOutput, (list, tuple)) else referenceOutput
+            self.assertTrue(torch.allclose(output, referenceOutput))
+            del model, referenceModel
+
+        self.delayDisplay("Weights cache test passed")
+
+    def test_PredictIceballAnatomyCache(self):
+        """Test that cached prostate and urethra segmentations are used for an identical scan of the same study,
+        and are not used if the anatomy has changed.
+        """
+
+        self.delayDisplay("Starting anatomy cache test")
+
+        self._setupPythonRequirements()
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+
+        logic = PredictIceballLogic()
+        logic.logCallback = self._mylog
+        self.assertFalse(logic.anatomyCacheEnabled)
+
+        volumeArray = self._createTestVolumeArray((24, 40, 48))
+        volumeNode = slicer.util.addVolumeFromArray(volumeArray)
+        shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+        studyItem = shNode.CreateStudyItem(shNode.CreateSubjectItem(shNode.GetSceneItemID(), "Patient"), "Study")
+        shNode.SetItemParent(shNode.GetItemByDataNode(volumeNode), studyItem)
+
+        # Segmentation labelmaps use IJK voxel order
+        prostateArray = np.zeros(volumeArray.shape[::-1], dtype=np.uint8)
+        prostateArray[16:32, 14:26, 8:16] = 1
+        urethraArray = np.zeros(volumeArray.shape[::-1], dtype=np.uint8)
+        urethraArray[23:25, 19:21, 8:16] = 1
+        self.assertIsNone(logic.cachedAnatomy(volumeNode))
+        logic.updateAnatomyCache(volumeNode, CroppedLabelmap(prostateArray).cropped(), CroppedLabelmap(urethraArray))
+
+        # Hit: next scan of the same study is identical
+        cachedAnatomy = logic.cachedAnatomy(volumeNode)
+        self.assertIsNotNone(cachedAnatomy)
+        (segmentationNode, prostateSegmentId), (_, urethraSegmentId) = cachedAnatomy
+        self.assertEqual(prostateSegmentId, "prostate")
+        self.assertEqual(urethraSegmentId, "urethra")
+        np.testing.assert_array_equal(logic.segmentMaskArray(cachedAnatomy[0], volumeNode), np.transpose(prostateArray, (2, 1, 0)))
+
+        # Miss: intensities around the prostate have changed
+        changedArray = self._createTestVolumeArray(volumeArray.shape, seed=1)
+        changedArray[4:20, 10:30, 12:36] = 1000.0 - changedArray[4:20, 10:30, 12:36]
+        slicer.util.updateVolumeFromArray(volumeNode, changedArray)
+        self.assertIsNone(logic.cachedAnatomy(volumeNode))
+
+        logic.clearAnatomyCache()
+        self.assertFalse(slicer.mrmlScene.IsNodePresent(segmentationNode))
+        self.delayDisplay("Anatomy cache test passed")
+
+    def test_PredictIceballProbeRasterizer(self):
+        """Test that the needle mask created from probe positions matches a brute-force rasterization,
+        which computes the distance of every voxel center from every probe segment.
+        """
+
+        self.delayDisplay("Starting probe rasterizer test")
+
+        import numpy as np
+        from PredictIceballLib import ProbeRasterizer
+
+        # Oblique volume with anisotropic spacing
+        angle = np.radians(30.0)
+        rotation = np.array([[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]])
+        ijkToRas = np.eye(4)
+        ijkToRas[:3, :3] = rotation @ np.diag([0.8, 0.9, 2.5])
+        ijkToRas[:3, 3] = [-10.0, 5.0, -20.0]
+        volumeShape = (40, 36, 16)
+        probes = [
+            # Oblique probe inside the volume
+            (np.array([2.0, 15.0, -10.0]), np.array([8.0, 30.0, 5.0])),
+            # Probe that extends outside the volume
+            (np.array([-5.0, 20.0, -15.0]), np.array([-60.0, 20.0, -15.0])),
+            # Probe with the tip at the entry point (sphere)
+            (np.array([5.0, 25.0, 0.0]), np.array([5.0, 25.0, 0.0])),
+            # Probe completely outside the volume
+            (np.array([200.0, 200.0, 200.0]), np.array([220.0, 200.0, 200.0])),
+            ]
+        diameter = 3.0
+
+        def bruteForceMask(probes, radius):
+            i, j, k = np.meshgrid(*[np.arange(length) for length in volumeShape], indexing="ij")
+            points = np.stack([i.ravel(), j.ravel(), k.ravel(), np.ones(i.size)])
+            points = (ijkToRas @ points)[:3].T
+            mask = np.zeros(len(points), dtype=bool)
+            for tip, entry in probes:
+                axis = entry - tip
+                t = np.zeros(len(points))
+                if axis.dot(axis) > 0:
+                    t = np.clip((points - tip) @ axis / axis.dot(axis), 0.0, 1.0)
+                distance = np.linalg.norm(points - (tip + t[:, None] * axis), axis=1)
+                mask |= distance <= radius
+            return mask.reshape(volumeShape).astype(np.uint8)
+
+        rasterizer = ProbeRasterizer(volumeShape, ijkToRas)
+        mask = rasterizer.rasterize(probes, diameter)
+        self.assertEqual(mask.shape, volumeShape)
+        self.assertEqual(mask.dtype, np.uint8)
+        expectedMask = bruteForceMask(probes, diameter / 2)
+        self.assertGreater(int(expectedMask.sum()), 0)
+        np.testing.assert_array_equal(mask, expectedMask)
+
+        # Probes are added to an existing mask
+        mask = rasterizer.rasterize(probes[:1], diameter)
+        rasterizer.rasterize(probes[1:], diameter, mask=mask)
+        np.testing.assert_array_equal(mask, expectedMask)
+
+        # Probes thinner than a voxel are rasterized with half of the largest voxel spacing as radius
+        np.testing.assert_array_equal(rasterizer.rasterize(probes, 0.1), bruteForceMask(probes, 1.25))
+
+        self.delayDisplay("Probe rasterizer test passed")
+
+    def test_PredictIceballSegmentMask(self):
+        """Test that existing segmentations are written as masks in the geometry and voxel order of the input file"""
+
+        self.delayDisplay("Starting segment mask test")
+
+        self._setupPythonRequirements()
+        import nrrd
+        import numpy as np
+
+        logic = PredictIceballLogic()
+        logic.logCallback = self._mylog
+        volumeArray = self._createTestVolumeArray((16, 30, 40))
+        inputNode = slicer.util.addVolumeFromArray(volumeArray)
+        inputNode.SetSpacing(0.8, 0.9, 2.5)
+        inputNode.SetOrigin(-10.0, 5.0, -20.0)
+
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputNode)
+        prostateArray = np.zeros(volumeArray.shape, dtype=np.uint8)
+        prostateArray[4:10, 8:20, 10:30] = 1
+        urethraArray = np.zeros(volumeArray.shape, dtype=np.uint8)
+        urethraArray[2:14, 13:15, 19:21] = 1
+        for segmentId, segmentArray in [("prostate", prostateArray), ("urethra", urethraArray)]:
+            segmentationNode.GetSegmentation().AddEmptySegment(segmentId, segmentId)
+            slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, segmentationNode, segmentId, inputNode)
+
+        # Single segment or union of all segments, KJI voxel order
+        np.testing.assert_array_equal(logic.segmentMaskArray((segmentationNode, "prostate"), inputNode), prostateArray)
+        np.testing.assert_array_equal(logic.segmentMaskArray(segmentationNode, inputNode), prostateArray | urethraArray)
+        with self.assertRaises(ValueError):
+            logic.segmentMaskArray((segmentationNode, "bladder"), inputNode)
+        with self.assertRaises(ValueError):
+            logic.segmentMaskArray(slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode"), inputNode)
+
+        # Mask labelmap is cropped to the segment, has the same geometry as the input file and IJK voxel order
+        testDir = slicer.util.tempDirectory()
+        inputFile = os.path.join(testDir, "input.nrrd")
+        maskFile = os.path.join(testDir, "prostate.nrrd")
+        self.assertTrue(slicer.util.saveNode(inputNode, inputFile))
+        inputHeader = nrrd.read_header(inputFile)
+        mask = logic.segmentMaskLabelmap((segmentationNode, "prostate"), inputNode, inputHeader)
+        self.assertEqual(list(mask.offset), [10, 8, 4])
+        self.assertEqual(mask.array.shape, (20, 12, 6))
+        np.testing.assert_array_equal(mask.toArray(), np.transpose(prostateArray, (2, 1, 0)))
+        mask.write(maskFile)
+        np.testing.assert_array_equal(logic.readLabelmapArray(maskFile), np.transpose(prostateArray, (2, 1, 0)))
+        maskHeader = nrrd.read_header(maskFile)
+        np.testing.assert_allclose(maskHeader["space directions"], inputHeader["space directions"])
+        np.testing.assert_allclose(maskHeader["space origin"], np.asarray(inputHeader["space origin"]) + mask.offset @ inputHeader["space directions"])
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Segment mask test passed")
+
+    def test_PredictIceballCroppedLabelmap(self):
+        """Test that cropped labelmaps written by the inference script give the same labels as uncropped labelmaps
+        (also for an empty labelmap), that the anatomy is refined the same way as in the full volume,
+        and that cropped labelmaps are imported into segments at their offset.
+        """
+
+        self.delayDisplay("Starting cropped labelmap test")
+
+        self._setupPythonRequirements()
+        import cv2
+        import nrrd
+        import numpy as np
+        from PredictIceballLib import CroppedLabelmap
+        inference = self._importScript("auto3dseg_segresnet_inference")
+
+        logic = PredictIceballLogic()
+        logic.logCallback = self._mylog
+        testDir = slicer.util.tempDirectory()
+        header = {"space": "left-posterior-superior", "space directions": np.diag([0.8, 0.9, 2.5]), "space origin": np.array([1.0, 2.0, 3.0])}
+        volumeShape = (48, 40, 16)
+        labelArray = np.zeros(volumeShape, dtype=np.uint8)
+        labelArray[10:20, 5:9, 3:12] = 1
+        labelArray[12:14, 30:34, 2] = 2
+        for labelmapName, expectedArray, expectedCroppedShape in [
+                ("labels", labelArray, (10, 29, 10)),
+                ("empty", np.zeros(volumeShape, dtype=np.uint8), (1, 1, 1))]:
+            uncroppedFile = os.path.join(testDir, f"{labelmapName}.nrrd")
+            croppedFile = os.path.join(testDir, f"{labelmapName}-cropped.nrrd")
+            inference.write_labelmap(uncroppedFile, expectedArray, header)
+            inference.write_labelmap(croppedFile, expectedArray, header, crop=True)
+            self.assertEqual(nrrd.read_header(croppedFile)["sizes"].tolist(), list(expectedCroppedShape))
+            for labelmapFile in [uncroppedFile, croppedFile]:
+                np.testing.assert_array_equal(logic.readLabelmapArray(labelmapFile), expectedArray)
+                labelmap = CroppedLabelmap.read(labelmapFile)
+                self.assertEqual(labelmap.shape, volumeShape)
+                np.testing.assert_array_equal(labelmap.toArray(), expectedArray)
+                np.testing.assert_allclose(labelmap.header["space origin"], header["space origin"])
+                self.assertNotIn("crop_offset", labelmap.header)
+                # Any box of the volume, also boxes that only partially overlap with the labelmap
+                for region in [(slice(0, 48), slice(0, 40), slice(0, 16)), (slice(15, 30), slice(2, 7), slice(0, 5)), (slice(40, 48), slice(0, 3), slice(14, 16))]:
+                    np.testing.assert_array_equal(labelmap.arrayInRegion(region), expectedArray[region])
+                # Writing it again gives the same file content
+                labelmap.cropped().write(os.path.join(testDir, "rewritten.nrrd"))
+                np.testing.assert_array_equal(nrrd.read(os.path.join(testDir, "rewritten.nrrd"))[0], nrrd.read(croppedFile)[0])
+                np.testing.assert_array_equal(inference.read_labelmap(labelmapFile, volumeShape), expectedArray)
+
+        # Anatomy refinement in the box of the dilated prostate is the same as in the full volume
+        # (prostate is in a single slice, and close to the edge of the volume)
+        prostateArray = np.zeros(volumeShape, dtype=np.uint8)
+        prostateArray[2:20, 10:25, 7] = 1
+        urethraArray = np.zeros(volumeShape, dtype=np.uint8)
+        urethraArray[5:40, 15:17, 4:10] = 1
+        needleArray = np.zeros(volumeShape, dtype=np.uint8)
+        needleArray[8:10, 0:40, 5:9] = 1
+        expectedDilatedArray = cv2.dilate(prostateArray, np.ones((25, 25), np.uint8), iterations=1) > 0
+        expectedNeedleArray = expectedDilatedArray & (needleArray == 1)
+        expectedUrethraArray = expectedDilatedArray & (urethraArray == 1) & ~expectedNeedleArray
+        refined = logic.refineAnatomy(CroppedLabelmap(prostateArray, header=header).cropped(), CroppedLabelmap(urethraArray).cropped(),
+            CroppedLabelmap(needleArray))
+        for labelmap, expectedArray in zip(refined, [expectedDilatedArray, expectedNeedleArray, expectedUrethraArray]):
+            self.assertTrue(expectedArray.any())
+            self.assertLess(labelmap.array.size, expectedArray.size)
+            np.testing.assert_array_equal(labelmap.toArray(), expectedArray.astype(np.uint8))
+
+        # Layout and iceball refinement, shared by process() and evaluateProbeLayouts()
+        np.testing.assert_array_equal(logic.layoutLabelmap(refined[1], refined[2]).toArray(), expectedNeedleArray + 2 * expectedUrethraArray)
+        iceballArray = np.zeros(volumeShape, dtype=np.uint8)
+        iceballArray[6:30, 12:22, 3:10] = 1
+        np.testing.assert_array_equal(logic.refineIceball(CroppedLabelmap(iceballArray).cropped(), refined[2]).toArray(),
+            (iceballArray == 1) & ~expectedUrethraArray)
+
+        # Segment imported from a cropped labelmap is the same as imported from the full array
+        volumeNode = slicer.util.addVolumeFromArray(np.zeros(volumeShape[::-1]))
+        volumeNode.SetSpacing(0.8, 0.9, 2.5)
+        volumeNode.SetOrigin(-1.0, -2.0, 3.0)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentationNode.GetSegmentation().AddEmptySegment("labels")
+        labelmap = CroppedLabelmap((labelArray == 1).astype(np.uint8)).cropped()
+        logic.updateSegmentFromLabelmap(segmentationNode, "labels", labelmap, volumeNode)
+        np.testing.assert_array_equal(slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, "labels", volumeNode),
+            np.transpose(labelArray == 1, (2, 1, 0)).astype(np.uint8))
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Cropped labelmap test passed")
+
+    def test_PredictIceballWindowSkipping(self):
+        """Test that sliding windows outside the foreground or the ROI mask are skipped,
+        and labels in the foreground or ROI are the same as without skipping windows.
+        """
+
+        self.delayDisplay("Starting window skipping test")
+
+        self._setupPythonRequirements()
+        import re
+        import numpy as np
+        import torch
+        inference = self._importScript("auto3dseg_segresnet_inference")
+
+        # Foreground is the intersection of the thresholded first channel and the ROI
+        data = torch.arange(8, dtype=torch.float32).reshape(1, 1, 2, 2, 2)
+        roi = torch.zeros_like(data)
+        roi[..., 0, :, :] = 1.0
+        self.assertIsNone(inference.foreground_mask(data))
+        np.testing.assert_array_equal(inference.foreground_mask(data, foreground_threshold=2.5).numpy(), (data > 2.5).numpy())
+        np.testing.assert_array_equal(inference.foreground_mask(data, roi=roi).numpy(), (roi > 0.5).numpy())
+        np.testing.assert_array_equal(inference.foreground_mask(data, roi, 2.5).numpy(), ((data > 2.5) & (roi > 0.5)).numpy())
+
+        volumeArray = self._createTestVolumeArray((96, 80, 40))
+        testDir, imageFile, header, modelFile = self._createTestInputs(volumeArray)
+        roiArray = np.zeros(volumeArray.shape, dtype=np.uint8)
+        roiArray[24:48, 20:44, 5:25] = 1
+        roiFile = os.path.join(testDir, "roi.nrrd")
+        # ROI mask is cropped the same way as the masks that the logic writes
+        inference.write_labelmap(roiFile, roiArray, header, crop=True)
+
+        def predict(*options):
+            labels, _, output = self._predict(modelFile, imageFile, os.path.join(testDir, "result.nrrd"), ["--sw-workers", 1] + list(options))
+            skipped = re.search(r"\((\d+) of (\d+) windows skipped", output)
+            return labels, (int(skipped.group(1)) if skipped else 0)
+
+        # Parallel inferer without skipping windows is the reference
+        referenceLabels, skippedWindowCount = predict()
+        self.assertEqual(skippedWindowCount, 0)
+        # Foreground threshold is applied after intensity normalization (with a small margin for rounding differences)
+        nonzeroValues = volumeArray[volumeArray != 0]
+        foreground = (volumeArray - nonzeroValues.mean()) / nonzeroValues.std() > 3.1
+        for options, selectedVoxels in [
+                (["--roi-mask-file", roiFile], roiArray > 0),
+                (["--foreground-threshold", 3.0], foreground),
+                (["--roi-mask-file", roiFile, "--foreground-threshold", 3.0], (roiArray > 0) & foreground)]:
+            labels, skippedWindowCount = predict(*options)
+            self.assertGreater(skippedWindowCount, 0, options)
+            self.assertTrue(selectedVoxels.any())
+            np.testing.assert_array_equal(labels[selectedVoxels], referenceLabels[selectedVoxels])
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Window skipping test passed")
+
+    def test_PredictIceballPreprocessingCache(self):
+        """Test that preprocessed inputs are reused by models with the same preprocessing settings,
+        and that results are the same as without the cache (preprocessing is inverted correctly).
+        """
+
+        self.delayDisplay("Starting preprocessing cache test")
+
+        self._setupPythonRequirements()
+        import nrrd
+        import numpy as np
+        preprocessing_cache = self._importScript("preprocessing_cache")
+
+        testDir, imageFile, header, modelFile = self._createTestInputs(self._createTestVolumeArray((48, 40, 16)),
+            directions=np.diag([-0.8, 0.9, 2.5]), origin=[1.0, 2.0, 3.0])
+        cacheDir = os.path.join(testDir, "cache")
+        changedImageFile = os.path.join(testDir, "changed-image.nrrd")
+        nrrd.write(changedImageFile, self._createTestVolumeArray((48, 40, 16), seed=1).astype(np.float32), header)
+        # Different network, same preprocessing
+        otherModelFile = self._createTestModelFile(os.path.join(testDir, "other-model.pt"), seed=1, roi_size=[16, 16, 16])
+        # Different preprocessing
+        resampledModelFile = self._createTestModelFile(os.path.join(testDir, "resampled-model.pt"), resample_resolution=[1.5, 1.5, 1.5])
+
+        # Cache key only depends on the input content and the preprocessing settings
+        cache = preprocessing_cache.PreprocessingCache(cacheDir)
+        config = {"normalize_mode": "meanstd", "intensity_bounds": [0, 1], "resample_resolution": [1.0, 1.0, 1.0], "roi_size": [32, 32, 32]}
+        key = cache.key([imageFile], config)
+        self.assertEqual(key, cache.key([imageFile], dict(config, roi_size=[16, 16, 16])))
+        self.assertNotEqual(key, cache.key([imageFile], dict(config, resample_resolution=[1.5, 1.5, 1.5])))
+        self.assertNotEqual(key, cache.key([changedImageFile], config))
+        self.assertNotEqual(key, cache.key([imageFile], config, roi_mask_file=changedImageFile))
+        self.assertNotEqual(key, cache.key([imageFile], config, layout_file=changedImageFile))
+        self.assertIsNone(cache.load(key))
+
+        def predict(modelFile, imageFile, useCache):
+            labels, resultHeader, output = self._predict(modelFile, imageFile, os.path.join(testDir, "result.nrrd"),
+                ["--preprocessing-cache-dir", cacheDir] if useCache else [])
+            return (labels, resultHeader), "Preprocessing (cached):" in output
+
+        for currentModelFile, currentImageFile, expectedCacheHit in [
+                (modelFile, imageFile, False),
+                (modelFile, imageFile, True),
+                (otherModelFile, imageFile, True),
+                (resampledModelFile, imageFile, False),
+                (modelFile, changedImageFile, False)]:
+            (labels, resultHeader), cacheHit = predict(currentModelFile, currentImageFile, useCache=True)
+            self.assertEqual(cacheHit, expectedCacheHit, (currentModelFile, currentImageFile))
+            (referenceLabels, referenceHeader), _ = predict(currentModelFile, currentImageFile, useCache=False)
+            np.testing.assert_array_equal(labels, referenceLabels)
+            np.testing.assert_allclose(resultHeader["space directions"], referenceHeader["space directions"])
+            np.testing.assert_allclose(resultHeader["space origin"], referenceHeader["space origin"])
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Preprocessing cache test passed")
+
+    def test_PredictIceballParallelSlidingWindow(self):
+        """Test that the parallel sliding window inferer gives the same results as MONAI SlidingWindowInfererAdapt,
+        with one and multiple workers, with an input that is smaller than the window, and with skipped windows.
+        """
+
+        self.delayDisplay("Starting parallel sliding window test")
+
+        self._setupPythonRequirements()
+        import numpy as np
+        import torch
+        from monai.inferers import SlidingWindowInfererAdapt
+        sliding_window = self._importScript("sliding_window")
+
+        torch.manual_seed(0)
+        network = torch.nn.Sequential(torch.nn.Conv3d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv3d(4, 3, 3, padding=1)).eval()
+        roiSize = [16, 16, 16]
+        # Last axis is smaller than the window, so the input is padded
+        data = torch.as_tensor(self._createTestVolumeArray((40, 36, 12)), dtype=torch.float32)[None, None] / 1000.0
+        with torch.no_grad():
+            referenceLogits = SlidingWindowInfererAdapt(roi_size=roiSize, sw_batch_size=1, overlap=0.625, mode="gaussian")(inputs=data, network=network)
+        referenceLabels = torch.argmax(referenceLogits, dim=1, keepdim=True)
+
+        mask = torch.zeros_like(data, dtype=torch.bool)
+        mask[:, :, :16, :16, :] = True
+        region = torch.zeros_like(data, dtype=torch.bool)
+        region[:, :, 30:34, 20:24, 4:8] = True
+        threadCount = torch.get_num_threads()
+        for workers in [1, 4]:
+            inferer = sliding_window.ParallelSlidingWindowInferer(roiSize, workers=workers)
+            with torch.no_grad():
+                logits = inferer(inputs=data, network=network)
+                np.testing.assert_allclose(logits.numpy(), referenceLogits.numpy(), rtol=1e-4, atol=1e-5)
+                self.assertEqual(inferer.used_worker_count, workers)
+
+                inferer.output = "labels"
+                labels = inferer(inputs=data, network=network)
+                self.assertEqual(labels.dtype, torch.uint8)
+                # Labels may only differ where the two highest class scores are nearly equal
+                topLogits = torch.topk(referenceLogits, 2, dim=1).values
+                ambiguous = (topLogits[:, 0:1] - topLogits[:, 1:2]) < 1e-4
+                self.assertTrue(torch.all((labels == referenceLabels) | ambiguous))
+
+                # Voxels in the mask or region are only covered by evaluated windows
+                inferer.output = "logits"
+                for selection in [{"mask": mask}, {"region": region}]:
+                    selectedLogits = inferer(inputs=data, network=network, **selection)
+                    self.assertGreater(inferer.skipped_window_count, 0)
+                    selectedVoxels = list(selection.values())[0].expand_as(referenceLogits)
+                    np.testing.assert_allclose(selectedLogits[selectedVoxels].numpy(), referenceLogits[selectedVoxels].numpy(), rtol=1e-4, atol=1e-5)
+            # Thread count of the process is restored
+            self.assertEqual(torch.get_num_threads(), threadCount)
+
+        self.delayDisplay("Parallel sliding window test passed")
+
+    def test_PredictIceballMemoryPlanner(self):
+        """Test that the memory planner chooses the fastest inference level that fits into the budget,
+        and that inference is retried at the next level when it runs out of memory.
+        """
+
+        self.delayDisplay("Starting memory planner test")
+
+        self._setupPythonRequirements()
+        import torch
+        inference = self._importScript("auto3dseg_segresnet_inference")
+        memory_planning = self._importScript("memory_planning")
+
+        # Level selection (GPU levels can be planned without a GPU)
+        def createPlanner(budget, device):
+            return memory_planning.MemoryPlanner(budget, torch.device(device), [96, 96, 96], [200, 180, 120], [256, 256, 100],
+                init_filters=32, model_bytes=40 * 1024 * 1024)
+        for device in ["cuda", "cpu"]:
+            planner = createPlanner(0, device)
+            peakEstimates = [max(planner.estimate(level).values()) for level in planner.levels]
+            # Each level uses less memory than the previous one
+            self.assertEqual(peakEstimates, sorted(peakEstimates, reverse=True))
+            for levelIndex, peakEstimate in enumerate(peakEstimates):
+                planner = createPlanner(peakEstimate, device)
+                self.assertTrue(planner.choose_level())
+                # Levels with the same memory usage are equivalent, the first (fastest) of them is chosen
+                self.assertEqual(planner.level_index, peakEstimates.index(peakEstimate))
+            planner = createPlanner(10 * peakEstimates[0], device)
+            self.assertTrue(planner.choose_level())
+            self.assertEqual(planner.level_index, 0)
+            # If nothing fits then the level with the least memory usage is used
+            planner = createPlanner(peakEstimates[-1] - 1, device)
+            self.assertFalse(planner.choose_level())
+            self.assertEqual(planner.level_index, len(planner.levels) - 1)
+            self.assertFalse(planner.degrade())
+            self.assertEqual(planner.level_index, len(planner.levels) - 1)
+        # float16 accumulator is only used when the float32 levels do not fit
+        cudaLevels = memory_planning.inference_levels(torch.device("cuda"))
+        firstFloat16LevelIndex = [level.accumulator_dtype for level in cudaLevels].index(torch.float16)
+        self.assertTrue(all(level.accumulator_dtype == torch.float32 for level in cudaLevels[:firstFloat16LevelIndex]))
+        # Measured memory usage is included in the estimate
+        planner = createPlanner(0, "cpu")
+        measuredPlanner = createPlanner(0, "cpu")
+        measuredPlanner.baseline_bytes = 10 * 1024 * 1024 * 1024
+        self.assertGreater(max(measuredPlanner.estimate(measuredPlanner.level()).values()), 10 * 1024 * 1024 * 1024)
+        self.assertLess(max(planner.estimate(planner.level()).values()), max(measuredPlanner.estimate(measuredPlanner.level()).values()))
+
+        self.assertTrue(memory_planning.is_out_of_memory_error(MemoryError()))
+        self.assertTrue(memory_planning.is_out_of_memory_error(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")))
+        self.assertTrue(memory_planning.is_out_of_memory_error(RuntimeError("[enforce fail at alloc_cpu.cpp] DefaultCPUAllocator: can't allocate memory")))
+        self.assertFalse(memory_planning.is_out_of_memory_error(RuntimeError("shape mismatch")))
+        self.assertFalse(memory_planning.is_out_of_memory_error(ValueError("out of memory")))
+
+        # Inference is retried at the next level when it runs out of memory
+        class OutOfMemoryNetwork(torch.nn.Module):
+            """Network that runs out of memory in the first failureCount calls"""
+            def __init__(self, network, failureCount, error=None):
+                super().__init__()
+                self.network = network
+                self.failureCount = failureCount
+                self.error = error if error is not None else RuntimeError("DefaultCPUAllocator: not enough memory")
+            def forward(self, x):
+                if self.failureCount > 0:
+                    self.failureCount -= 1
+                    raise self.error
+                return self.network(x)
+
+        torch.manual_seed(0)
+        network = torch.nn.Sequential(torch.nn.Conv3d(1, 4, 3, padding=1), torch.nn.ReLU(), torch.nn.Conv3d(4, 2, 3, padding=1)).eval()
+        data = torch.as_tensor(self._createTestVolumeArray((40, 36, 24)), dtype=torch.float32)[None, None] / 1000.0
+        device = torch.device("cpu")
+        with torch.no_grad():
+            referenceLogits = inference.make_sliding_inferrer([16, 16, 16], sw_workers=1)(inputs=data, network=network)
+        referenceLabels = torch.argmax(referenceLogits, dim=1, keepdim=True)
+
+        def predict(network, planner):
+            with torch.no_grad():
+                return inference.predict_labels(inference.make_sliding_inferrer([16, 16, 16], sw_workers=1), data, network, device,
+                    False, [], memory_planner=planner, model=network)
+
+        planner = memory_planning.MemoryPlanner(1024 ** 4, device, [16, 16, 16], data.shape[2:], data.shape[2:])
+        self.assertTrue(planner.choose_level())
+        self.assertEqual(planner.level_index, 0)
+        labels = predict(OutOfMemoryNetwork(network, failureCount=1), planner)
+        self.assertEqual(planner.level_index, 1)
+        self.assertEqual(planner.level().accumulator_dtype, torch.float16)
+        # Labels may only differ where the two highest class scores are nearly equal (float16 accumulator)
+        topLogits = torch.topk(referenceLogits, 2, dim=1).values
+        ambiguous = (topLogits[:, 0:1] - topLogits[:, 1:2]) < 1e-2
+        self.assertEqual(labels.shape, referenceLabels.shape)
+        self.assertTrue(torch.all((labels == referenceLabels) | ambiguous))
+
+        # Error is raised if it still runs out of memory at the last level
+        planner = memory_planning.MemoryPlanner(1024 ** 4, device, [16, 16, 16], data.shape[2:], data.shape[2:])
+        planner.choose_level()
+        with self.assertRaises(RuntimeError):
+            predict(OutOfMemoryNetwork(network, failureCount=len(planner.levels)), planner)
+        self.assertEqual(planner.level_index, len(planner.levels) - 1)
+
+        # Other errors are not retried
+        planner = memory_planning.MemoryPlanner(1024 ** 4, device, [16, 16, 16], data.shape[2:], data.shape[2:])
+        planner.choose_level()
+        with self.assertRaises(RuntimeError):
+            predict(OutOfMemoryNetwork(network, failureCount=1, error=RuntimeError("shape mismatch")), planner)
+        self.assertEqual(planner.level_index, 0)
+
+        self.delayDisplay("Memory planner test passed")
+
+    def test_PredictIceballInferenceTuning(self):
+        """Test that the tuner stores the fastest settings whose results are similar to the reference,
+        separately for all settings and for output-invariant settings, and that only the latter are used by default.
+        """
+
+        self.delayDisplay("Starting inference tuning test")
+
+        self._setupPythonRequirements()
+        import tempfile
+        import torch
+        inference_tuning = self._importScript("inference_tuning")
+
+        referenceLabels = torch.zeros((1, 1, 8, 8, 8), dtype=torch.uint8)
+        referenceLabels[:, :, 2:6, 2:6, 2:6] = 1
+        differentLabels = torch.zeros_like(referenceLabels)
+        differentLabels[:, :, 2:4, 2:6, 2:6] = 1
+        self.assertEqual(inference_tuning.dice(referenceLabels, referenceLabels), 1.0)
+        self.assertAlmostEqual(inference_tuning.dice(differentLabels, referenceLabels), 2.0 * 32 / (32 + 64))
+        self.assertEqual(inference_tuning.dice(torch.zeros_like(referenceLabels), torch.zeros_like(referenceLabels)), 1.0)
+
+        # Computation time and result of each setting is simulated:
+        # (sw_batch_size, overlap, blend_mode) -> (median computation time, labels), None if it fails (e.g., out of memory)
+        simulatedResults = {
+            (1, 0.625, "gaussian"): (10.0, referenceLabels),  # reference
+            (2, 0.625, "gaussian"): (6.0, referenceLabels),  # fastest output-invariant
+            (4, 0.625, "gaussian"): None,
+            (1, 0.5, "constant"): (3.0, referenceLabels),  # fastest acceptable
+            (4, 0.25, "constant"): (1.0, differentLabels),  # fastest, but its result is too different
+            }
+        runSettingsCalls = []
+        def simulatedRunSettings(model, config, data, device, settings, repeats=3):
+            runSettingsCalls.append(dict(settings))
+            result = simulatedResults.get((settings["sw_batch_size"], settings["overlap"], settings["blend_mode"]), (20.0, referenceLabels))
+            if result is None:
+                raise RuntimeError("out of memory")
+            computationTime, labels = result
+            return labels, computationTime
+
+        runSettings = inference_tuning.run_settings
+        inference_tuning.run_settings = simulatedRunSettings
+        try:
+            with tempfile.TemporaryDirectory() as tempDir:
+                modelFolder = os.path.join(tempDir, "test-model-v1.0.0")
+                os.makedirs(modelFolder)
+                modelFile = self._createTestModelFile(os.path.join(modelFolder, "model.pt"))
+                tuningFile = os.path.join(tempDir, "inference-tuning.json")
+                self.assertIsNone(inference_tuning.tuned_settings(tuningFile, modelFile))
+
+                inference_tuning.main(model_file=modelFile, tuning_file=tuningFile, batch_sizes=(1, 2, 4), workers=[1],
+                    overlaps=(0.625, 0.5, 0.25), blend_modes=("gaussian", "constant"), synthetic_size=1.0)
+                # Reference and all combinations of the search grid are run
+                self.assertEqual(len(runSettingsCalls), 1 + 3 * 3 * 2)
+
+                tuning = inference_tuning.read_tuning_file(tuningFile)
+                entry = tuning["settings"][f"{inference_tuning.model_key(modelFile)}|{inference_tuning.hardware_fingerprint()}"]
+                self.assertEqual(entry["settings"], {"sw_batch_size": 1, "sw_workers": 1, "overlap": 0.5, "blend_mode": "constant"})
+                self.assertEqual(entry["time"], 3.0)
+                self.assertEqual(entry["dice"], 1.0)
+                self.assertEqual(entry["output_invariant"]["settings"],
+                    {"sw_batch_size": 2, "sw_workers": 1, "overlap": 0.625, "blend_mode": "gaussian"})
+                self.assertEqual(entry["output_invariant"]["time"], 6.0)
+
+                # Only settings that do not change the output are used, unless accuracy settings are allowed
+                self.assertEqual(inference_tuning.tuned_settings(tuningFile, modelFile), {"sw_batch_size": 2, "sw_workers": 1})
+                self.assertEqual(inference_tuning.tuned_settings(tuningFile, modelFile, accuracy_settings=True), entry["settings"])
+
+                # If no setting is faster than the reference then the reference settings are kept
+                simulatedResults.clear()
+                simulatedResults[(1, 0.625, "gaussian")] = (1.0, referenceLabels)
+                inference_tuning.main(model_file=modelFile, tuning_file=tuningFile, batch_sizes=(1, 2), workers=[1],
+                    overlaps=(0.625,), blend_modes=("gaussian",), synthetic_size=1.0)
+                self.assertEqual(inference_tuning.tuned_settings(tuningFile, modelFile), {"sw_batch_size": 1, "sw_workers": 1})
+                self.assertEqual(inference_tuning.tuned_settings(tuningFile, modelFile, accuracy_settings=True),
+                    {"sw_batch_size": 1, "sw_workers": 1, "overlap": 0.625, "blend_mode": "gaussian"})
+
+                # Results of other models and of tuning files of other versions are not used
+                otherModelFile = self._createTestModelFile(os.path.join(modelFolder, "other_model.pt"), seed=1)
+                self.assertIsNone(inference_tuning.tuned_settings(tuningFile, otherModelFile))
+                tuning = inference_tuning.read_tuning_file(tuningFile)
+                tuning["version"] = inference_tuning.TUNING_FILE_VERSION - 1
+                inference_tuning.write_tuning_file(tuningFile, tuning)
+                self.assertIsNone(inference_tuning.tuned_settings(tuningFile, modelFile))
+        finally:
+            inference_tuning.run_settings = runSettings
+
+        self.delayDisplay("Inference tuning test passed")
+
+    def test_PredictIceballProgressivePrediction(self):
+        """Test that progressive prediction runs a preview pass and then a full-quality pass,
+        and that the processing completed callback is called only once, after the full-quality pass.
+        Passes are simulated, so that only the sequencing of the passes and callbacks is tested.
+        """
+
+        self.delayDisplay("Starting progressive prediction test")
+
+        logic = PredictIceballLogic()
+        completedCalls = []
+        logic.processingCompletedCallback = lambda returnCode, customData: completedCalls.append((returnCode, customData))
+        passes = []
+        pendingCompletions = []
+
+        anatomyLabelmapsOfPasses = []
+
+        def simulatedProcess(inputNodes, outputSegmentation, model=None, cpu=False, waitForCompletion=True, customData=None, preview=False, **kwargs):
+            passes.append("preview" if preview else "full")
+            anatomyLabelmapsOfPasses.append(kwargs["anatomyLabelmaps"])
+            segmentationProcessInfo = {"proc": None, "stopTime": 0.0}
+            completedCallback = logic.processingCompletedCallback
+            complete = lambda: completedCallback(0, customData)
+            if waitForCompletion:
+                complete()
+            else:
+                pendingCompletions.append(complete)
+            return segmentationProcessInfo
+
+        logic.process = simulatedProcess
+
+        # Waiting for completion
+        segmentationProcessInfo = logic.processProgressive(["input"], "output", waitForCompletion=True, customData="sync")
+        self.assertEqual(passes, ["preview", "full"])
+        self.assertEqual(completedCalls, [(0, "sync")])
+        self.assertIsNotNone(segmentationProcessInfo["previewTimeSec"])
+        # Anatomy labelmaps of the preview are reused in the full-quality pass
+        self.assertIs(anatomyLabelmapsOfPasses[0], anatomyLabelmapsOfPasses[1])
+
+        # In the background: the full-quality pass starts when the preview is completed
+        passes.clear()
+        completedCalls.clear()
+        progressiveProcessInfo = logic.processProgressive(["input"], "output", waitForCompletion=False, customData="async")
+        self.assertEqual(passes, ["preview"])
+        pendingCompletions.pop(0)()
+        self.assertEqual(passes, ["preview", "full"])
+        self.assertEqual(completedCalls, [])
+        self.assertIs(progressiveProcessInfo["currentProcessInfo"]["previewTimeSec"], progressiveProcessInfo["previewTimeSec"])
+        pendingCompletions.pop(0)()
+        self.assertEqual(completedCalls, [(0, "async")])
+        self.assertEqual(pendingCompletions, [])
+
+        # Cancelled during the preview: the full-quality pass is not started
+        passes.clear()
+        completedCalls.clear()
+        progressiveProcessInfo = logic.processProgressive(["input"], "output", waitForCompletion=False, customData="cancel")
+        # Simulated process has no process to stop, its completion is triggered below
+        logic.onSegmentationProcessCompleted = lambda segmentationProcessInfo: None
+        logic.cancelProcessing(progressiveProcessInfo)
+        pendingCompletions.pop(0)()
+        self.assertEqual(passes, ["preview"])
+        self.assertEqual(completedCalls, [(PredictIceballLogic.EXIT_CODE_USER_CANCELLED, "cancel")])
+
+        self.delayDisplay("Progressive prediction test passed")
+
+    def test_PredictIceballProgressivePredictionModels(self):
+        """Test progressive prediction with small test models (runs the inference scripts): the preview is computed
+        at twice the resample resolution with low overlap and imported into the output segmentation before the full-quality pass,
+        the full-quality pass reuses the anatomy of the preview, and latencies of both results are reported.
+        """
+
+        self.delayDisplay("Starting progressive prediction test with models")
+
+        self._setupPythonRequirements()
+        import numpy as np
+
+        logic = PredictIceballLogic()
+        logic.modelRegistry, modelId = self._createTestModelPackage()
+        logic.anatomyCacheEnabled = False
+        logMessages = []
+        logic.logCallback = logMessages.append
+        importedSegments = []
+
+        def onResultImported(customData):
+            segmentation = outputSegmentation.GetSegmentation()
+            fullQualityPassStarted = "Computing full-quality iceball..." in logMessages
+            importedSegments.append((fullQualityPassStarted, [segmentation.GetNthSegmentID(index) for index in range(segmentation.GetNumberOfSegments())]))
+
+        logic.endResultImportCallback = onResultImported
+
+        volumeArray = self._createTestVolumeArray((48, 40, 24))
+        inputNode = slicer.util.addVolumeFromArray(volumeArray.transpose().astype(np.float32))
+        outputSegmentation = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+        segmentationProcessInfo = logic.processProgressive([inputNode], outputSegmentation, modelId, cpu=True, waitForCompletion=True)
+
+        # Anatomy and iceball models of the preview run at 2x resample resolution with low overlap,
+        # the full-quality pass only runs the iceball model, at the resolution of the model
+        self.assertEqual(logic.previewResolutionScale, 2.0)
+        resolutionScaleMessages = [message for message in logMessages if message.startswith("Resample resolution is scaled by")]
+        self.assertEqual(resolutionScaleMessages, [f"Resample resolution is scaled by {logic.previewResolutionScale}"] * 4)
+        commandMessages = [message for message in logMessages if message.startswith("Auto3DSeg command:")]
+        self.assertEqual(len(commandMessages), 2)
+        self.assertIn(f"'--overlap', '{logic.previewOverlap}'", commandMessages[0])
+        self.assertNotIn("'--overlap'", commandMessages[1])
+        for name in ["needle", "urethra", "prostate"]:
+            self.assertIn(f"Using the {name} segmentation that is already computed", logMessages)
+
+        # Preview is imported into the output segmentation before the full-quality pass starts, then it is replaced
+        self.assertEqual(importedSegments, [(False, ["iceball"]), (True, ["iceball"])])
+
+        # Latencies of both results are reported
+        self.assertEqual(segmentationProcessInfo["procReturnCode"], 0)
+        self.assertIsNotNone(segmentationProcessInfo["previewTimeSec"])
+        self.assertEqual(len([message for message in logMessages if message.startswith("Latency of the preview:")]), 1)
+
+        self.delayDisplay("Progressive prediction test with models passed")
+
+    def test_PredictIceballBlockingProcess(self):
+        """Test that process() with waitForCompletion=True returns only when the processing is completed
+        (the result is available and the completed callback is already called), and that a failing model raises an exception.
+        Small test models are used, the input is a volume file, so that no scene nodes are needed.
+        """
+
+        self.delayDisplay("Starting blocking process test")
+
+        self._setupPythonRequirements()
+        import subprocess
+        import nrrd
+        import numpy as np
+
+        logic = PredictIceballLogic()
+        logic.modelRegistry, modelId = self._createTestModelPackage()
+        logic.logCallback = self._mylog
+        completedCalls = []
+        logic.processingCompletedCallback = lambda returnCode, customData: completedCalls.append((returnCode, customData))
+
+        testDir = slicer.util.tempDirectory()
+        imageFile = os.path.join(testDir, "image.nrrd")
+        nrrd.write(imageFile, self._createTestVolumeArray((48, 40, 24)).astype(np.float32),
+            {"space": "left-posterior-superior", "space directions": np.eye(3), "space origin": np.zeros(3)})
+
+        segmentationProcessInfo = logic.process([imageFile], None, modelId, cpu=True, waitForCompletion=True, customData="blocking")
+        self.assertEqual(completedCalls, [(0, "blocking")])
+        self.assertEqual(segmentationProcessInfo["procReturnCode"], 0)
+        self.assertIn("stopTime", segmentationProcessInfo)
+        self.assertEqual(segmentationProcessInfo["resultLabelmap"].shape, (48, 40, 24))
+        # Process output is read in the foreground, not by a background thread
+        self.assertNotIn("procThread", segmentationProcessInfo)
+
+        # Failure of the iceball model is reported to the caller
+        with open(logic.modelPath(modelId).joinpath("model.pt"), "w") as f:
+            f.write("not a model")
+        with self.assertRaises(subprocess.CalledProcessError):
+            logic.process([imageFile], None, modelId, cpu=True, waitForCompletion=True)
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Blocking process test passed")
+
+    def test_PredictIceballSeriesProcessing(self):
+        """Test processing of series (as in watch folder and batch processing) with small test models:
+        a DICOM series folder and a NRRD file of the same volume are passed to the inference scripts without loading them
+        into the scene, and they give the same segmentation file.
+        """
+
+        self.delayDisplay("Starting series processing test")
+
+        self._setupPythonRequirements()
+        import json
+        import nrrd
+        import numpy as np
+        from PredictIceballLib import FolderWatcher
+
+        logic = PredictIceballLogic()
+        logic.modelRegistry, modelId = self._createTestModelPackage()
+        logic.logCallback = self._mylog
+
+        testDir = slicer.util.tempDirectory()
+        directions = np.diag([0.8, 0.9, 2.5])
+        origin = np.array([10.0, -20.0, 30.0])
+        storedArray = self._createTestVolumeArray((48, 40, 24)).astype(np.int16)
+        nrrdFile = os.path.join(testDir, "series1.nrrd")
+        nrrd.write(nrrdFile, storedArray.astype(np.float32),
+            {"space": "left-posterior-superior", "space directions": directions.T, "space origin": origin})
+        dicomDir = os.path.join(testDir, "series2")
+        self._writeTestDicomSeries(dicomDir, storedArray, directions, origin)
+
+        numberOfNodes = slicer.mrmlScene.GetNumberOfNodes()
+        segmentations = []
+        for seriesPath in [nrrdFile, dicomDir]:
+            self.assertTrue(logic.processSeries(seriesPath, modelId, cpu=True))
+            segmentationFilePath, timingFilePath = FolderWatcher.resultPaths(seriesPath)
+            with open(timingFilePath) as f:
+                timing = json.load(f)
+            self.assertEqual(timing["status"], "completed")
+            segmentations.append(nrrd.read(segmentationFilePath))
+        # Series are not loaded into the scene
+        self.assertEqual(slicer.mrmlScene.GetNumberOfNodes(), numberOfNodes)
+
+        for array, header in segmentations:
+            self.assertEqual(header["Segment0_ID"], "iceball")
+            self.assertEqual(header["Segment0_LabelValue"], "1")
+            offset = [int(index) for index in header["Segmentation_ReferenceImageExtentOffset"].split()]
+            np.testing.assert_allclose(header["space origin"], origin + np.array(offset) @ directions.T, atol=1e-4)
+        np.testing.assert_array_equal(segmentations[0][0], segmentations[1][0])
+        self.assertEqual(segmentations[0][1]["Segmentation_ReferenceImageExtentOffset"], segmentations[1][1]["Segmentation_ReferenceImageExtentOffset"])
+
+        # Segmentation file is read by Slicer as a segmentation that has the geometry of the volume
+        segmentationNode = slicer.util.loadSegmentation(FolderWatcher.resultPaths(dicomDir)[0])
+        volumeNode = slicer.util.loadVolume(nrrdFile)
+        labels = np.zeros(storedArray.shape, dtype=np.uint8)
+        labels[tuple(slice(start, start + size) for start, size in zip(offset, segmentations[1][0].shape))] = segmentations[1][0]
+        np.testing.assert_array_equal(slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, "iceball", volumeNode),
+            np.transpose(labels, (2, 1, 0)))
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Series processing test passed")
+
+    def test_PredictIceballLayoutInference(self):
+        """Test that evaluating multiple probe layouts in one pass gives the same labels as evaluating each layout alone.
+        One of the layouts extends into the empty region of the image, so its foreground cropping box is different.
+        """
+
+        self.delayDisplay("Starting layout inference test")
+
+        self._setupPythonRequirements()
+        import nrrd
+        import numpy as np
+
+        volumeArray = self._createTestVolumeArray((48, 40, 24))
+        volumeArray[:14] = 0
+        volumeArray[:, :, :3] = 0
+        testDir, imageFile, header, modelFile = self._createTestInputs(volumeArray, directions=np.diag([0.8, 0.9, 2.5]), origin=[1.0, 2.0, 3.0])
+        layoutFiles = []
+        for layoutIndex, (region, label) in enumerate([
+                ((slice(20, 24), slice(18, 21), slice(8, 16)), 1),
+                ((slice(0, 4), slice(18, 21), slice(0, 16)), 1),
+                ((slice(26, 29), slice(10, 13), slice(5, 20)), 2)]):
+            layoutArray = np.zeros(volumeArray.shape, dtype=np.uint8)
+            layoutArray[region] = label
+            layoutFiles.append(os.path.join(testDir, f"layout{layoutIndex}.nrrd"))
+            nrrd.write(layoutFiles[-1], layoutArray, header)
+
+        resultFiles = [os.path.join(testDir, f"result{layoutIndex}.nrrd") for layoutIndex in range(len(layoutFiles))]
+        self._runScript("layout_inference.py", ["--model-file", modelFile, "--image-file", imageFile,
+            "--layout-files", ",".join(layoutFiles), "--result-files", ",".join(resultFiles)])
+        for layoutFile, resultFile in zip(layoutFiles, resultFiles):
+            singleResultFile = os.path.join(testDir, "single-result.nrrd")
+            self._runScript("layout_inference.py", ["--model-file", modelFile, "--image-file", imageFile,
+                "--layout-files", layoutFile, "--result-files", singleResultFile])
+            np.testing.assert_array_equal(nrrd.read(resultFile)[0], nrrd.read(singleResultFile)[0])
+
+        import shutil
+        shutil.rmtree(testDir)
+        self.delayDisplay("Layout inference test passed")
+
+    def _setupPythonRequirements(self):
+        logic = PredictIceballLogic()
+        logic.logCallback = self._mylog
+        logic.setupPythonRequirements()
+
+    def _importScript(self, scriptName):
+        """Import a module from the Scripts folder (they are normally run in a separate process)"""
+        import importlib
+        import sys
+        scriptsPath = os.path.join(os.path.dirname(slicer.modules.predicticeball.path), "Scripts")
+        if scriptsPath not in sys.path:
+            sys.path.insert(0, scriptsPath)
+        return importlib.import_module(scriptName)
+
+    def _runScript(self, scriptName, arguments):
+        """Run a script of the Scripts folder in a separate process, the same way as the logic runs it"""
+        import shutil
+        import subprocess
+        scriptPath = os.path.join(os.path.dirname(slicer.modules.predicticeball.path), "Scripts", scriptName)
+        result = subprocess.run([shutil.which("PythonSlicer"), scriptPath] + [str(argument) for argument in arguments],
+            capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout + result.stderr)
+        return result.stdout
+
+    def _createTestVolumeArray(self, shape, seed=0):
+        """Smooth random volume with a bright blob in the middle, so that it has foreground and background regions"""
+        import numpy as np
+        randomGenerator = np.random.default_rng(seed)
+        grid = np.meshgrid(*[np.linspace(-1.0, 1.0, size) for size in shape], indexing="ij")
+        blob = np.exp(-sum(coordinate ** 2 for coordinate in grid) * 4.0)
+        return np.round(1000.0 * blob + 50.0 * randomGenerator.random(shape))
+
+    def _createTestModelFile(self, modelFile, seed=0, **configOverrides):
+        """Create a small randomly initialized model, in the same checkpoint format as the models of this module"""
+        import torch
+        from monai.bundle import ConfigParser
+        config = {
+            "normalize_mode": "meanstd",
+            "intensity_bounds": [0, 1],
+            "roi_size": [32, 32, 32],
+            "orientation_ras": True,
+            "crop_foreground": True,
+            "resample_resolution": [1.0, 1.0, 1.0],
+            "network": {"_target_": "SegResNetDS", "init_filters": 8, "blocks_down": [1, 2, 2], "out_channels": 2,
+                "in_channels": 1, "dsdepth": 1},
+            }
+        config.update(configOverrides)
+        torch.manual_seed(seed)
+        network = ConfigParser(config["network"]).get_parsed_content()
+        torch.save({"config": config, "state_dict": network.state_dict()}, modelFile)
+        return modelFile
+
+    def _createTestInputs(self, volumeArray, directions=None, origin=None, **modelConfigOverrides):
+        """Create a temporary folder with the volume written to image.nrrd (IJK voxel order, LPS coordinate system)
+        and a small test model in model.pt.
+        :return: testDir, imageFile, header, modelFile
+        """
+        import nrrd
+        import numpy as np
+        testDir = slicer.util.tempDirectory()
+        header = {
+            "space": "left-posterior-superior",
+            "space directions": np.eye(3) if directions is None else np.array(directions, dtype=float),
+            "space origin": np.zeros(3) if origin is None else np.array(origin, dtype=float),
+            }
+        imageFile = os.path.join(testDir, "image.nrrd")
+        nrrd.write(imageFile, volumeArray.astype(np.float32), header)
+        modelFile = self._createTestModelFile(os.path.join(testDir, "model.pt"), **modelConfigOverrides)
+        return testDir, imageFile, header, modelFile
+
+    def _predict(self, modelFile, imageFile, resultFile, options=None):
+        """Run the inference script and read the result.
+        :return: labels (IJK voxel order), result header, script output
+        """
+        import nrrd
+        output = self._runScript("auto3dseg_segresnet_inference.py", ["--model-file", modelFile, "--image-file", imageFile,
+            "--result-file", resultFile] + list(options or []))
+        labels, header = nrrd.read(resultFile)
+        return labels, header, output
+
+    def _writeTestDicomSeries(self, dicomDir, storedArray, directions, origin, rescaleSlope=1.0, rescaleIntercept=0.0):
+        """Write a volume (int16 stored values, IJK voxel order) as a DICOM series.
+        Slices are written in random order, half of them into a subfolder, and a file that is not DICOM is added.
+        :param directions: IJK to LPS axis vectors (columns), with spacing
+        """
+        import random
+        import numpy as np
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+        os.makedirs(os.path.join(dicomDir, "subfolder"))
+        with open(os.path.join(dicomDir, "readme.txt"), "w") as f:
+            f.write("Not a DICOM file")
+        spacing = np.linalg.norm(directions, axis=0)
+        seriesInstanceUid = generate_uid()
+        sliceIndices = list(range(storedArray.shape[2]))
+        random.Random(0).shuffle(sliceIndices)
+        for fileIndex, k in enumerate(sliceIndices):
+            fileMeta = FileMetaDataset()
+            fileMeta.TransferSyntaxUID = ExplicitVRLittleEndian
+            fileMeta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+            fileMeta.MediaStorageSOPInstanceUID = generate_uid()
+            dataset = Dataset()
+            dataset.file_meta = fileMeta
+            dataset.SOPClassUID = fileMeta.MediaStorageSOPClassUID
+            dataset.SOPInstanceUID = fileMeta.MediaStorageSOPInstanceUID
+            dataset.SeriesInstanceUID = seriesInstanceUid
+            dataset.ImageOrientationPatient = list(directions[:, 0] / spacing[0]) + list(directions[:, 1] / spacing[1])
+            dataset.ImagePositionPatient = list(np.asarray(origin) + directions[:, 2] * k)
+            dataset.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+            dataset.Rows, dataset.Columns = storedArray.shape[1], storedArray.shape[0]
+            dataset.BitsAllocated, dataset.BitsStored, dataset.HighBit, dataset.PixelRepresentation = 16, 16, 15, 1
+            dataset.SamplesPerPixel = 1
+            dataset.PhotometricInterpretation = "MONOCHROME2"
+            dataset.RescaleSlope, dataset.RescaleIntercept = rescaleSlope, rescaleIntercept
+            dataset.PixelData = np.ascontiguousarray(storedArray[:, :, k].T).tobytes()
+            subfolder = "subfolder" if fileIndex % 2 else ""
+            dataset.save_as(os.path.join(dicomDir, subfolder, f"{fileIndex:04d}.dcm"), enforce_file_format=True)
+
+    def _createTestModelPackage(self):
+        """Create a temporary models folder with a registered model package of small test models
+        (needle, urethra and prostate models, and the iceball model) and labels.csv with a single iceball label.
+        :return: model registry of the models folder, model ID
+        """
+        import pathlib
+        from PredictIceballLib import ModelRegistry
+        modelsPath = pathlib.Path(slicer.util.tempDirectory())
+        modelId = "test-iceball-v1.0.0"
+        modelDir = modelsPath.joinpath(modelId)
+        modelDir.mkdir()
+        for seed, modelFileName in enumerate(["needle_model.pt", "urethra_model.pt", "prostatemodel.pt", "model.pt"]):
+            self._createTestModelFile(str(modelDir.joinpath(modelFileName)), seed=seed)
+        codeSequences = ["SegmentedPropertyCategoryCodeSequence", "SegmentedPropertyTypeCodeSequence",
+            "SegmentedPropertyTypeModifierCodeSequence", "AnatomicRegionSequence", "AnatomicRegionModifierSequence"]
+        with open(modelDir.joinpath("labels.csv"), "w") as f:
+            f.write(",".join(["LabelValue", "Name"] + [f"{codeSequence}.{fieldName}" for codeSequence in codeSequences
+                for fieldName in ["CodingSchemeDesignator", "CodeValue", "CodeMeaning"]]) + "\n")
+            f.write("1,iceball,SCT,49755003,Morphologically Altered Structure,SCT,367643001,Cyst,,,,SCT,41216001,Prostate,,,\n")
+        modelRegistry = ModelRegistry(modelsPath)
+        modelRegistry.register(modelId, "1.0.0", modelDir)
+        return modelRegistry, modelId
+
     def _mylog(self,text):
         print(text)
 
@@ -0,0 +1,9 @@
+from .log_handler import LogSink
+from .model_download import ModelDownloader
+from .model_registry import ModelRegistry
+from .dependency_handler import DependencyChecker
+from .folder_watcher import FolderWatcher
+from .probe_rasterizer import ProbeRasterizer
+from .terminology_index import TerminologyIndex
+from .cropped_labelmap import CroppedLabelmap
+from .inference_worker import InferenceWorker
@@ -0,0 +1,83 @@
+class CroppedLabelmap:
+    """Labelmap that only stores the voxels of a box in a full volume (IJK voxel order).
+
+    Segmentation results of the inference scripts only contain the bounding box of the nonzero voxels
+    (see write_labelmap in Scripts/auto3dseg_segresnet_inference.py). The NRRD file has "space origin" at the first voxel
+    of the box, and the "crop_offset" and "uncropped_sizes" fields specify the position of the box and the size
+    of the full volume. Labelmaps are processed and imported into segments in this form, so that memory usage
+    and processing time scale with the size of the structure instead of the size of the volume.
+    numpy is only imported in the methods, as this module is imported at application startup.
+    """
+
+    def __init__(self, array, offset=None, shape=None, header=None):
+        """
+        :param array: voxels of the box (IJK voxel order)
+        :param offset: index of the first voxel of the box in the full volume (default: origin of the full volume)
+        :param shape: size of the full volume (default: size of the array)
+        :param header: NRRD header of the full volume (geometry is used for writing the labelmap to file)
+        """
+        import numpy as np
+        self.array = array
+        self.offset = np.zeros(3, dtype=int) if offset is None else np.array(offset, dtype=int)
+        self.shape = tuple(int(size) for size in (array.shape if shape is None else shape))
+        self.header = header
+        if np.any(self.offset < 0) or np.any(self.offset + array.shape > np.array(self.shape)):
+            raise ValueError(f"Box of size {array.shape} at offset {list(self.offset)} is outside the volume of size {self.shape}")
+
+    @classmethod
+    def read(cls, filePath):
+        """Read a labelmap file written by the inference scripts (cropped or not)"""
+        import nrrd
+        import numpy as np
+        array, header = nrrd.read(str(filePath))
+        if "crop_offset" not in header:
+            return cls(array, header=header)
+        offset = [int(value) for value in header.pop("crop_offset").split()]
+        shape = [int(value) for value in header.pop("uncropped_sizes").split()]
+        # Geometry of the full volume
+        header["space origin"] = np.asarray(header["space origin"], dtype=float) - np.array(offset) @ np.asarray(header["space directions"], dtype=float)
+        return cls(array, offset, shape, header)
+
+    def region(self):
+        """Get the box in the full volume (tuple of slices)"""
+        return tuple(slice(int(start), int(start) + size) for start, size in zip(self.offset, self.array.shape))
+
+    def toArray(self):
+        """Get the labelmap in the full volume"""
+        import numpy as np
+        fullArray = np.zeros(self.shape, dtype=self.array.dtype)
+        fullArray[self.region()] = self.array
+        return fullArray
+
+    def arrayInRegion(self, region):
+        """Get the labelmap in another box of the full volume (tuple of slices), voxels outside of this box are 0"""
+        import numpy as np
+        regionArray = np.zeros(tuple(item.stop - item.start for item in region), dtype=self.array.dtype)
+        overlapStart = [max(item.start, int(start)) for item, start in zip(region, self.offset)]
+        overlapStop = [min(item.stop, int(start) + size) for item, start, size in zip(region, self.offset, self.array.shape)]
+        if any(stop <= start for start, stop in zip(overlapStart, overlapStop)):
+            return regionArray
+        regionArray[tuple(slice(start - item.start, stop - item.start) for item, start, stop in zip(region, overlapStart, overlapStop))] = (
+            self.array[tuple(slice(start - int(offset), stop - int(offset)) for offset, start, stop in zip(self.offset, overlapStart, overlapStop))])
+        return regionArray
+
+    def cropped(self):
+        """Get the labelmap cropped to the bounding box of its nonzero voxels (empty labelmap is cropped to a single voxel)"""
+        import numpy as np
+        ranges = []
+        for axis in range(3):
+            indices = np.flatnonzero(self.array.any(axis=tuple(other for other in range(3) if other != axis)))
+            ranges.append((indices[0], indices[-1] + 1) if len(indices) else (0, 1))
+        array = self.array[tuple(slice(start, stop) for start, stop in ranges)]
+        return CroppedLabelmap(array, self.offset + [start for start, stop in ranges], self.shape, self.header)
+
+    def write(self, filePath, compress=False):
+        """Write the labelmap to file, in the same format as the inference scripts write it"""
+        import nrrd
+        import numpy as np
+        header = dict(self.header)
+        header["space origin"] = np.asarray(header["space origin"], dtype=float) + self.offset @ np.asarray(header["space directions"], dtype=float)
+        header["crop_offset"] = " ".join(str(int(index)) for index in self.offset)
+        header["uncropped_sizes"] = " ".join(str(size) for size in self.shape)
+        header["encoding"] = "gzip" if compress else "raw"
+        nrrd.write(str(filePath), np.ascontiguousarray(self.array), header)
@@ -0,0 +1,71 @@
+import json
+import os
+import sys
+
+
+class DependencyChecker:
+    """Checks if required Python packages are installed, without running pip.
+
+    Installed distributions and versions are checked using package metadata (importlib.metadata).
+    Successful result is stored in a cache file, together with a fingerprint of the Python environment
+    (interpreter, requirements, and modification time of package folders). As long as the fingerprint
+    does not change, the check is just reading a small file.
+    """
+
+    def __init__(self, requirements, cacheFilePath):
+        """
+        :param requirements: list of requirement specifiers, such as "monai>=1.3"
+        :param cacheFilePath: file where the check result is stored
+        """
+        self.requirements = requirements
+        self.cacheFilePath = cacheFilePath
+
+    def environmentFingerprint(self):
+        """String that changes when packages are installed, removed, or upgraded in the Python environment."""
+        import hashlib
+        sitePackagesFolders = sorted(set(path for path in sys.path if os.path.basename(path) == "site-packages" and os.path.isdir(path)))
+        items = [sys.executable, sys.version] + sorted(self.requirements)
+        for folder in sitePackagesFolders:
+            # Installing or removing a package adds or removes a *.dist-info folder, which changes the folder modification time
+            items.append(f"{folder}:{os.stat(folder).st_mtime_ns}")
+        return hashlib.sha256("\n".join(items).encode()).hexdigest()
+
+    def missingRequirements(self):
+        """Return list of requirements that are not installed or the installed version is not compatible."""
+        import importlib.metadata
+        from packaging.requirements import Requirement
+        missing = []
+        for requirementStr in self.requirements:
+            requirement = Requirement(requirementStr)
+            try:
+                installedVersion = importlib.metadata.version(requirement.name)
+            except importlib.metadata.PackageNotFoundError:
+                missing.append(requirementStr)
+                continue
+            if not requirement.specifier.contains(installedVersion, prereleases=True):
+                missing.append(requirementStr)
+        return missing
+
+    def _readCache(self):
+        try:
+            with open(self.cacheFilePath, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _writeCache(self, fingerprint):
+        os.makedirs(os.path.dirname(self.cacheFilePath), exist_ok=True)
+        tempFilePath = f"{self.cacheFilePath}.{os.getpid()}.tmp"
+        with open(tempFilePath, "w", encoding="utf-8") as f:
+            json.dump({"fingerprint": fingerprint, "requirements": self.requirements}, f, indent=2)
+        os.replace(tempFilePath, self.cacheFilePath)
+
+    def isReady(self):
+        """Returns True if all requirements are satisfied. Result is cached for the current environment."""
+        fingerprint = self.environmentFingerprint()
+        if self._readCache().get("fingerprint") == fingerprint:
+            return True
+        if self.missingRequirements():
+            return False
+        self._writeCache(fingerprint)
+        return True
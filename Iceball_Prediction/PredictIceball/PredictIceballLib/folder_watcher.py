@@ -0,0 +1,126 @@
+import os
+import time
+
+
+class FolderWatcher:
+    """Finds new input series in a folder, for example a network folder where the scanner console pushes each new series.
+
+    A series is a volume file directly in the folder (such as .nrrd or .nii.gz) or a subfolder (such as a DICOM series).
+    Files may be still being written when they are first seen, therefore a series is only reported as ready
+    when none of its files has changed (number of files, size, or modification time) for settleTimeSec.
+    Temporary and hidden files, and result files written next to the inputs, are ignored.
+
+    The folder is polled (not watched using file system notifications), because notifications
+    are not reliable on network folders.
+    """
+
+    VOLUME_EXTENSIONS = (".nrrd", ".nhdr", ".nii", ".nii.gz", ".mha", ".mhd")
+    IGNORED_SUFFIXES = (".tmp", ".part", ".partial", ".crdownload", "~")
+    RESULT_SUFFIXES = ("-iceball.seg.nrrd", "-timing.json")
+
+    def __init__(self, folderPath, settleTimeSec=5.0):
+        self.folderPath = folderPath
+        self.settleTimeSec = settleTimeSec
+        # Series path -> (signature, time when the signature last changed)
+        self._pending = {}
+        # Series path -> signature when it was processed
+        self._processed = {}
+
+    @staticmethod
+    def resultPaths(seriesPath):
+        """Get paths of (segmentation file, timing report file) that are written next to the series"""
+        basePath = seriesPath.rstrip("/\\")
+        for extension in FolderWatcher.VOLUME_EXTENSIONS:
+            if basePath.lower().endswith(extension):
+                basePath = basePath[:-len(extension)]
+                break
+        return tuple(basePath + suffix for suffix in FolderWatcher.RESULT_SUFFIXES)
+
+    @staticmethod
+    def _isIgnored(name):
+        lowerName = name.lower()
+        return (name.startswith(".") or lowerName.endswith(FolderWatcher.IGNORED_SUFFIXES)
+            or lowerName.endswith(FolderWatcher.RESULT_SUFFIXES))
+
+    def seriesPaths(self):
+        """Get paths of all series that are currently in the folder"""
+        paths = []
+        for entry in os.scandir(self.folderPath):
+            if FolderWatcher._isIgnored(entry.name):
+                continue
+            if entry.is_dir() or entry.name.lower().endswith(FolderWatcher.VOLUME_EXTENSIONS):
+                paths.append(entry.path)
+        return sorted(paths)
+
+    @staticmethod
+    def signature(seriesPath):
+        """Get (file count, total size, latest modification time) of a series, it changes whenever a file is added or written"""
+        if os.path.isfile(seriesPath):
+            try:
+                stat = os.stat(seriesPath)
+            except FileNotFoundError:
+                return None
+            return (1, stat.st_size, stat.st_mtime_ns)
+        fileCount = 0
+        totalSize = 0
+        latestModifiedTime = 0
+        for folderPath, folderNames, fileNames in os.walk(seriesPath):
+            for fileName in fileNames:
+                if FolderWatcher._isIgnored(fileName):
+                    # Temporary file, the series is still being written
+                    return None
+                try:
+                    stat = os.stat(os.path.join(folderPath, fileName))
+                except FileNotFoundError:
+                    # File was renamed or removed since the folder was listed
+                    return None
+                fileCount += 1
+                totalSize += stat.st_size
+                latestModifiedTime = max(latestModifiedTime, stat.st_mtime_ns)
+        return (fileCount, totalSize, latestModifiedTime) if fileCount else None
+
+    def poll(self, currentTime=None):
+        """Check the folder for changes.
+        Returns (new series, ready series): new series appeared since the previous poll (their files may be incomplete),
+        ready series have not changed for settleTimeSec and have not been processed yet.
+        A series is processed again if its files are modified after it was processed.
+        """
+        if currentTime is None:
+            currentTime = time.time()
+        newSeries = []
+        readySeries = []
+        currentPaths = set()
+        for seriesPath in self.seriesPaths():
+            currentPaths.add(seriesPath)
+            signature = FolderWatcher.signature(seriesPath)
+            if seriesPath in self._processed and self._processed[seriesPath] == signature:
+                continue
+            pending = self._pending.get(seriesPath)
+            if pending is None:
+                newSeries.append(seriesPath)
+            if pending is None or pending[0] != signature:
+                self._pending[seriesPath] = (signature, currentTime)
+                continue
+            if signature is not None and currentTime - pending[1] >= self.settleTimeSec:
+                readySeries.append(seriesPath)
+        # Forget series that have been removed
+        for seriesPath in list(self._pending.keys()):
+            if seriesPath not in currentPaths:
+                del self._pending[seriesPath]
+        return newSeries, readySeries
+
+    def pendingSeries(self):
+        """Get (series path, signature, time when the signature last changed) of series that have files and are not processed yet"""
+        return [(seriesPath, signature, changedTime) for seriesPath, (signature, changedTime) in sorted(self._pending.items())
+            if signature is not None]
+
+    def markProcessed(self, seriesPath):
+        """Mark series as processed, so that it is not reported as ready again (until it is modified)"""
+        pending = self._pending.pop(seriesPath, None)
+        self._processed[seriesPath] = pending[0] if pending else FolderWatcher.signature(seriesPath)
+
+    def skipExisting(self):
+        """Mark all series that already have a result next to them as processed"""
+        for seriesPath in self.seriesPaths():
+            if os.path.exists(FolderWatcher.resultPaths(seriesPath)[0]):
+                self._processed[seriesPath] = FolderWatcher.signature(seriesPath)
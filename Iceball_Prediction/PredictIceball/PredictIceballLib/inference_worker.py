@@ -0,0 +1,159 @@
+import queue
+import threading
+
+
+class InferenceWorker:
+    """Client of a persistent inference process (Scripts/inference_worker.py) that keeps the models loaded between runs.
+
+    Running a model in a new process takes several seconds more than the inference itself (importing torch and MONAI,
+    loading the model). When many inputs are processed one after the other (for example each new series in a watched
+    folder), the worker runs the inference script for each of them in the same process instead.
+
+    Requests are sent over a local connection with a random authentication key, not through the standard input,
+    because the Python launcher does not forward its standard input to the Python process on all platforms.
+    Output of the process is read by a background thread and passed to the log callback while a request is running.
+    """
+
+    ADDRESS_PREFIX = "INFERENCE_WORKER_ADDRESS"
+    AUTHKEY_ENVIRONMENT_VARIABLE = "PREDICTICEBALL_WORKER_AUTHKEY"
+
+    def __init__(self, launchProcess, startupTimeoutSec=300.0):
+        """
+        :param launchProcess: function(command, environment) that starts a process with a command (list of str) and additional
+          environment variables (dict), and returns a Popen object with text standard output that includes the standard error
+          (for example slicer.util.launchConsoleProcess)
+        :param startupTimeoutSec: maximum time to wait for the process to report its address
+        """
+        self.launchProcess = launchProcess
+        self.startupTimeoutSec = startupTimeoutSec
+        self.proc = None
+        self.connection = None
+        self._outputQueue = queue.Queue()
+        # Number of sent requests whose response has not been received yet
+        self._pendingResponses = 0
+
+    def start(self, command, environment=None, logCallback=None):
+        """Start the worker process and connect to it. RuntimeError is raised if the process does not start."""
+        import secrets
+        import time
+        from multiprocessing.connection import Client
+        self.stop()
+        authkey = secrets.token_bytes(32)
+        environment = dict(environment) if environment else {}
+        environment[InferenceWorker.AUTHKEY_ENVIRONMENT_VARIABLE] = authkey.hex()
+        self.proc = self.launchProcess(command, environment)
+        self._outputQueue = queue.Queue()
+        threading.Thread(target=InferenceWorker._readOutput, args=[self.proc, self._outputQueue], daemon=True).start()
+        startTime = time.time()
+        while True:
+            try:
+                line = self._outputQueue.get(timeout=0.1)
+            except queue.Empty:
+                if self.proc.poll() is not None:
+                    returnCode = self.proc.returncode
+                    self.stop()
+                    raise RuntimeError(f"Inference worker exited during startup (return code {returnCode})")
+                if time.time() - startTime > self.startupTimeoutSec:
+                    self.stop()
+                    raise RuntimeError(f"Inference worker did not start in {self.startupTimeoutSec:.0f} seconds")
+                continue
+            if line.startswith(InferenceWorker.ADDRESS_PREFIX):
+                host, port = line[len(InferenceWorker.ADDRESS_PREFIX):].strip().rsplit(":", 1)
+                self.connection = Client((host, int(port)), authkey=authkey)
+                return
+            if logCallback:
+                logCallback(line)
+
+    def isRunning(self):
+        return self.connection is not None and self.proc is not None and self.proc.poll() is None
+
+    def loadModels(self, modelFiles):
+        """Load models in the worker in advance. Does not wait for the loading, the next run() waits for it."""
+        self._send({"load_models": [str(modelFile) for modelFile in modelFiles]})
+
+    def run(self, args, logCallback=None):
+        """Run the inference script with command-line arguments (list of str, without the script path) and wait for its completion.
+        Output is passed to logCallback. Returns the return code (0 = success).
+        RuntimeError is raised if the worker process exits, the worker is stopped then.
+        """
+        self._send({"args": [str(arg) for arg in args]})
+        response = None
+        while self._pendingResponses:
+            response = self._receive(logCallback)
+            self._pendingResponses -= 1
+        if response.get("error") and logCallback:
+            logCallback(f"Inference worker: {response['error']}")
+        return response["returnCode"]
+
+    def stop(self, timeoutSec=10.0):
+        """Stop the worker process. It exits when the connection is closed, it is terminated if it does not exit in timeoutSec."""
+        import subprocess
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+            self.connection = None
+        if self.proc is not None:
+            try:
+                self.proc.wait(timeoutSec)
+            except subprocess.TimeoutExpired:
+                # Stopping only the launcher would leave the Python process running
+                import psutil
+                try:
+                    psProcess = psutil.Process(self.proc.pid)
+                    for psChildProcess in psProcess.children(recursive=True):
+                        psChildProcess.terminate()
+                    psProcess.terminate()
+                except psutil.NoSuchProcess:
+                    # Already exited
+                    pass
+                self.proc.wait()
+            self.proc = None
+        self._pendingResponses = 0
+
+    def _send(self, request):
+        if not self.isRunning():
+            raise RuntimeError("Inference worker is not running")
+        self.connection.send(request)
+        self._pendingResponses += 1
+
+    def _receive(self, logCallback):
+        import time
+        while True:
+            self._forwardOutput(logCallback)
+            try:
+                if self.connection.poll(0.1):
+                    response = self.connection.recv()
+                    break
+            except (EOFError, OSError):
+                # Connection is closed, the process is exiting
+                time.sleep(0.1)
+            if self.proc.poll() is not None:
+                self._forwardOutput(logCallback)
+                returnCode = self.proc.returncode
+                self.stop()
+                raise RuntimeError(f"Inference worker exited (return code {returnCode})")
+        self._forwardOutput(logCallback)
+        return response
+
+    def _forwardOutput(self, logCallback):
+        while True:
+            try:
+                line = self._outputQueue.get_nowait()
+            except queue.Empty:
+                return
+            if logCallback:
+                logCallback(line)
+
+    @staticmethod
+    def _readOutput(proc, outputQueue):
+        while True:
+            try:
+                line = proc.stdout.readline()
+                if not line:
+                    break
+                outputQueue.put(line.rstrip())
+            except UnicodeDecodeError:
+                # Same as for other processes, only UTF8 locale is supported, lines that cannot be decoded are discarded
+                pass
@@ -0,0 +1,106 @@
+import collections
+import re
+
+
+class LogSink:
+    """Collects log lines and hands them over to the GUI in frames.
+
+    Writing to the status panel and processing events for each log line is expensive when a process
+    reports progress (tqdm sliding window progress, model download) hundreds of times.
+    Lines are collected here and the GUI only needs to render them once per frame (see takeFrame()).
+
+    Progress updates are collapsed into a single line: a line that ends with a carriage return
+    or a line that only differs in numbers and progress bar characters from the previous progress line
+    replaces that line instead of being appended.
+
+    The number of lines that are kept is limited by maxLines.
+    """
+
+    # Characters that tqdm uses for drawing the progress bar
+    PROGRESS_BAR_CHARACTERS = " #|▏▎▍▌▋▊▉█"
+
+    def __init__(self, maxLines=2000):
+        self.maxLines = maxLines
+        self.clear()
+
+    def clear(self):
+        self.lines = collections.deque(maxlen=self.maxLines)
+        # Key of the progress line that is currently displayed as last line (None if the last line is not a progress line)
+        self._lastProgressKey = None
+        # Last line is not terminated yet (carriage return was received), next text replaces it
+        self._lastLineOpen = False
+        # Lines added since last frame
+        self._pendingLines = []
+        # If True then the last line that was already rendered has been changed, it has to be replaced by the first pending line
+        self._replaceRenderedLastLine = False
+        # If True then the full text has to be rendered again (the log was cleared)
+        self._resetRequired = True
+
+    def write(self, text):
+        """Add text to the log. Text may contain multiple lines, separated by newline or carriage return characters."""
+        text = str(text)
+        # Normalize line endings
+        text = text.replace("\r\n", "\n")
+        if text.endswith("\n"):
+            text = text[:-1]
+        for line in text.split("\n"):
+            lineOpen = line.endswith("\r")
+            if "\r" in line:
+                # Carriage return: only the last non-empty segment of the line remains visible
+                segments = [segment for segment in line.split("\r") if segment]
+                line = segments[-1] if segments else ""
+            self._addLine(line, lineOpen)
+
+    def _addLine(self, line, lineOpen=False):
+        if not line and lineOpen:
+            # Only a carriage return, keep the previous line visible but replace it with the next text
+            self._lastLineOpen = bool(self.lines)
+            return
+        progressKey = LogSink.progressKey(line)
+        replaceLast = self.lines and (self._lastLineOpen
+            or (progressKey is not None and progressKey == self._lastProgressKey))
+        if replaceLast:
+            self.lines[-1] = line
+            if self._pendingLines:
+                self._pendingLines[-1] = line
+            else:
+                # Already rendered line is changed, only that line has to be rendered again
+                self._pendingLines.append(line)
+                self._replaceRenderedLastLine = True
+        else:
+            self.lines.append(line)
+            self._pendingLines.append(line)
+        self._lastProgressKey = progressKey
+        self._lastLineOpen = lineOpen
+
+    @staticmethod
+    def progressKey(line):
+        """Get a string that identifies the progress reporting stream of a line.
+        Returns None if the line does not look like a progress report.
+        """
+        if "%" not in line:
+            return None
+        key = re.sub(r"\d+(\.\d+)?", "", line)
+        return "".join(character for character in key if character not in LogSink.PROGRESS_BAR_CHARACTERS)
+
+    def takeFrame(self):
+        """Get changes since the last frame.
+
+        Returns None if there is no change. Otherwise it returns a (reset, replaceLastLine, lines) tuple.
+        If reset is True then the displayed text must be replaced by lines (complete scrollback).
+        Otherwise, if replaceLastLine is True then the last displayed line must be replaced by the first line
+        (for example, by an updated progress line), and the other lines must be appended to the displayed text.
+        """
+        if self._resetRequired:
+            self._resetRequired = False
+            self._replaceRenderedLastLine = False
+            self._pendingLines = []
+            return True, False, list(self.lines)
+        if not self._pendingLines:
+            return None
+        # Lines that do not fit into the scrollback would be removed by the GUI anyway
+        replaceLastLine = self._replaceRenderedLastLine and len(self._pendingLines) <= self.maxLines
+        lines = self._pendingLines[-self.maxLines:]
+        self._pendingLines = []
+        self._replaceRenderedLastLine = False
+        return False, replaceLastLine, lines
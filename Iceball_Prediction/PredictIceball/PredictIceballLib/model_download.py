@@ -0,0 +1,172 @@
+import logging
+import os
+import pathlib
+import shutil
+
+
+class ModelDownloader:
+    """Downloads and installs model packages.
+
+    Download is resumable: data is written to a partial file next to the models folder,
+    and if the download is interrupted then the next attempt requests only the missing
+    bytes (using HTTP range request). Downloaded file is verified by its SHA-256 hash (if known),
+    extracted to a staging folder, and the staging folder is renamed to the final model folder.
+    The rename is the commit point: the model folder either contains a complete model or does not exist.
+    An existing model folder is renamed aside before the staging folder is moved into its place, and it is only
+    deleted after that, so a failure at any step leaves either the previous or the new model in place.
+    """
+
+    def __init__(self, modelsPath, logCallback=None):
+        self.modelsPath = pathlib.Path(modelsPath)
+        self.logCallback = logCallback
+        self.chunkSize = 1024 * 1024
+        self.reportingIncrementPercent = 1.0
+        self.reportingIncrementBytes = 10 * 1024 * 1024
+        self.timeoutSec = 60
+
+    def log(self, text):
+        if self.logCallback:
+            self.logCallback(text)
+        else:
+            logging.info(text)
+
+    def downloadFolderPath(self):
+        return self.modelsPath.joinpath(".download")
+
+    def partialDownloadFilePath(self, modelName):
+        return self.downloadFolderPath().joinpath(f"{modelName}.zip.part")
+
+    def stagingFolderPath(self, modelName):
+        return self.downloadFolderPath().joinpath(f"{modelName}.staging")
+
+    def replacedFolderPath(self, modelName):
+        """Folder where the previously installed model is moved while the new model is moved into its place"""
+        return self.downloadFolderPath().joinpath(f"{modelName}.replaced")
+
+    def install(self, modelName, url, sha256=None):
+        """Download model package from url and install it into modelsPath/modelName.
+        Returns path of the installed model folder.
+        """
+        modelDir = self.modelsPath.joinpath(modelName)
+        partialFilePath = self.partialDownloadFilePath(modelName)
+        os.makedirs(partialFilePath.parent, exist_ok=True)
+
+        self.log(f"Downloading model '{modelName}' from {url}...")
+        self.downloadFile(url, partialFilePath)
+
+        if sha256:
+            self.log("Verifying downloaded file...")
+            actualSha256 = ModelDownloader.fileSha256(partialFilePath)
+            if actualSha256.lower() != sha256.lower():
+                # Corrupted or incorrect file, it must not be resumed next time
+                os.remove(partialFilePath)
+                raise RuntimeError(f"Downloaded model file is corrupted (SHA-256 is {actualSha256}, expected {sha256})")
+        else:
+            # Log the checksum, so that it can be added to the model description after the file is checked
+            self.log(f"Checksum of the model file is not specified, skipping verification (SHA-256 of the downloaded file is {ModelDownloader.fileSha256(partialFilePath)}).")
+
+        stagingDir = self.stagingFolderPath(modelName)
+        self.log(f"Download finished. Extracting to {modelDir}...")
+        if stagingDir.exists():
+            shutil.rmtree(stagingDir)
+        try:
+            ModelDownloader.extractZip(partialFilePath, stagingDir)
+            ModelDownloader.replaceFolder(stagingDir, modelDir, self.replacedFolderPath(modelName))
+        finally:
+            if stagingDir.exists():
+                shutil.rmtree(stagingDir)
+
+        os.remove(partialFilePath)
+        return modelDir
+
+    @staticmethod
+    def replaceFolder(sourceDir, targetDir, replacedDir):
+        """Move sourceDir to targetDir, replacing the current content of targetDir.
+        The current targetDir is renamed to replacedDir first (on the same file system), and it is deleted only after
+        sourceDir is moved into its place. If the move fails then the previous targetDir is restored.
+        """
+        if replacedDir.exists():
+            # Left over from an interrupted replacement
+            shutil.rmtree(replacedDir)
+        if targetDir.exists():
+            os.replace(targetDir, replacedDir)
+        try:
+            os.replace(sourceDir, targetDir)
+        except Exception:
+            if replacedDir.exists() and not targetDir.exists():
+                os.replace(replacedDir, targetDir)
+            raise
+        if replacedDir.exists():
+            shutil.rmtree(replacedDir)
+
+    def downloadFile(self, url, filePath):
+        """Download url into filePath. If filePath already exists then the download is resumed."""
+        import requests
+
+        filePath = pathlib.Path(filePath)
+        downloadedSize = filePath.stat().st_size if filePath.exists() else 0
+        headers = {"Range": f"bytes={downloadedSize}-"} if downloadedSize else {}
+
+        with requests.get(url, stream=True, headers=headers, timeout=self.timeoutSec) as r:
+            if downloadedSize and r.status_code == 416:
+                # Requested range not satisfiable: the partial file is already complete
+                self.log(f"Model file has been already downloaded ({downloadedSize/1024/1024:.1f}MB)")
+                return
+            r.raise_for_status()
+            if downloadedSize and r.status_code == 206:
+                self.log(f"Resuming download from {downloadedSize/1024/1024:.1f}MB")
+                mode = "ab"
+            else:
+                # Server does not support range requests (or nothing has been downloaded yet), start from the beginning
+                downloadedSize = 0
+                mode = "wb"
+            contentLength = int(r.headers.get("content-length", 0))
+            totalSize = downloadedSize + contentLength if contentLength else 0
+
+            lastReportedDownloadPercent = -self.reportingIncrementPercent
+            lastReportedDownloadSize = downloadedSize
+            with open(filePath, mode) as f:
+                for chunk in r.iter_content(chunk_size=self.chunkSize):
+                    f.write(chunk)
+                    downloadedSize += len(chunk)
+                    if totalSize:
+                        downloadedPercent = 100.0 * downloadedSize / totalSize
+                        if downloadedPercent - lastReportedDownloadPercent > self.reportingIncrementPercent:
+                            self.log(f"Downloading model: {downloadedSize/1024/1024:.1f}MB / {totalSize/1024/1024:.1f}MB ({downloadedPercent:.1f}%)")
+                            lastReportedDownloadPercent = downloadedPercent
+                    elif downloadedSize - lastReportedDownloadSize > self.reportingIncrementBytes:
+                        # Total size is unknown, only report downloaded size
+                        self.log(f"Downloading model: {downloadedSize/1024/1024:.1f}MB")
+                        lastReportedDownloadSize = downloadedSize
+
+        if totalSize and downloadedSize < totalSize:
+            raise RuntimeError(f"Download of {url} is incomplete ({downloadedSize} of {totalSize} bytes), try again to resume")
+
+    @staticmethod
+    def fileSha256(filePath, chunkSize=1024 * 1024):
+        import hashlib
+        sha256 = hashlib.sha256()
+        with open(filePath, "rb") as f:
+            for chunk in iter(lambda: f.read(chunkSize), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def extractZip(zipFilePath, outputDir, chunkSize=1024 * 1024):
+        """Extract zip file member by member, without loading any file content into memory at once."""
+        import zipfile
+        outputDir = pathlib.Path(outputDir)
+        outputDirResolved = outputDir.resolve()
+        os.makedirs(outputDir, exist_ok=True)
+        with zipfile.ZipFile(zipFilePath, "r") as zipFile:
+            for member in zipFile.infolist():
+                targetPath = outputDir.joinpath(member.filename)
+                # Do not allow writing outside of the output folder
+                if outputDirResolved not in targetPath.resolve().parents and targetPath.resolve() != outputDirResolved:
+                    raise RuntimeError(f"Invalid file path in model package: {member.filename}")
+                if member.is_dir():
+                    os.makedirs(targetPath, exist_ok=True)
+                    continue
+                os.makedirs(targetPath.parent, exist_ok=True)
+                with zipFile.open(member) as source, open(targetPath, "wb") as target:
+                    shutil.copyfileobj(source, target, chunkSize)
@@ -0,0 +1,221 @@
+import contextlib
+import json
+import os
+import pathlib
+import time
+
+
+class ModelRegistry:
+    """Keeps track of installed models in a JSON manifest file in the models folder.
+
+    The manifest stores for each installed model id the model version, the model folder
+    (that contains labels.csv), the list of model files with their size and SHA-256 hash,
+    and optional optimized variants of model files (for example, converted weight files).
+
+    Lookups use the in-memory copy of the manifest, which is only re-read if the manifest file is modified,
+    so checking if a model is installed does not require scanning the models folder.
+
+    The manifest is always replaced atomically, therefore multiple application instances can read it
+    at the same time. Modifications are serialized using a lock file.
+
+    If there is no manifest (models were installed by an earlier version) then it is created by scanning
+    the models folder. If the models folder is read-only then the scan result is only kept in memory.
+    """
+
+    MANIFEST_FILENAME = "manifest.json"
+    MANIFEST_VERSION = 1
+
+    def __init__(self, modelsPath):
+        self.modelsPath = pathlib.Path(modelsPath)
+        self.lockTimeoutSec = 30
+        # Lock files older than this are considered to be left behind by a crashed process
+        self.staleLockSec = 120
+        self._manifest = None
+        self._manifestStamp = None
+        # Models found by scanning the models folder, if the manifest could not be written
+        self._scannedModels = None
+
+    def manifestFilePath(self):
+        return self.modelsPath.joinpath(ModelRegistry.MANIFEST_FILENAME)
+
+    def _emptyManifest(self):
+        return {"version": ModelRegistry.MANIFEST_VERSION, "models": {}}
+
+    def _readManifest(self):
+        """Get manifest content. The file is only read if it has changed since it was read last time."""
+        manifestFilePath = self.manifestFilePath()
+        try:
+            stat = os.stat(manifestFilePath)
+        except FileNotFoundError:
+            self._manifest = None
+            self._manifestStamp = None
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if self._manifest is None or stamp != self._manifestStamp:
+            with open(manifestFilePath, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+            self._manifestStamp = stamp
+        return self._manifest
+
+    def _writeManifest(self, manifest):
+        os.makedirs(self.modelsPath, exist_ok=True)
+        manifestFilePath = self.manifestFilePath()
+        tempFilePath = manifestFilePath.with_name(f"{manifestFilePath.name}.{os.getpid()}.tmp")
+        with open(tempFilePath, "w", encoding="utf-8", newline="\n") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tempFilePath, manifestFilePath)
+        self._manifest = None
+
+    @contextlib.contextmanager
+    def _lockedManifest(self):
+        """Context manager for modifying the manifest. Yields the manifest, which is written when the context exits."""
+        os.makedirs(self.modelsPath, exist_ok=True)
+        lockFilePath = self.manifestFilePath().with_suffix(".lock")
+        startTime = time.time()
+        while True:
+            try:
+                lockFile = os.open(lockFilePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lockFilePath) > self.staleLockSec:
+                        os.remove(lockFilePath)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() - startTime > self.lockTimeoutSec:
+                    raise RuntimeError(f"Failed to lock model manifest file: {lockFilePath}")
+                time.sleep(0.1)
+        try:
+            manifest = self._readManifest()
+            if manifest is None:
+                manifest = self._emptyManifest()
+            yield manifest
+            self._writeManifest(manifest)
+        finally:
+            os.close(lockFile)
+            os.remove(lockFilePath)
+
+    def _manifestModels(self):
+        manifest = self._readManifest()
+        if manifest is None:
+            if not self.modelsPath.exists():
+                return {}
+            # Models folder was created by an earlier version that did not use a manifest
+            try:
+                self.rebuild()
+                manifest = self._readManifest()
+            except OSError:
+                # Models folder is read-only, use the models found by scanning the folder
+                manifest = None
+            if manifest is None:
+                if self._scannedModels is None:
+                    self._scannedModels = self._scanModels()
+                return self._scannedModels
+        return manifest["models"]
+
+    def entry(self, modelId):
+        """Get manifest entry of the model. Returns None if the model is not installed."""
+        return self._manifestModels().get(modelId)
+
+    def installedModelIds(self):
+        return list(self._manifestModels().keys())
+
+    def isInstalled(self, modelId):
+        modelEntry = self.entry(modelId)
+        if not modelEntry:
+            return False
+        # Detect if the model folder has been removed manually
+        return self.modelsPath.joinpath(modelEntry["path"]).is_dir()
+
+    def modelPath(self, modelId):
+        """Get folder of the model that contains labels.csv and model files. Returns None if the model is not installed."""
+        if not self.isInstalled(modelId):
+            return None
+        return self.modelsPath.joinpath(self.entry(modelId)["path"])
+
+    def register(self, modelId, version, modelDir, computeHashes=True):
+        """Add installed model to the manifest. modelDir is the folder where the model package was extracted to."""
+        modelEntry = self._modelEntry(modelId, version, modelDir, computeHashes)
+        with self._lockedManifest() as manifest:
+            manifest["models"][modelId] = modelEntry
+
+    def _modelEntry(self, modelId, version, modelDir, computeHashes=True):
+        """Create manifest entry of a model by scanning its folder"""
+        modelDir = pathlib.Path(modelDir)
+        modelFolder = None
+        for path in modelDir.rglob("labels.csv"):
+            modelFolder = path.parent
+            break
+        if modelFolder is None:
+            raise RuntimeError(f"Model {modelId} does not contain labels.csv file")
+        files = {}
+        for path in sorted(modelFolder.rglob("*")):
+            if not path.is_file():
+                continue
+            fileInfo = {"size": path.stat().st_size}
+            if computeHashes:
+                from .model_download import ModelDownloader
+                fileInfo["sha256"] = ModelDownloader.fileSha256(path)
+            files[path.relative_to(modelFolder).as_posix()] = fileInfo
+        return {
+            "version": version,
+            "path": modelFolder.relative_to(self.modelsPath).as_posix(),
+            "files": files,
+            "variants": {},
+            }
+
+    def unregister(self, modelId):
+        with self._lockedManifest() as manifest:
+            manifest["models"].pop(modelId, None)
+
+    def addVariant(self, modelId, fileName, variantName, variantFileName):
+        """Record an optimized variant of a model file (for example, converted weights).
+        File names are relative to the model folder.
+        """
+        with self._lockedManifest() as manifest:
+            modelEntry = manifest["models"].get(modelId)
+            if not modelEntry:
+                raise RuntimeError(f"Model {modelId} is not installed")
+            variantFilePath = self.modelsPath.joinpath(modelEntry["path"], variantFileName)
+            modelEntry["variants"].setdefault(fileName, {})[variantName] = {
+                "file": variantFileName,
+                "size": variantFilePath.stat().st_size,
+                }
+
+    def variantFilePath(self, modelId, fileName, variantName):
+        """Get path of an optimized variant of a model file. Returns None if the variant is not available."""
+        modelEntry = self.entry(modelId)
+        if not modelEntry:
+            return None
+        variant = modelEntry["variants"].get(fileName, {}).get(variantName)
+        if not variant:
+            return None
+        return self.modelsPath.joinpath(modelEntry["path"], variant["file"])
+
+    def _scanModels(self):
+        """Get manifest entries of all models in the models folder (file hashes are not computed)"""
+        models = {}
+        for modelDir in sorted(self.modelsPath.iterdir()):
+            if not modelDir.is_dir() or modelDir.name.startswith("."):
+                continue
+            # Model folder name is <filename>-v<version>
+            version = modelDir.name.rpartition("-v")[2]
+            try:
+                models[modelDir.name] = self._modelEntry(modelDir.name, version, modelDir, computeHashes=False)
+            except RuntimeError:
+                # Incomplete model folder, ignore it
+                pass
+        return models
+
+    def rebuild(self):
+        """Recreate manifest by scanning the models folder. Only needed for models installed without a manifest."""
+        models = self._scanModels()
+        with self._lockedManifest() as manifest:
+            manifest["models"] = models
+        self._scannedModels = None
+
+    def clear(self):
+        self._manifest = None
+        self._manifestStamp = None
+        self._scannedModels = None
@@ -0,0 +1,87 @@
+class ProbeRasterizer:
+    """Creates a needle mask from known probe positions, without segmenting the needles in the image.
+
+    Each probe is a line segment between its tip and entry point, with a circular cross-section.
+    A voxel belongs to the probe if its center is closer to the segment than the probe radius.
+    Distances are computed for all voxels of the bounding box of the probe at once (vectorized),
+    so the cost only depends on the size of the probes and not on the size of the volume.
+    numpy is only imported in the methods, as this module is imported at application startup.
+    """
+
+    def __init__(self, volumeShape, ijkToRas):
+        """
+        :param volumeShape: volume dimensions in IJK order
+        :param ijkToRas: 4x4 matrix that maps voxel indices to RAS coordinates
+        """
+        import numpy as np
+        self.volumeShape = tuple(int(length) for length in volumeShape)
+        self.ijkToRas = np.array(ijkToRas, dtype=float)
+        self.rasToIjk = np.linalg.inv(self.ijkToRas)
+        # Probes thinner than a voxel would be rasterized as disconnected voxels
+        self.minimumRadius = 0.5 * np.linalg.norm(self.ijkToRas[:3, :3], axis=0).max()
+
+    @staticmethod
+    def probesFromMarkups(markupsNode, worldToVolumeRas=None):
+        """Get list of (tip, entry) RAS positions from a markups node.
+        Control points are taken in pairs: each pair defines a probe (for example, a line markup is one probe).
+        :param worldToVolumeRas: 4x4 matrix that transforms world positions to the RAS coordinate system of the volume
+        """
+        import numpy as np
+        pointCount = markupsNode.GetNumberOfControlPoints()
+        if pointCount == 0 or pointCount % 2 != 0:
+            raise ValueError(f"Markups node {markupsNode.GetName()} must contain pairs of probe tip and entry points, found {pointCount} points")
+        positions = []
+        for pointIndex in range(pointCount):
+            position = [0.0, 0.0, 0.0]
+            markupsNode.GetNthControlPointPositionWorld(pointIndex, position)
+            if worldToVolumeRas is not None:
+                position = (np.array(worldToVolumeRas, dtype=float) @ np.append(position, 1.0))[:3]
+            positions.append(np.array(position, dtype=float))
+        return [(positions[pointIndex], positions[pointIndex + 1]) for pointIndex in range(0, pointCount, 2)]
+
+    def rasterize(self, probes, diameter, mask=None):
+        """Get uint8 mask (IJK order) with voxels of the probes set to 1.
+
+        :param probes: list of (tip, entry) RAS positions
+        :param diameter: probe diameter in mm
+        :param mask: if specified then probes are added to this mask instead of a new one
+        """
+        import numpy as np
+        if mask is None:
+            mask = np.zeros(self.volumeShape, dtype=np.uint8)
+        radius = max(0.5 * float(diameter), self.minimumRadius)
+        for tip, entry in probes:
+            self._rasterizeProbe(mask, np.asarray(tip, dtype=float), np.asarray(entry, dtype=float), radius)
+        return mask
+
+    def _boundingBox(self, tip, entry, radius):
+        """Get voxel index ranges (list of slices) that contain the probe, or None if it is outside the volume"""
+        import numpy as np
+        rasMin = np.minimum(tip, entry) - radius
+        rasMax = np.maximum(tip, entry) + radius
+        corners = np.array([[x, y, z, 1.0] for x in (rasMin[0], rasMax[0]) for y in (rasMin[1], rasMax[1]) for z in (rasMin[2], rasMax[2])])
+        cornersIjk = (self.rasToIjk @ corners.T)[:3]
+        ijkMin = np.maximum(np.floor(cornersIjk.min(axis=1)).astype(int), 0)
+        ijkMax = np.minimum(np.ceil(cornersIjk.max(axis=1)).astype(int) + 1, self.volumeShape)
+        if np.any(ijkMax <= ijkMin):
+            return None
+        return [slice(start, stop) for start, stop in zip(ijkMin, ijkMax)]
+
+    def _rasterizeProbe(self, mask, tip, entry, radius):
+        import numpy as np
+        box = self._boundingBox(tip, entry, radius)
+        if box is None:
+            return
+        # RAS positions of voxel centers in the bounding box (3, ni, nj, nk)
+        i, j, k = np.ogrid[box[0], box[1], box[2]]
+        points = (self.ijkToRas[:3, 0, None, None, None] * i + self.ijkToRas[:3, 1, None, None, None] * j
+            + self.ijkToRas[:3, 2, None, None, None] * k + self.ijkToRas[:3, 3, None, None, None])
+        # Distance from the closest point of the segment
+        axis = entry - tip
+        axisLengthSquared = axis.dot(axis)
+        offsets = points - tip[:, None, None, None]
+        if axisLengthSquared > 0:
+            t = np.clip(np.tensordot(axis, offsets, axes=1) / axisLengthSquared, 0.0, 1.0)
+            offsets -= axis[:, None, None, None] * t
+        distanceSquared = (offsets * offsets).sum(axis=0)
+        mask[tuple(box)] |= (distanceSquared <= radius * radius).astype(np.uint8)
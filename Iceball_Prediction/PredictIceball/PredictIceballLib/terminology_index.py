@@ -0,0 +1,152 @@
+import json
+import os
+
+
+class TerminologyIndex:
+    """Lookup tables for the terminology and anatomic context files of the module.
+
+    Walking the terminology through the Terminologies module logic requires many VTK calls for each lookup.
+    This index reads the .term.json files directly and stores types, type modifiers, and anatomic regions
+    in dicts keyed by (coding scheme designator, code value). The index is cached in a file and only rebuilt
+    when the terminology files change.
+    """
+
+    CACHE_VERSION = 1
+    DEFAULT_COLOR = [127, 127, 127]
+
+    def __init__(self):
+        self.terminologyContextNames = []
+        self.anatomicContextNames = []
+        # (scheme, code) -> {"codeMeaning", "label", "color", "categories": [(scheme, code), ...]}
+        self.types = {}
+        # ((typeScheme, typeCode), (modifierScheme, modifierCode)) -> {"codeMeaning", "label", "color"}
+        self.typeModifiers = {}
+        # (scheme, code) -> {"codeMeaning"}
+        self.regions = {}
+
+    @staticmethod
+    def load(terminologyFilePaths, anatomicContextFilePaths, cacheFilePath=None):
+        """Get index of the specified terminology and anatomic context files.
+        If cacheFilePath is specified then the index is read from there if the files have not changed since it was built.
+        """
+        filesKey = TerminologyIndex._filesKey(list(terminologyFilePaths) + list(anatomicContextFilePaths))
+        if cacheFilePath:
+            try:
+                with open(cacheFilePath, encoding="utf-8") as f:
+                    cache = json.load(f)
+                if cache.get("version") == TerminologyIndex.CACHE_VERSION and cache.get("filesKey") == filesKey:
+                    return TerminologyIndex._fromSerializable(cache["index"])
+            except (OSError, ValueError, KeyError):
+                # Missing or invalid cache, rebuild the index
+                pass
+
+        index = TerminologyIndex()
+        for terminologyFilePath in terminologyFilePaths:
+            index.addTerminologyFile(terminologyFilePath)
+        for anatomicContextFilePath in anatomicContextFilePaths:
+            index.addAnatomicContextFile(anatomicContextFilePath)
+
+        if cacheFilePath:
+            try:
+                os.makedirs(os.path.dirname(cacheFilePath), exist_ok=True)
+                tempFilePath = f"{cacheFilePath}.{os.getpid()}.tmp"
+                with open(tempFilePath, "w", encoding="utf-8") as f:
+                    json.dump({"version": TerminologyIndex.CACHE_VERSION, "filesKey": filesKey, "index": index._toSerializable()}, f)
+                os.replace(tempFilePath, cacheFilePath)
+            except OSError:
+                # The cache is optional
+                pass
+
+        return index
+
+    @staticmethod
+    def _filesKey(filePaths):
+        """String that changes if any of the files is changed"""
+        keys = []
+        for filePath in filePaths:
+            stat = os.stat(filePath)
+            keys.append(f"{os.path.abspath(filePath)}:{stat.st_mtime_ns}:{stat.st_size}")
+        return "|".join(keys)
+
+    @staticmethod
+    def _code(item):
+        return (item["CodingSchemeDesignator"], item["CodeValue"])
+
+    @staticmethod
+    def _labelColor(item):
+        label = item.get("3dSlicerLabel") or item.get("CodeMeaning", "")
+        color = item.get("recommendedDisplayRGBValue", TerminologyIndex.DEFAULT_COLOR)
+        return label, list(color)
+
+    def addTerminologyFile(self, terminologyFilePath):
+        with open(terminologyFilePath, encoding="utf-8") as f:
+            terminology = json.load(f)
+        self.terminologyContextNames.append(terminology["SegmentationCategoryTypeContextName"])
+        for category in terminology["SegmentationCodes"]["Category"]:
+            categoryCode = TerminologyIndex._code(category)
+            for typeItem in category.get("Type", []):
+                typeCode = TerminologyIndex._code(typeItem)
+                if typeCode in self.types:
+                    # Type is already defined in another category
+                    self.types[typeCode]["categories"].append(categoryCode)
+                    continue
+                label, color = TerminologyIndex._labelColor(typeItem)
+                self.types[typeCode] = {"codeMeaning": typeItem.get("CodeMeaning", ""), "label": label, "color": color, "categories": [categoryCode]}
+                for modifierItem in typeItem.get("Modifier", []):
+                    label, color = TerminologyIndex._labelColor(modifierItem)
+                    self.typeModifiers[(typeCode, TerminologyIndex._code(modifierItem))] = {
+                        "codeMeaning": modifierItem.get("CodeMeaning", ""), "label": label, "color": color}
+
+    def addAnatomicContextFile(self, anatomicContextFilePath):
+        with open(anatomicContextFilePath, encoding="utf-8") as f:
+            anatomicContext = json.load(f)
+        self.anatomicContextNames.append(anatomicContext["AnatomicContextName"])
+        for regionItem in anatomicContext["AnatomicCodes"].get("AnatomicRegion", []):
+            self.regions[TerminologyIndex._code(regionItem)] = {"codeMeaning": regionItem.get("CodeMeaning", "")}
+
+    def hasType(self, scheme, code, categoryScheme=None, categoryCode=None):
+        typeEntry = self.types.get((scheme, code))
+        if not typeEntry:
+            return False
+        if categoryScheme is None:
+            return True
+        return (categoryScheme, categoryCode) in typeEntry["categories"]
+
+    def hasRegion(self, scheme, code):
+        return (scheme, code) in self.regions
+
+    def labelColor(self, typeScheme, typeCode, modifierScheme=None, modifierCode=None):
+        """Get (label, (r, g, b)) of a type or type modifier. Color components are in the range 0.0-1.0.
+        Returns None if the type or modifier is not found.
+        """
+        if modifierCode:
+            entry = self.typeModifiers.get(((typeScheme, typeCode), (modifierScheme, modifierCode)))
+        else:
+            entry = self.types.get((typeScheme, typeCode))
+        if not entry:
+            return None
+        rgb = entry["color"]
+        return entry["label"], (rgb[0]/255.0, rgb[1]/255.0, rgb[2]/255.0)
+
+    def _toSerializable(self):
+        return {
+            "terminologyContextNames": self.terminologyContextNames,
+            "anatomicContextNames": self.anatomicContextNames,
+            "types": [[list(code), entry] for code, entry in self.types.items()],
+            "typeModifiers": [[list(typeCode), list(modifierCode), entry] for (typeCode, modifierCode), entry in self.typeModifiers.items()],
+            "regions": [[list(code), entry] for code, entry in self.regions.items()],
+            }
+
+    @staticmethod
+    def _fromSerializable(data):
+        index = TerminologyIndex()
+        index.terminologyContextNames = data["terminologyContextNames"]
+        index.anatomicContextNames = data["anatomicContextNames"]
+        for code, entry in data["types"]:
+            entry["categories"] = [tuple(categoryCode) for categoryCode in entry["categories"]]
+            index.types[tuple(code)] = entry
+        for typeCode, modifierCode, entry in data["typeModifiers"]:
+            index.typeModifiers[(tuple(typeCode), tuple(modifierCode))] = entry
+        for code, entry in data["regions"]:
+            index.regions[tuple(code)] = entry
+        return index
@@ -1,68 +1,110 @@
-import os
-import numpy as np
-import fire
 import time
-import torch
+script_start_time = time.time()
+
+import os
 from collections import OrderedDict
 
-import nrrd
+# Only packages that are needed by all processing paths are imported here.
+# Importing torch and monai takes several seconds, it is reported as a separate stage in the computation time log.
+import numpy as np
+import torch
 from monai.bundle import ConfigParser
 from monai.data import decollate_batch, list_data_collate
 from monai.utils import convert_to_dst_type
 from monai.utils import MetaKeys
-
-from torch.cuda.amp import autocast
 from monai.inferers import SlidingWindowInfererAdapt
-
 from monai.transforms import (
     Compose,
     CropForegroundd,
     EnsureTyped,
     Invertd,
-    KeepLargestConnectedComponentd,
-    Lambdad,
     LoadImaged,
-    NormalizeIntensityd,
-    Resized,
-    ScaleIntensityRanged,
     Spacingd,
     Orientationd,
     ConcatItemsd,
 )
 
+# Startup stages that have not been reported yet in the computation time log, list of (operation, time) tuples
+startup_timing_checkpoints = [("Importing modules", time.time())]
+
+# If enabled then models are kept loaded after a run, for the next runs in the same process (see inference_worker.py)
+keep_models_loaded = False
+# (model file, device) -> (model file modification time, model, config, True if weights are memory-mapped)
+loaded_models = {}
+
 
 def logits2pred(logits, sigmoid=False, dim=1):
     if isinstance(logits, (list, tuple)):
         logits = logits[0]
 
     if sigmoid:
-        pred = torch.sigmoid(logits)
-        pred = (pred >= 0.5)
+        # sigmoid(x) >= 0.5 is the same as x >= 0
+        pred = (logits >= 0)
     else:
-        pred = torch.softmax(logits, dim=dim)
-        pred = torch.argmax(pred, dim=dim, keepdim=True).to(dtype=torch.uint8)
+        # softmax does not change which channel has the largest value
+        pred = torch.argmax(logits, dim=dim, keepdim=True).to(dtype=torch.uint8)
 
     return pred
 
 
-@torch.no_grad()
-def main(model_file,
-         image_file,
-         result_file,
-         save_mode=None,
-         image_file_2=None,
-         image_file_3=None,
-         image_file_4=None,
-         **kwargs):
-    start_time = time.time()
-    timing_checkpoints = []  # list of (operation, time) tuples
+def weights_cache_file(model_file):
+    """Get path of the memory-mappable copy of a checkpoint file"""
+    return os.path.splitext(model_file)[0] + ".mmap.pt"
+
+
+def _torch_load_supports_mmap():
+    import inspect
+    return "mmap" in inspect.signature(torch.load).parameters
+
+
+def write_weights_cache(checkpoint, cache_file):
+    """Save checkpoint in a format that can be loaded lazily by memory mapping.
+
+    Convolution kernels are stored in channels_last_3d layout, which is used for inference,
+    so that the weights do not have to be copied after loading and the memory pages can be shared
+    between processes that load the same model.
+    """
+    state_dict = OrderedDict()
+    for name, tensor in checkpoint["state_dict"].items():
+        if tensor.dim() == 5:
+            tensor = tensor.contiguous(memory_format=torch.channels_last_3d)
+        state_dict[name] = tensor
+    cache_checkpoint = dict(checkpoint)
+    cache_checkpoint["state_dict"] = state_dict
+    # Write to temporary file and rename, so that other processes never see a partially written file
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    torch.save(cache_checkpoint, temp_file)
+    os.replace(temp_file, cache_file)
+
+
+def load_checkpoint(model_file, use_weights_cache=True):
+    """Load checkpoint, using the memory-mapped weights cache if possible.
+    Returns the checkpoint and True if the weights are memory-mapped.
+    """
+    if use_weights_cache and _torch_load_supports_mmap():
+        cache_file = weights_cache_file(model_file)
+        if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(model_file):
+            try:
+                return torch.load(cache_file, map_location="cpu", mmap=True), True
+            except Exception as e:
+                print(f"Failed to load weights cache {cache_file}, using the original model file: {e}")
 
-    # Checking for model file
+    checkpoint = torch.load(model_file, map_location="cpu")
 
-    if not os.path.exists(model_file):
-        raise ValueError('Cannot find model file:' + str(model_file))
+    if use_weights_cache and _torch_load_supports_mmap() and "state_dict" in checkpoint:
+        try:
+            write_weights_cache(checkpoint, weights_cache_file(model_file))
+            print(f"Created weights cache {weights_cache_file(model_file)}")
+        except OSError as e:
+            # Model folder may be read-only, the cache is optional
+            print(f"Failed to create weights cache: {e}")
 
-    checkpoint = torch.load(model_file, map_location="cpu")
+    return checkpoint, False
+
+
+def load_model(model_file, device, use_weights_cache=True):
+    """Load auto3dseg segresnet model for inference. Returns model, model config, and True if weights are memory-mapped."""
+    checkpoint, mmap_loaded = load_checkpoint(model_file, use_weights_cache=use_weights_cache)
 
     if 'config' not in checkpoint:
         raise ValueError('Config not found in checkpoint (not a auto3dseg/segresnet model):' + str(model_file))
@@ -73,20 +115,317 @@ def main(model_file,
 
     epoch = checkpoint.get("epoch", 0)
     best_metric = checkpoint.get("best_metric", 0)
-    sigmoid = config.get("sigmoid", False)
 
     model = ConfigParser(config["network"]).get_parsed_content()
-    model.load_state_dict(state_dict, strict=True)
+    if mmap_loaded:
+        # Use the memory-mapped tensors as parameters instead of copying them
+        model.load_state_dict(state_dict, strict=True, assign=True)
+    else:
+        model.load_state_dict(state_dict, strict=True)
 
     print(f'Model epoch {epoch} metric {best_metric}')
 
-    device = torch.device("cpu") if torch.cuda.device_count() == 0 else torch.device(0)
     model = model.to(device=device, memory_format=torch.channels_last_3d)  # gpu
     model.eval()
+    return model, config, mmap_loaded
+
+
+def get_model(model_file, device, use_weights_cache=True):
+    """Load model, or use the already loaded model if keep_models_loaded is enabled and the model file has not changed since.
+    Returns model, model config (a copy that the caller may modify), and True if weights are memory-mapped.
+    """
+    import copy
+    key = (os.path.abspath(model_file), str(device))
+    modified_time = os.path.getmtime(model_file)
+    loaded_model = loaded_models.get(key)
+    if loaded_model is not None and loaded_model[0] == modified_time:
+        print("Using model that is already loaded")
+    else:
+        model, config, mmap_loaded = load_model(model_file, device, use_weights_cache=use_weights_cache)
+        if not keep_models_loaded:
+            return model, config, mmap_loaded
+        loaded_model = (modified_time, model, config, mmap_loaded)
+        loaded_models[key] = loaded_model
+    return loaded_model[1], copy.deepcopy(loaded_model[2]), loaded_model[3]
+
+
+def inference_device():
+    """Get the device that is used for inference: the first GPU if available, otherwise the CPU"""
+    return torch.device("cpu") if torch.cuda.device_count() == 0 else torch.device(0)
+
+
+def prepare_fast_startup(model_files=None):
+    """Prepare for fast startup of subsequent runs.
+
+    Modules are already imported at this point (so their files are in the operating system file cache).
+    Python bytecode of this script and of the MONAI package is compiled, and memory-mappable weights caches
+    are created for the specified model files. Folders that are not writable (for example, a read-only application
+    installation) are not compiled.
+    """
+    import compileall
+    import monai
+    print("Compiling Python bytecode...")
+    for folder in [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(monai.__file__)]:
+        if os.access(folder, os.W_OK):
+            compileall.compile_dir(folder, quiet=1)
+        else:
+            print(f"Folder {folder} is read-only, its Python bytecode is not compiled")
+    if model_files:
+        if isinstance(model_files, str):
+            model_files = model_files.split(",")
+        for model_file in model_files:
+            print(f"Preparing model {model_file}...")
+            load_checkpoint(model_file)
+
+
+def autocast(device):
+    """Mixed precision inference context (only used on GPU)"""
+    return torch.autocast(device_type=device.type, enabled=(device.type == "cuda"))
+
+
+def make_sliding_inferrer(roi_size, sw_workers=None, aggregation="logits", accumulator_dtype="float32", sigmoid=False,
+                          skip_windows=False, sw_batch_size=None, overlap=None, blend_mode=None):
+    """Create sliding window inferer.
+    If all settings are default then MONAI SlidingWindowInfererAdapt is used, otherwise the windows are evaluated
+    by sw_workers parallel workers (0 = one worker per CPU core, None = 1 worker).
+    If aggregation is "labels" then the inferer returns uint8 labels instead of logits.
+    If skip_windows is True then windows outside the foreground mask are skipped.
+    sw_batch_size (default 1), overlap (default 0.625), and blend_mode (default "gaussian") are sliding window parameters.
+    """
+    default_settings = (sw_workers is None and aggregation == "logits" and accumulator_dtype == "float32" and not skip_windows
+                        and sw_batch_size is None and overlap is None and blend_mode is None)
+    sw_batch_size = int(sw_batch_size) if sw_batch_size is not None else 1
+    overlap = float(overlap) if overlap is not None else 0.625
+    blend_mode = blend_mode if blend_mode is not None else "gaussian"
+    if default_settings:
+        return SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=blend_mode,
+                                         cache_roi_weight_map=False, progress=True)
+    from sliding_window import ParallelSlidingWindowInferer
+    sliding_inferrer = ParallelSlidingWindowInferer(roi_size=roi_size, sw_batch_size=sw_batch_size, overlap=overlap, mode=blend_mode,
+                                                    workers=int(sw_workers) if sw_workers is not None else 1,
+                                                    output=aggregation, sigmoid=sigmoid,
+                                                    accumulator_dtype=getattr(torch, accumulator_dtype), progress=True)
+    return sliding_inferrer
+
+
+def predict_labels(sliding_inferrer, data, network, device, sigmoid, timing_checkpoints, mask=None,
+                   memory_planner=None, model=None, region=None):
+    """Run sliding window inference and convert the result to uint8 labels.
+    If mask is specified then windows that do not overlap with the mask are skipped.
+    If region is specified then only windows that overlap with the region are evaluated (labels are only valid in the region).
+    If memory_planner is specified then inference settings are set according to the current level of the planner,
+    and if inference runs out of memory then it is retried at the next level (model is moved to the CPU if needed).
+    """
+    print('Running Inference ...')
+    while True:
+        if memory_planner is not None:
+            level = memory_planner.level()
+            sliding_inferrer.sw_batch_size = level.sw_batch_size
+            sliding_inferrer.accumulator_dtype = level.accumulator_dtype
+            sliding_inferrer.output_device = level.output_device
+            if data.device != level.window_device:
+                device = level.window_device
+                model.to(device)
+                data = data.to(device)
+                if mask is not None:
+                    mask = mask.to(device)
+                if region is not None:
+                    region = region.to(device)
+        # Window selection is only supported by the parallel inferer
+        window_selection = {}
+        if mask is not None:
+            window_selection["mask"] = mask
+        if region is not None:
+            window_selection["region"] = region
+        try:
+            with autocast(device):
+                result = sliding_inferrer(inputs=data, network=network, **window_selection)
+            break
+        except Exception as e:
+            from memory_planning import is_out_of_memory_error
+            if memory_planner is None or not is_out_of_memory_error(e) or not memory_planner.degrade():
+                raise
+            print(f"Out of memory during inference ({e}), retrying with {memory_planner.describe()}")
+        # Release memory of the failed attempt (exception is already deleted here)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    print_sliding_inferrer_info(sliding_inferrer)
+    if mask is not None or region is not None:
+        skip_ratio = sliding_inferrer.skipped_window_count / sliding_inferrer.window_count
+        timing_checkpoints.append(stage_checkpoint(f"Inference ({sliding_inferrer.skipped_window_count} of "
+                                                   f"{sliding_inferrer.window_count} windows skipped, {skip_ratio:.0%})"))
+    else:
+        timing_checkpoints.append(stage_checkpoint("Inference"))
+
+    if result.dtype == torch.uint8:
+        # Inferer already computed the labels
+        print(f"preds {result.shape}")
+        return result
+
+    logits = result
+    result = None
+    print(f"Logits {logits.shape}")
+    # logits -> preds
+    print('Converting logits into predictions')
+    try:
+        pred = logits2pred(logits, sigmoid=sigmoid)
+    except RuntimeError as e:
+        if not logits.is_cuda:
+            raise e
+        print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
+        logits = logits.cpu()
+        pred = logits2pred(logits, sigmoid=sigmoid)
+    print(f"preds {pred.shape}")
+    timing_checkpoints.append(stage_checkpoint("Logits"))
+    return pred
+
+
+def peak_memory_mb():
+    """Get peak memory usage since the previous call, in MB.
+
+    Returns (peak resident memory, peak GPU memory). Resident memory peak of each stage is only available on Linux,
+    on other systems the peak since the process started (or current memory usage) is returned.
+    GPU memory is None if CUDA is not used.
+    """
+    cpu_peak_mb = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    cpu_peak_mb = int(line.split()[1]) / 1024
+                    break
+        # Reset the peak, so that the next call returns the peak of the next stage
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        try:
+            import psutil
+            memory_info = psutil.Process().memory_info()
+            cpu_peak_mb = getattr(memory_info, "peak_wset", memory_info.rss) / 1024 / 1024
+        except ImportError:
+            pass
+    gpu_peak_mb = None
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        gpu_peak_mb = torch.cuda.max_memory_allocated() / 1024 / 1024
+        torch.cuda.reset_peak_memory_stats()
+    return cpu_peak_mb, gpu_peak_mb
+
+
+def stage_checkpoint(operation):
+    """Get computation time log checkpoint: (operation, time, peak memory, peak GPU memory)"""
+    return (operation, time.time()) + peak_memory_mb()
+
+
+def resident_memory_mb():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+@torch.no_grad()
+def main(model_file=None,
+         image_file=None,
+         result_file=None,
+         save_mode=None,
+         image_file_2=None,
+         image_file_3=None,
+         image_file_4=None,
+         weights_cache=True,
+         warmup=False,
+         sw_workers=None,
+         aggregation="logits",
+         accumulator_dtype="float32",
+         foreground_threshold=None,
+         roi_mask_file=None,
+         layout_file=None,
+         memory_budget=None,
+         sw_batch_size=None,
+         overlap=None,
+         blend_mode=None,
+         tuning_file=None,
+         tuning_accuracy_settings=False,
+         preprocessing_cache_dir=None,
+         incremental_state_file=None,
+         incremental_margin=16,
+         incremental_tolerance=0.1,
+         resolution_scale=None,
+         crop_output=False,
+         **kwargs):
+    start_time = time.time()
+    timing_checkpoints = []  # list of (operation, time) tuples
+    if startup_timing_checkpoints:
+        # First run in this process, include startup time
+        start_time = script_start_time
+        timing_checkpoints.extend(startup_timing_checkpoints)
+        startup_timing_checkpoints.clear()
+
+    if memory_budget is not None and aggregation != "labels":
+        # Aggregating logits would require a full-size float volume and conversion to labels
+        print("Memory budget is specified, using labels aggregation")
+        aggregation = "labels"
+
+    if warmup:
+        # Only prepare for fast startup (model_file may contain a comma-separated list of model files)
+        prepare_fast_startup(model_file)
+        timing_checkpoints.append(stage_checkpoint("Warmup"))
+        print_timing_checkpoints(start_time, timing_checkpoints)
+        return
+
+    if model_file is None or image_file is None or result_file is None:
+        raise ValueError("model_file, image_file, and result_file must be specified")
+
+    # Checking for model file
+
+    if not os.path.exists(model_file):
+        raise ValueError('Cannot find model file:' + str(model_file))
+
+    device = inference_device()
+    model, config, mmap_loaded = get_model(model_file, device, use_weights_cache=weights_cache)
+    sigmoid = config.get("sigmoid", False)
+
+    if resolution_scale is not None and float(resolution_scale) != 1.0:
+        # Coarser resampling for a quick preview: fewer voxels and windows, at the cost of accuracy
+        if config.get("resample_resolution", None) is None:
+            print("Model does not resample the input, resolution_scale is ignored")
+        else:
+            config["resample_resolution"] = [float(spacing) * float(resolution_scale) for spacing in config["resample_resolution"]]
+            print(f"Resample resolution is scaled by {resolution_scale}")
+
+    if tuning_file is not None:
+        # Use settings found by inference_tuning.py for this model on this machine (explicitly specified settings take precedence).
+        # Overlap and blending mode change the output, they are only used if tuning_accuracy_settings is enabled.
+        from inference_tuning import tuned_settings
+        settings = tuned_settings(tuning_file, model_file, tuning_accuracy_settings)
+        if settings:
+            print(f"Using tuned inference settings: {settings}")
+            sw_batch_size = sw_batch_size if sw_batch_size is not None else settings.get("sw_batch_size")
+            sw_workers = sw_workers if sw_workers is not None else settings.get("sw_workers")
+            overlap = overlap if overlap is not None else settings.get("overlap")
+            blend_mode = blend_mode if blend_mode is not None else settings.get("blend_mode")
+    timing_checkpoints.append(stage_checkpoint("Loading model"))
+    memory_mb = resident_memory_mb()
+    print(f"Model loaded{' (memory-mapped weights)' if mmap_loaded else ''}"
+          + (f", resident memory {memory_mb:.0f}MB" if memory_mb is not None else ""))
+
+    # Record when the first sliding window is evaluated (time to first window)
+    first_window_time = []
+    def network(inputs):
+        if not first_window_time:
+            first_window_time.append(time.time())
+        return model(inputs)
 
     # If BRATS
     if save_mode == 'brats' or 'brats' in model_file:  # for brats case
 
+        if roi_mask_file is not None:
+            raise ValueError('roi_mask_file is not supported for BRATS models')
+        if layout_file is not None:
+            raise ValueError('layout_file is not supported for BRATS models')
+        if incremental_state_file is not None:
+            raise ValueError('incremental_state_file is not supported for BRATS models')
+
         image_files = []
         for index, img in enumerate([image_file, image_file_2, image_file_3, image_file_4]):
             if img is not None:
@@ -95,6 +434,8 @@ def main(model_file,
         for img in image_files:
             if img is None or not os.path.exists(img):
                 raise ValueError(f'Incorrect image filename for {img}: "{img}"')
+            if os.path.isdir(img):
+                raise ValueError('DICOM series input is not supported for BRATS models')
 
         ts = [
             LoadImaged(keys="image", ensure_channel_first=True, dtype=None, allow_missing_keys=True, image_only=False),
@@ -136,48 +477,34 @@ def main(model_file,
         # sliding_inferrer
         roi_size = config["roi_size"]
         # roi_size = [224, 224, 144]
-        sliding_inferrer = SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
-                                                     cache_roi_weight_map=False, progress=True)
+        sliding_inferrer = make_sliding_inferrer(roi_size, sw_workers, aggregation, accumulator_dtype, sigmoid,
+                                                 skip_windows=(foreground_threshold is not None or roi_mask_file is not None),
+                                                 sw_batch_size=sw_batch_size, overlap=overlap, blend_mode=blend_mode)
 
         # process DATA
         batch_data = inf_transform([{"image": image_files}])
         # original_affine = batch_data[0]['image_meta_dict']['original_affine']
         original_affine = batch_data[0]['image'].meta[MetaKeys.ORIGINAL_AFFINE]
+        original_shape = batch_data[0]['image'].meta.get(MetaKeys.SPATIAL_SHAPE, batch_data[0]['image'].shape[1:])
         batch_data = list_data_collate([batch_data])
         data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=torch.channels_last_3d, device=device)
-        timing_checkpoints.append(("Preprocessing", time.time()))
+        timing_checkpoints.append(stage_checkpoint("Preprocessing"))
 
-        print('Running Inference ...')
-        with autocast(enabled=True):
-            logits = sliding_inferrer(inputs=data, network=model)
-        timing_checkpoints.append(("Inference", time.time()))
+        mask = foreground_mask(data, foreground_threshold=foreground_threshold)
+        memory_planner = None
+        if memory_budget is not None:
+            memory_planner = make_memory_planner(memory_budget, device, roi_size, data, original_shape, config, model)
+        pred = predict_labels(sliding_inferrer, data, network, device, sigmoid, timing_checkpoints, mask,
+                              memory_planner, model)
 
-        print(f"Logits {logits.shape}")
-        # logits -> preds
-        print('Converting logits into predictions')
-        try:
-            pred = logits2pred(logits, sigmoid=sigmoid)
-        except RuntimeError as e:
-            if not logits.is_cuda:
-                raise e
-            print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
-            logits = logits.cpu()
-            pred = logits2pred(logits, sigmoid=sigmoid)
-        print(f"preds {pred.shape}")
-        timing_checkpoints.append(("Logits", time.time()))
-        logits = None
-
-        # pred = pred.cpu() # convert to CPU if the next step (reverse interpolation) is OOM on GPU
         # invert loading transforms (uncrop, reverse-resample, etc)
         post_transforms = Compose(
             [Invertd(keys="pred", orig_keys="image", transform=inf_transform, nearest_interp=True)])
 
-        batch_data["pred"] = convert_to_dst_type(pred, batch_data["image"], dtype=pred.dtype, device=pred.device)[
-            0]  # make Meta tensor
-        pred = [post_transforms(x)["pred"] for x in decollate_batch(batch_data)]
+        pred = invert_prediction(pred, batch_data, post_transforms)
         seg = pred[0]
         print(f"preds inverted {seg.shape}")
-        timing_checkpoints.append(("Preds", time.time()))
+        timing_checkpoints.append(stage_checkpoint("Preds"))
 
         # BRATS model outputs 3 channels for the three overlapping tumour segments:
         # enhancing tumour (ET), the tumour core (ED) and the whole tumour
@@ -203,139 +530,343 @@ def main(model_file,
             if image_files[img] is None or not os.path.exists(image_files[img]):
                 raise ValueError(f'Incorrect image filename for {img}: "{image_files[img]}"')
 
-        # Loading volumes
-        loader = LoadImaged(keys=keys, ensure_channel_first=True, dtype=None, allow_missing_keys=True, image_only=False)
-        images_loaded = loader(image_files)
-        timing_checkpoints.append(("Loading volumes", time.time()))
-
-        if len(keys) > 1:
-            # Loading size of image 1
-            image1_shape = images_loaded[keys[0]].shape[1:]
-            # Resizing the other volumes if needed
-            for idx, img in enumerate(keys[1:]):
-                temp_shape = images_loaded[img].shape[-len(image1_shape):]
-                if np.any(np.not_equal(image1_shape, temp_shape)):
-                    print(f'Volumes do not have the same size - Resizing volume {img}')
-                    resizer = Resized(keys=img, spatial_size=image1_shape, mode='bilinear')
-                    images_loaded = resizer(images_loaded)
-                    timing_checkpoints.append((f"Resizing volume {img}", time.time()))
-
-        # make input Transform chain
-        main_normalize_mode = config["normalize_mode"]
-        intensity_bounds = config["intensity_bounds"]
-        if len(keys) == 1:  # only one input image
-            ts = [
-                ConcatItemsd(keys=keys, name="image", dim=0),
-                EnsureTyped(keys="image", data_type="tensor", dtype=torch.float, allow_missing_keys=True)
-            ]
-            _add_normalization_transforms(ts, "image", main_normalize_mode, intensity_bounds)
-        else:  # multiple input images
-            ts = [
-            ]
-
-            extra_modalities = OrderedDict(config['extra_modalities'])
-            normalize_modes = [main_normalize_mode] + list(extra_modalities.values())
-            for key, normalize_mode in zip(keys, normalize_modes):
-                _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds)
-            ts.extend([
-                ConcatItemsd(keys=keys, name="image", dim=0),
-                EnsureTyped(keys="image", data_type="tensor", dtype=torch.float, allow_missing_keys=True)
-            ])
-
-        if config.get("orientation_ras", False):
-            print('Using orientation_ras')
-            # we assume LPS physical coordinate system orientation
-            # This code is only tested with NRRD files that use LPS space
-            ts.append(Orientationd(keys="image", axcodes="RAS"))  # reorient #
-        if config.get("crop_foreground", True):
-            print('Using crop_foreground')
-            ts.append(CropForegroundd(keys="image", source_key="image1", margin=10, allow_smaller=True))  # subcrop
-
-        if config.get("resample_resolution", None) is not None:
-            pixdim = list(config["resample_resolution"])
-            print(f'Using resample with  resample_resolution {pixdim}')
-
-            ts.append(
-                Spacingd(
-                    keys=["image"],
-                    pixdim=list(pixdim),
-                    mode=["bilinear"],
-                    dtype=torch.float,
-                    min_pixdim=np.array(pixdim) * 0.75,
-                    max_pixdim=np.array(pixdim) * 1.25,
-                    allow_missing_keys=True,
-                )
-            )
-
-        inf_transform = Compose(ts)
+        # Preprocessed input may be cached by a previous model that uses the same input and preprocessing
+        preprocessing_cache = None
+        cached_data = None
+        if preprocessing_cache_dir is not None:
+            from preprocessing_cache import PreprocessingCache
+            preprocessing_cache = PreprocessingCache(preprocessing_cache_dir)
+            cache_key = preprocessing_cache.key(list(image_files.values()), config, roi_mask_file, layout_file)
+            cached_data = preprocessing_cache.load(cache_key)
+            print(f"Preprocessing cache {'hit' if cached_data is not None else 'miss'}")
+
+        # ROI mask is resampled along with the image, using the geometry of image 1
+        spatial_keys = ["image"] if roi_mask_file is None else ["image", "roi"]
+        if cached_data is None:
+            # Loading volumes
+            images_loaded = load_images(image_files)
+            if layout_file is not None:
+                images_loaded[keys[0]] = composite_layout(images_loaded[keys[0]], layout_file)
+            timing_checkpoints.append(stage_checkpoint("Loading volumes"))
+
+            if len(keys) > 1:
+                # Loading size of image 1
+                image1_shape = images_loaded[keys[0]].shape[1:]
+                # Resizing the other volumes if needed
+                for idx, img in enumerate(keys[1:]):
+                    temp_shape = images_loaded[img].shape[-len(image1_shape):]
+                    if np.any(np.not_equal(image1_shape, temp_shape)):
+                        print(f'Volumes do not have the same size - Resizing volume {img}')
+                        from monai.transforms import Resized
+                        resizer = Resized(keys=img, spatial_size=image1_shape, mode='bilinear')
+                        images_loaded = resizer(images_loaded)
+                        timing_checkpoints.append(stage_checkpoint(f"Resizing volume {img}"))
+
+            if roi_mask_file is not None:
+                roi = read_labelmap(roi_mask_file, images_loaded[keys[0]].shape[1:])
+                images_loaded["roi"] = convert_to_dst_type(torch.as_tensor(roi[None] > 0).float(), images_loaded[keys[0]])[0]
+
+        inf_transform = make_inference_transform(config, keys, spatial_keys)
 
         # sliding_inferrer
         roi_size = config["roi_size"]
         # roi_size = [224, 224, 144]
-        sliding_inferrer = SlidingWindowInfererAdapt(roi_size=roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian",
-                                                     cache_roi_weight_map=False, progress=True)
+        sliding_inferrer = make_sliding_inferrer(roi_size, sw_workers, aggregation, accumulator_dtype, sigmoid,
+                                                 skip_windows=(foreground_threshold is not None or roi_mask_file is not None
+                                                               or incremental_state_file is not None),
+                                                 sw_batch_size=sw_batch_size, overlap=overlap, blend_mode=blend_mode)
 
         # process DATA
-        batch_data = inf_transform([images_loaded])
+        if cached_data is None:
+            batch_data = inf_transform([images_loaded])
+            images_loaded = None
+            if preprocessing_cache is not None:
+                preprocessing_cache.save(cache_key, {key: batch_data[0][key] for key in spatial_keys})
+        else:
+            batch_data = [cached_data]
         # original_affine = batch_data[0]['image_meta_dict']['original_affine']
         original_affine = batch_data[0]['image'].meta[MetaKeys.ORIGINAL_AFFINE]
+        original_shape = batch_data[0]['image'].meta.get(MetaKeys.SPATIAL_SHAPE, batch_data[0]['image'].shape[1:])
         batch_data = list_data_collate([batch_data])
         data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=torch.channels_last_3d, device=device)
-        timing_checkpoints.append(("Preprocessing", time.time()))
-
-        print('Running Inference ...')
-        with autocast(enabled=True):
-            logits = sliding_inferrer(inputs=data, network=model)
-        timing_checkpoints.append(("Inference", time.time()))
-        
-        print(f"Logits {logits.shape}")
-        # logits -> preds
-        print('Converting logits into predictions')
-        try:
-            pred = logits2pred(logits, sigmoid=sigmoid)
-        except RuntimeError as e:
-            if not logits.is_cuda:
-                raise e
-            print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
-            logits = logits.cpu()
-            pred = logits2pred(logits, sigmoid=sigmoid)
-        print(f"preds {pred.shape}")
-        timing_checkpoints.append(("Logits", time.time()))
-        logits = None
-
-        # pred = pred.cpu() # convert to CPU if the next step (reverse interpolation) is OOM on GPU
+        timing_checkpoints.append(stage_checkpoint("Preprocessing" if cached_data is None else "Preprocessing (cached)"))
+
+        mask = foreground_mask(data, batch_data.get("roi"), foreground_threshold)
+        batch_data.pop("roi", None)
+        memory_planner = None
+        if memory_budget is not None:
+            memory_planner = make_memory_planner(memory_budget, device, roi_size, data, original_shape, config, model)
+        # Only update the prediction where the input has changed since the previous run
+        previous_state = None
+        region = None
+        if incremental_state_file is not None:
+            from incremental_prediction import load_state, save_state, state_settings, update_region
+            incremental_settings = state_settings(model_file, sliding_inferrer)
+            # Affine of the preprocessed volume (after cropping and resampling)
+            preprocessed_affine = batch_data["image"].affine
+            previous_state = load_state(incremental_state_file, incremental_settings, data, preprocessed_affine)
+            if previous_state is not None:
+                region = update_region(data, previous_state[0], incremental_tolerance, incremental_margin)
+        if region is not None and not region.any():
+            print("Incremental prediction: input has not changed, using the previous prediction")
+            pred = previous_state[1].to(device)
+            timing_checkpoints.append(stage_checkpoint("Inference (no change)"))
+        else:
+            pred = predict_labels(sliding_inferrer, data, network, device, sigmoid, timing_checkpoints, mask,
+                                  memory_planner, model, region)
+            if region is not None:
+                pred = torch.where(region.to(pred.device), pred, previous_state[1].to(pred.device))
+        if incremental_state_file is not None:
+            save_state(incremental_state_file, incremental_settings, data, preprocessed_affine, pred)
+        mask = None
+        region = None
+        previous_state = None
+
         # invert loading transforms (uncrop, reverse-resample, etc)
         post_transforms_list = [Invertd(keys="pred", orig_keys="image", transform=inf_transform, nearest_interp=True)]
-        post_transforms_list.append(KeepLargestConnectedComponentd(keys="pred", num_components=2)) if 'whole-head' in model_file else post_transforms_list
+        if 'whole-head' in model_file:
+            from monai.transforms import KeepLargestConnectedComponentd
+            post_transforms_list.append(KeepLargestConnectedComponentd(keys="pred", num_components=2))
         post_transforms = Compose(post_transforms_list)
 
-        batch_data["pred"] = convert_to_dst_type(pred, batch_data["image"], dtype=pred.dtype, device=pred.device)[
-            0]  # make Meta tensor
-        pred = [post_transforms(x)["pred"] for x in decollate_batch(batch_data)]
+        pred = invert_prediction(pred, batch_data, post_transforms)
         seg = pred[0][0]
 
 
     print(f"preds inverted {seg.shape}")
-    timing_checkpoints.append(("Preds", time.time()))
+    timing_checkpoints.append(stage_checkpoint("Preds"))
 
     seg = seg.cpu().numpy().astype(np.uint8)
-    timing_checkpoints.append(("Convert to array", time.time()))
+    timing_checkpoints.append(stage_checkpoint("Convert to array"))
 
     # save result by copying all image metadata from the input, just replacing the voxel data
-    nrrd_header = nrrd.read_header(image_file)
-    nrrd.write(result_file, seg, nrrd_header)
-    timing_checkpoints.append(("Save", time.time()))
+    nrrd_header = result_header(image_file, original_affine)
+    write_labelmap(result_file, seg, nrrd_header, crop_output)
+    timing_checkpoints.append(stage_checkpoint("Save"))
+
+    if first_window_time:
+        print(f"Time to first window: {first_window_time[0] - start_time:.2f} seconds")
+    memory_mb = resident_memory_mb()
+    if memory_mb is not None:
+        print(f"Resident memory at exit: {memory_mb:.0f}MB")
+
+    print_timing_checkpoints(start_time, timing_checkpoints)
+
+    print(f'ALL DONE, result saved in {result_file}')
+
+
+def load_images(image_files):
+    """Load input volumes (dict of key: file path) as channel-first MetaTensors.
+    A directory is loaded as a DICOM series, without writing an intermediate volume file.
+    """
+    dicom_keys = [key for key, path in image_files.items() if os.path.isdir(path)]
+    file_keys = [key for key in image_files.keys() if key not in dicom_keys]
+    images_loaded = {}
+    if file_keys:
+        loader = LoadImaged(keys=file_keys, ensure_channel_first=True, dtype=None, allow_missing_keys=True, image_only=False)
+        images_loaded = loader({key: image_files[key] for key in file_keys})
+    if dicom_keys:
+        from dicom_series import load_dicom_image
+        for key in dicom_keys:
+            images_loaded[key] = load_dicom_image(image_files[key])
+    return images_loaded
+
+
+def result_header(image_file, original_affine):
+    """Get NRRD header for saving the result: the header of the input NRRD file, or created from the geometry of the input
+    (DICOM series or other volume file formats)
+    """
+    import nrrd
+    if os.path.isdir(image_file) or not image_file.lower().endswith((".nrrd", ".nhdr")):
+        from dicom_series import nrrd_header
+        return nrrd_header(np.asarray(original_affine))
+    return nrrd.read_header(image_file)
+
+
+def write_labelmap(file_path, labelmap, nrrd_header, crop=False):
+    """Write labelmap (IJK voxel order) to a NRRD file.
+    If crop is True then only the bounding box of the nonzero voxels is written, with "space origin" moved to the first
+    voxel of the box. Offset of the box and size of the full volume are stored in "crop_offset" and "uncropped_sizes"
+    fields, so that the full volume can be restored when reading. File size and writing and reading time then scale
+    with the size of the structure instead of the size of the volume.
+    """
+    import nrrd
+    if crop and "space origin" in nrrd_header and "space directions" in nrrd_header:
+        ranges = []
+        for axis in range(labelmap.ndim):
+            indices = np.flatnonzero(labelmap.any(axis=tuple(other for other in range(labelmap.ndim) if other != axis)))
+            # Empty labelmap is written as a single voxel
+            ranges.append((indices[0], indices[-1] + 1) if len(indices) else (0, 1))
+        offset = np.array([start for start, stop in ranges])
+        nrrd_header = dict(nrrd_header)
+        nrrd_header["space origin"] = np.asarray(nrrd_header["space origin"], dtype=float) + offset @ np.asarray(nrrd_header["space directions"], dtype=float)
+        nrrd_header["crop_offset"] = " ".join(str(int(index)) for index in offset)
+        nrrd_header["uncropped_sizes"] = " ".join(str(int(size)) for size in labelmap.shape)
+        labelmap = np.ascontiguousarray(labelmap[tuple(slice(start, stop) for start, stop in ranges)])
+    nrrd.write(file_path, labelmap, nrrd_header)
+
+
+def read_labelmap(file_path, shape=None):
+    """Read labelmap written by write_labelmap (IJK voxel order), a cropped labelmap is restored to the full volume size.
+    :param shape: size of the volume that the labelmap must match (ValueError is raised if the size is different)
+    """
+    import nrrd
+    labelmap, header = nrrd.read(file_path)
+    if "crop_offset" in header:
+        offset = [int(index) for index in header["crop_offset"].split()]
+        full_labelmap = np.zeros([int(size) for size in header["uncropped_sizes"].split()], dtype=labelmap.dtype)
+        full_labelmap[tuple(slice(start, start + size) for start, size in zip(offset, labelmap.shape))] = labelmap
+        labelmap = full_labelmap
+    if shape is not None and tuple(labelmap.shape) != tuple(shape):
+        raise ValueError(f"Labelmap {file_path} size {tuple(labelmap.shape)} does not match image size {tuple(shape)}")
+    return labelmap
+
+
+def composite_layout(image, layout_file):
+    """Add probe layout (labelmap file, 1 = needle, 2 = urethra) to the image (channel-first MetaTensor).
+    The composited input of the iceball model is image + 1000 * layout.
+    """
+    layout = read_labelmap(layout_file, image.shape[1:])
+    return image[:1] + 1000 * torch.as_tensor(layout[None], dtype=torch.float32)
+
+
+def make_memory_planner(memory_budget, device, roi_size, data, original_shape, config, model):
+    """Create memory planner and choose inference level that fits into memory_budget (bytes)"""
+    from memory_planning import MemoryPlanner, format_bytes
+    network_config = config.get("network", {})
+    # Memory that is already in use (libraries, network, preprocessed input) is part of the budget
+    if device.type == "cuda":
+        baseline_bytes = torch.cuda.memory_allocated(device)
+    else:
+        memory_mb = resident_memory_mb()
+        baseline_bytes = int(memory_mb * 1024 * 1024) if memory_mb is not None else None
+    memory_planner = MemoryPlanner(memory_budget, device, roi_size, data.shape[2:], original_shape,
+                                   input_channels=data.shape[1],
+                                   output_channels=network_config.get("out_channels", 2),
+                                   init_filters=network_config.get("init_filters", 32),
+                                   model_bytes=sum(p.numel() * p.element_size() for p in model.parameters()),
+                                   baseline_bytes=baseline_bytes)
+    if not memory_planner.choose_level():
+        print(f"Warning: estimated memory usage exceeds the memory budget of {format_bytes(memory_planner.budget)}")
+    print(f"Memory budget {format_bytes(memory_planner.budget)}: {memory_planner.describe()}")
+    return memory_planner
+
+
+def invert_prediction(pred, batch_data, post_transforms):
+    """Invert preprocessing transforms (uncrop, reverse-resample, etc.) on the prediction.
+    If it runs out of GPU memory then it is retried on CPU.
+    """
+    while True:
+        try:
+            batch_data["pred"] = convert_to_dst_type(pred, batch_data["image"], dtype=pred.dtype, device=pred.device)[
+                0]  # make Meta tensor
+            return [post_transforms(x)["pred"] for x in decollate_batch(batch_data)]
+        except Exception as e:
+            from memory_planning import is_out_of_memory_error
+            if not pred.is_cuda or not is_out_of_memory_error(e):
+                raise
+            print(f"Out of memory while inverting transforms on GPU, retrying on CPU {pred.shape}")
+        batch_data.pop("pred", None)
+        pred = pred.cpu()
+        torch.cuda.empty_cache()
+
+
+def foreground_mask(data, roi=None, foreground_threshold=None):
+    """Get mask of the region where the sliding windows must be evaluated.
+
+    :param data: preprocessed network input
+    :param roi: ROI mask, resampled the same way as the input (None if not used)
+    :param foreground_threshold: voxels of the first input channel above this value (after intensity normalization) are foreground
+    """
+    mask = None
+    if foreground_threshold is not None:
+        mask = data[:, :1] > float(foreground_threshold)
+    if roi is not None:
+        roi_mask = roi.as_subclass(torch.Tensor).to(device=data.device) > 0.5
+        mask = roi_mask if mask is None else (mask & roi_mask)
+    return mask
+
+
+def print_sliding_inferrer_info(sliding_inferrer):
+    if hasattr(sliding_inferrer, "used_worker_count"):
+        print(f"Parallel sliding window inference: {sliding_inferrer.window_count} windows, {sliding_inferrer.used_worker_count} workers")
+    else:
+        print("Sliding window inference: SlidingWindowInfererAdapt")
+
+
+def make_inference_transform(config, keys, spatial_keys=("image",)):
+    """Create preprocessing transform chain for image keys.
+    Spatial transforms are applied to spatial_keys ("image" is the concatenated image, optionally followed by "roi" mask).
+    """
+    spatial_keys = list(spatial_keys)
+    # make input Transform chain
+    main_normalize_mode = config["normalize_mode"]
+    intensity_bounds = config["intensity_bounds"]
+    if len(keys) == 1:  # only one input image
+        ts = [
+            ConcatItemsd(keys=keys, name="image", dim=0),
+            EnsureTyped(keys="image", data_type="tensor", dtype=torch.float, allow_missing_keys=True)
+        ]
+        _add_normalization_transforms(ts, "image", main_normalize_mode, intensity_bounds)
+    else:  # multiple input images
+        ts = [
+        ]
 
+        extra_modalities = OrderedDict(config['extra_modalities'])
+        normalize_modes = [main_normalize_mode] + list(extra_modalities.values())
+        for key, normalize_mode in zip(keys, normalize_modes):
+            _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds)
+        ts.extend([
+            ConcatItemsd(keys=keys, name="image", dim=0),
+            EnsureTyped(keys="image", data_type="tensor", dtype=torch.float, allow_missing_keys=True)
+        ])
+
+    if config.get("orientation_ras", False):
+        print('Using orientation_ras')
+        # we assume LPS physical coordinate system orientation
+        # This code is only tested with NRRD files that use LPS space
+        ts.append(Orientationd(keys=spatial_keys, axcodes="RAS"))  # reorient #
+    if config.get("crop_foreground", True):
+        print('Using crop_foreground')
+        ts.append(CropForegroundd(keys=spatial_keys, source_key="image1", margin=10, allow_smaller=True))  # subcrop
+
+    if config.get("resample_resolution", None) is not None:
+        pixdim = list(config["resample_resolution"])
+        print(f'Using resample with  resample_resolution {pixdim}')
+
+        ts.append(
+            Spacingd(
+                keys=spatial_keys,
+                pixdim=list(pixdim),
+                mode=["bilinear", "nearest"][:len(spatial_keys)],
+                dtype=torch.float,
+                min_pixdim=np.array(pixdim) * 0.75,
+                max_pixdim=np.array(pixdim) * 1.25,
+                allow_missing_keys=True,
+            )
+        )
+
+    return Compose(ts)
+
+
+def print_timing_checkpoints(start_time, timing_checkpoints):
     print("Computation time log:")
     previous_start_time = start_time
     for timing_checkpoint in timing_checkpoints:
-        print(f"  {timing_checkpoint[0]}: {timing_checkpoint[1] - previous_start_time:.2f} seconds")
+        line = f"  {timing_checkpoint[0]}: {timing_checkpoint[1] - previous_start_time:.2f} seconds"
+        memory = []
+        if len(timing_checkpoint) > 2 and timing_checkpoint[2] is not None:
+            memory.append(f"peak memory {timing_checkpoint[2]:.0f}MB")
+        if len(timing_checkpoint) > 3 and timing_checkpoint[3] is not None:
+            memory.append(f"peak GPU memory {timing_checkpoint[3]:.0f}MB")
+        if memory:
+            line += f" ({', '.join(memory)})"
+        print(line)
         previous_start_time = timing_checkpoint[1]
 
-    print(f'ALL DONE, result saved in {result_file}')
-
 
 def _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds):
+    from monai.transforms import Lambdad, NormalizeIntensityd, ScaleIntensityRanged
     if normalize_mode == "none":
         pass
     elif normalize_mode in ["range", "ct"]:
@@ -354,4 +885,5 @@ def _add_normalization_transforms(ts, key, normalize_mode, intensity_bounds):
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(main)
@@ -0,0 +1,150 @@
+"""Loading a DICOM series directly in the inference script, without exporting it to a volume file first.
+
+Each slice is decoded and copied into a preallocated volume array, so the volume is not assembled from a list of slice
+arrays. Slices are decoded one after the other: pydicom parses files in pure Python while holding the GIL, and decoding
+with a thread pool only overlapped file reading and rescaling with parsing. Its speedup could not be confirmed
+(200 slices of 512x512 voxels took 0.50 seconds with 1 thread and 0.41 seconds with 4 threads, measured on a single-core
+machine), therefore it is not used.
+The geometry is computed from the slice position and orientation the same way as in Slicer's DICOM scalar volume
+reader: i = column, j = row, k = slice, slices are ordered along the slice normal and the origin is the position
+of the first slice.
+
+pydicom is not installed by this module, the pydicom package that is bundled with Slicer is used.
+
+The volume is returned as a MetaTensor with the same metadata as LoadImaged creates for a NRRD file (RAS affine,
+channel first), so it can be passed directly to the preprocessing transforms. The NRRD header of the result
+is created from the same geometry.
+"""
+
+import os
+import time
+
+import numpy as np
+
+# Relative difference of slice spacings that is accepted as uniform spacing
+SLICE_SPACING_TOLERANCE = 0.01
+
+# Converts between LPS and RAS coordinate systems
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def series_files(directory):
+    """Get all files in the directory (recursively), except hidden files"""
+    files = []
+    for folder_path, folder_names, file_names in os.walk(directory):
+        folder_names[:] = [name for name in folder_names if not name.startswith(".")]
+        files.extend(os.path.join(folder_path, name) for name in file_names if not name.startswith("."))
+    return sorted(files)
+
+
+def read_slice_header(file_path):
+    """Read DICOM header of a slice, returns None if the file is not an image slice"""
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    try:
+        dataset = pydicom.dcmread(file_path, stop_before_pixels=True)
+    except InvalidDicomError:
+        return None
+    if "ImagePositionPatient" not in dataset or "ImageOrientationPatient" not in dataset:
+        return None
+    return dataset
+
+
+def slice_geometry(headers):
+    """Get slice order and LPS affine (IJK to LPS) of the volume from the slice headers.
+    :return: (list of header indices ordered along the slice normal, 4x4 affine)
+    """
+    orientation = np.array(headers[0].ImageOrientationPatient, dtype=float)
+    row_direction = orientation[:3]
+    column_direction = orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    for header in headers[1:]:
+        if not np.allclose(np.array(header.ImageOrientationPatient, dtype=float), orientation, atol=1e-3):
+            raise ValueError("Slices of the DICOM series have different orientations")
+
+    positions = np.array([np.array(header.ImagePositionPatient, dtype=float) for header in headers])
+    distances = positions @ normal
+    slice_order = [int(index) for index in np.argsort(distances, kind="stable")]
+    slice_spacing = 1.0
+    if len(headers) > 1:
+        spacings = np.diff(distances[slice_order])
+        slice_spacing = float(np.median(spacings))
+        if slice_spacing <= 0 or np.any(np.abs(spacings - slice_spacing) > SLICE_SPACING_TOLERANCE * slice_spacing):
+            raise ValueError("DICOM series does not have uniform slice spacing (it may contain multiple volumes)")
+
+    # PixelSpacing is (spacing between rows, spacing between columns)
+    pixel_spacing = np.array(headers[0].get("PixelSpacing", [1.0, 1.0]), dtype=float)
+    affine = np.eye(4)
+    affine[:3, 0] = row_direction * pixel_spacing[1]
+    affine[:3, 1] = column_direction * pixel_spacing[0]
+    affine[:3, 2] = normal * slice_spacing
+    affine[:3, 3] = positions[slice_order[0]]
+    return slice_order, affine
+
+
+def load_dicom_series(directory):
+    """Decode all slices of a DICOM series directory into a volume.
+    :return: (float32 volume in IJK order, 4x4 IJK to LPS affine)
+    """
+    import pydicom
+    start_time = time.time()
+    files = series_files(directory)
+    headers = [read_slice_header(file) for file in files]
+    slice_files = [file for file, header in zip(files, headers) if header is not None]
+    headers = [header for header in headers if header is not None]
+    if not headers:
+        raise ValueError(f"No DICOM image slices found in {directory}")
+    series_uids = {header.get("SeriesInstanceUID") for header in headers}
+    if len(series_uids) > 1:
+        raise ValueError(f"Directory {directory} contains {len(series_uids)} DICOM series, it must contain only one")
+    slice_order, affine = slice_geometry(headers)
+
+    rows = int(headers[0].Rows)
+    columns = int(headers[0].Columns)
+    # Each slice is stored contiguously (KJI order), the IJK volume is a transposed view of it
+    volume = np.empty((len(slice_order), rows, columns), dtype=np.float32)
+    decoded_bytes = 0
+    for k, header_index in enumerate(slice_order):
+        dataset = pydicom.dcmread(slice_files[header_index])
+        pixels = dataset.pixel_array
+        if pixels.shape != (rows, columns):
+            raise ValueError(f"Slice {slice_files[header_index]} size {pixels.shape} does not match the series size {(rows, columns)}")
+        slope = float(dataset.get("RescaleSlope", 1.0))
+        intercept = float(dataset.get("RescaleIntercept", 0.0))
+        np.multiply(pixels, slope, out=volume[k], casting="unsafe")
+        volume[k] += intercept
+        decoded_bytes += pixels.nbytes
+
+    elapsed_time = max(time.time() - start_time, 1e-6)
+    print(f"DICOM series decoded: {len(slice_order)} slices, {elapsed_time:.2f} seconds"
+          f" ({len(slice_order) / elapsed_time:.0f} slices/s, {decoded_bytes / elapsed_time / 1e6:.0f} MB/s)")
+    return volume.transpose(2, 1, 0), affine
+
+
+def load_dicom_image(directory):
+    """Load a DICOM series as a channel-first MetaTensor, with the same metadata as LoadImaged creates"""
+    import torch
+    from monai.data import MetaTensor
+    from monai.utils import MetaKeys, SpaceKeys
+    volume, affine = load_dicom_series(directory)
+    affine = LPS_TO_RAS @ affine
+    meta = {
+        MetaKeys.ORIGINAL_AFFINE: affine.copy(),
+        MetaKeys.SPATIAL_SHAPE: np.array(volume.shape),
+        MetaKeys.SPACE: SpaceKeys.RAS,
+        MetaKeys.ORIGINAL_CHANNEL_DIM: float("nan"),
+        "filename_or_obj": directory,
+        }
+    return MetaTensor(torch.from_numpy(volume)[None], affine=torch.as_tensor(affine, dtype=torch.float64), meta=meta)
+
+
+def nrrd_header(affine):
+    """Create NRRD header for a result volume from the original RAS affine of the input"""
+    affine = LPS_TO_RAS @ np.asarray(affine, dtype=float)
+    return {
+        "space": "left-posterior-superior",
+        "space directions": affine[:3, :3].T,
+        "space origin": affine[:3, 3],
+        "kinds": ["domain", "domain", "domain"],
+        "encoding": "gzip",
+        }
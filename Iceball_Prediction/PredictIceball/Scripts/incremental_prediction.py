@@ -0,0 +1,102 @@
+"""Incremental prediction: only re-evaluate the part of the volume that has changed since the previous run.
+
+The preprocessed network input and the predicted labels (in the preprocessed geometry) of the previous run
+are stored in a state file. In the next run, the new input is compared to the stored one, and the changed voxels,
+dilated by a margin, form the update region. Only the sliding windows that overlap with the update region are
+evaluated, and the labels outside of the region are taken from the previous run.
+
+This is a heuristic, it must be explicitly enabled and it has known limits:
+
+- A change of the input changes the output within the receptive field of the network around it. Labels outside
+  of the update region can be stale if the margin is smaller than the receptive field radius (in preprocessed voxels).
+  Labels inside the region are the same as in a full run only if the margin is at least the receptive field radius.
+- Changes below the tolerance are ignored. Normalization with statistics of the whole volume (such as "meanstd")
+  changes all voxels slightly when any part of the image changes, these changes are not propagated.
+
+The previous state is not used if the model, the sliding window settings, or the geometry of the preprocessed volume
+is different. The state file contains patient images, so the caller must use a separate state file for each study
+in a temporary location and delete it when processing is finished.
+"""
+
+import os
+
+import torch
+import torch.nn.functional as F
+
+
+STATE_VERSION = 1
+
+
+def state_settings(model_file, sliding_inferrer):
+    """Settings that must be the same in the previous and the current run for the previous state to be usable"""
+    model_file = os.path.abspath(model_file)
+    return {
+        "version": STATE_VERSION,
+        "model": f"{model_file}:{os.path.getsize(model_file)}:{os.path.getmtime(model_file)}",
+        "roi_size": list(sliding_inferrer.roi_size),
+        "overlap": sliding_inferrer.overlap,
+        "mode": sliding_inferrer.mode,
+        "sigma_scale": sliding_inferrer.sigma_scale,
+        "sigmoid": sliding_inferrer.sigmoid,
+        }
+
+
+def load_state(state_file, settings, data, affine):
+    """Get previous (input, labels) if they can be used for updating the prediction of data, None otherwise"""
+    if not os.path.exists(state_file):
+        print("Incremental prediction: no previous state, running full prediction")
+        return None
+    try:
+        state = torch.load(state_file, map_location="cpu", weights_only=False)
+    except Exception as e:
+        print(f"Incremental prediction: failed to read previous state from {state_file} ({e}), running full prediction")
+        return None
+    if state.get("settings") != settings:
+        print("Incremental prediction: model or inference settings changed, running full prediction")
+        return None
+    if state["input"].shape != data.shape or not torch.allclose(state["affine"].double(), torch.as_tensor(affine).double().cpu()):
+        print("Incremental prediction: volume geometry changed, running full prediction")
+        return None
+    return state["input"], state["labels"]
+
+
+def save_state(state_file, settings, data, affine, labels):
+    """Store the input and the predicted labels for the next incremental prediction.
+    The file is written atomically, so that a failed run does not leave a partially written state.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+    temp_file = f"{state_file}.{os.getpid()}.tmp"
+    torch.save({"settings": settings, "input": data.cpu(), "affine": torch.as_tensor(affine).cpu(), "labels": labels.cpu()}, temp_file)
+    os.replace(temp_file, state_file)
+
+
+def dilate(mask, margin):
+    """Dilate mask (1, 1, spatial dimensions) by margin voxels (box structuring element).
+    Dilation is done separately along each axis, which is much faster than a single 3D max pooling.
+    """
+    if margin <= 0:
+        return mask
+    dilated = mask.to(torch.float16 if mask.is_cuda else torch.float32)
+    spatial_dims = mask.dim() - 2
+    for axis in range(spatial_dims):
+        kernel_size = [1] * spatial_dims
+        kernel_size[axis] = 2 * margin + 1
+        padding = [0] * spatial_dims
+        padding[axis] = margin
+        dilated = F.max_pool3d(dilated, kernel_size=kernel_size, stride=1, padding=padding)
+    return dilated > 0
+
+
+def update_region(data, previous_data, tolerance=0.1, margin=16):
+    """Get mask (1, 1, spatial dimensions) of voxels where the prediction has to be updated.
+
+    :param data: current preprocessed input (1, channels, spatial dimensions)
+    :param previous_data: preprocessed input of the previous run
+    :param tolerance: voxels where the input changed less than this value (in normalized intensity units) are unchanged
+    :param margin: the changed region is dilated by this many voxels
+    """
+    changed = ((data - previous_data.to(device=data.device, dtype=data.dtype)).abs() > tolerance).any(dim=1, keepdim=True)
+    changed_voxel_count = int(changed.sum())
+    region = dilate(changed, int(margin))
+    print(f"Incremental prediction: {changed_voxel_count} changed voxels, update region is {int(region.sum()) / region.numel():.1%} of the volume")
+    return region
@@ -0,0 +1,235 @@
+"""Find the fastest sliding window inference settings on the local machine.
+
+Each model is run on a representative volume (or on a synthetic volume) with all combinations of the settings
+in the search grid. Each combination is run once for warm-up (one-time initializations, thread pool startup)
+and then the median computation time of several runs is used, so that a single slow or fast run does not decide.
+Results are compared to a reference-quality prediction (default settings), and the fastest combination that gives
+results similar enough to the reference is stored in the tuning file, for the model and the hardware fingerprint
+of this machine.
+
+Two results are stored: the fastest settings that do not change the output (window batch size and number of workers,
+with the default overlap and blending mode), and the fastest settings overall (overlap and blending mode change the
+output). The inference script only uses the output-invariant settings, unless tuned accuracy settings are
+explicitly allowed (see tuned_settings()).
+
+Usage:
+
+    PythonSlicer inference_tuning.py --model-folder <folder> --tuning-file <file> [--image-file <file>]
+"""
+
+import json
+import os
+import time
+
+
+TUNING_FILE_VERSION = 2
+
+# Settings that only affect the computation time, not the output
+OUTPUT_INVARIANT_SETTINGS = ("sw_batch_size", "sw_workers")
+
+
+def hardware_fingerprint():
+    """String that identifies the processing hardware and software (CPU, memory, GPU, torch version)"""
+    import hashlib
+    import platform
+    import torch
+    from sliding_window import cpu_core_count
+    items = [platform.machine(), platform.processor(), str(cpu_core_count()), torch.__version__]
+    try:
+        import psutil
+        items.append(f"{psutil.virtual_memory().total // (1024 * 1024 * 1024)}GB")
+    except ImportError:
+        pass
+    if torch.cuda.is_available():
+        items.extend(torch.cuda.get_device_name(index) for index in range(torch.cuda.device_count()))
+    return hashlib.sha256("|".join(items).encode()).hexdigest()[:16]
+
+
+def model_key(model_file):
+    """String that identifies the model file (model folder name contains the model version)"""
+    model_file = os.path.abspath(model_file)
+    return f"{os.path.basename(os.path.dirname(model_file))}/{os.path.basename(model_file)}:{os.path.getsize(model_file)}"
+
+
+def read_tuning_file(tuning_file):
+    try:
+        with open(tuning_file, encoding="utf-8") as f:
+            tuning = json.load(f)
+        if tuning.get("version") == TUNING_FILE_VERSION:
+            return tuning
+    except (OSError, ValueError):
+        pass
+    return {"version": TUNING_FILE_VERSION, "settings": {}}
+
+
+def write_tuning_file(tuning_file, tuning):
+    os.makedirs(os.path.dirname(os.path.abspath(tuning_file)), exist_ok=True)
+    temp_file = f"{tuning_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(tuning, f, indent=2)
+    os.replace(temp_file, tuning_file)
+
+
+def tuned_settings(tuning_file, model_file, accuracy_settings=False):
+    """Get stored settings for the model on this machine. Returns None if the model has not been tuned on this machine.
+    Only output-invariant settings (sw_batch_size, sw_workers) are returned, unless accuracy_settings is True
+    (then overlap and blend_mode are returned, too, which may change the output).
+    """
+    entry = read_tuning_file(tuning_file)["settings"].get(f"{model_key(model_file)}|{hardware_fingerprint()}")
+    if not entry:
+        return None
+    if accuracy_settings:
+        return entry["settings"]
+    return {name: value for name, value in entry["output_invariant"]["settings"].items() if name in OUTPUT_INVARIANT_SETTINGS}
+
+
+def dice(labels, reference_labels):
+    """Mean Dice coefficient of foreground labels. Returns 1.0 if there is no foreground in either of them."""
+    import torch
+    label_values = [value for value in torch.unique(torch.cat([labels.flatten(), reference_labels.flatten()])).tolist() if value != 0]
+    if not label_values:
+        return 1.0
+    scores = []
+    for value in label_values:
+        mask = labels == value
+        reference_mask = reference_labels == value
+        scores.append(2.0 * (mask & reference_mask).sum().item() / (mask.sum().item() + reference_mask.sum().item()))
+    return sum(scores) / len(scores)
+
+
+def load_input(config, image_file=None, synthetic_size=2.0):
+    """Get preprocessed network input from image_file. If image_file is not specified then a synthetic volume is created,
+    which is synthetic_size times larger than the window size.
+    """
+    import torch
+    from monai.data import list_data_collate
+    from monai.transforms import LoadImaged
+    import auto3dseg_segresnet_inference as inference
+
+    if image_file is not None:
+        images_loaded = LoadImaged(keys=["image1"], ensure_channel_first=True, dtype=None, image_only=False)({"image1": image_file})
+        inf_transform = inference.make_inference_transform(config, ["image1"])
+        batch_data = list_data_collate([inf_transform([images_loaded])])
+        return batch_data["image"].as_subclass(torch.Tensor)
+
+    # Smooth random volume, so that the network output has some structure
+    generator = torch.Generator().manual_seed(0)
+    input_channels = config["network"].get("in_channels", 1)
+    shape = [int(length * synthetic_size) for length in config["roi_size"]]
+    data = torch.rand([1, input_channels] + [max(length // 8, 1) for length in shape], generator=generator)
+    data = torch.nn.functional.interpolate(data, size=shape, mode="trilinear")
+    return (data - data.mean()) / data.std()
+
+
+def search_grid(batch_sizes, workers, overlaps, blend_modes):
+    import itertools
+    for sw_batch_size, sw_workers, overlap, blend_mode in itertools.product(batch_sizes, workers, overlaps, blend_modes):
+        yield {"sw_batch_size": sw_batch_size, "sw_workers": sw_workers, "overlap": overlap, "blend_mode": blend_mode}
+
+
+def run_settings(model, config, data, device, settings, repeats=3):
+    """Run inference with the specified settings: once for warm-up, then repeats times.
+    Returns (labels, median computation time).
+    """
+    import statistics
+    computation_times = []
+    for run_index in range(repeats + 1):
+        labels, computation_time = run_settings_once(model, config, data, device, settings)
+        if run_index > 0:
+            computation_times.append(computation_time)
+    return labels, statistics.median(computation_times)
+
+
+def run_settings_once(model, config, data, device, settings):
+    """Run inference with the specified settings once. Returns (labels, computation time)."""
+    import torch
+    import auto3dseg_segresnet_inference as inference
+    sliding_inferrer = inference.make_sliding_inferrer(config["roi_size"], settings["sw_workers"], aggregation="labels",
+                                                       sigmoid=config.get("sigmoid", False), sw_batch_size=settings["sw_batch_size"],
+                                                       overlap=settings["overlap"], blend_mode=settings["blend_mode"])
+    sliding_inferrer.progress = False
+    start_time = time.time()
+    with torch.no_grad(), inference.autocast(device):
+        labels = sliding_inferrer(inputs=data, network=model)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return labels.cpu(), time.time() - start_time
+
+
+def tune_model(model_file, image_file=None, batch_sizes=(1, 2, 4), workers=None, overlaps=(0.625, 0.5, 0.25),
+               blend_modes=("gaussian", "constant"), min_dice=0.95, synthetic_size=2.0, repeats=3):
+    """Find the fastest acceptable settings for a model.
+    Returns dict with the settings, computation time, and Dice score, and the same for the fastest output-invariant
+    settings in "output_invariant".
+    """
+    import torch
+    import auto3dseg_segresnet_inference as inference
+    from sliding_window import cpu_core_count
+
+    if workers is None:
+        workers = sorted(set([1, max(cpu_core_count() // 2, 1), cpu_core_count()]))
+
+    device = torch.device("cpu") if torch.cuda.device_count() == 0 else torch.device(0)
+    model, config, _ = inference.load_model(model_file, device)
+    data = load_input(config, image_file, synthetic_size).to(memory_format=torch.channels_last_3d, device=device)
+    print(f"Tuning {model_file} on input {tuple(data.shape)}")
+
+    # Reference: default settings
+    reference_settings = {"sw_batch_size": 1, "sw_workers": 1, "overlap": 0.625, "blend_mode": "gaussian"}
+    reference_labels, reference_time = run_settings(model, config, data, device, reference_settings, repeats)
+    print(f"  Reference {reference_settings}: {reference_time:.2f} seconds (median of {repeats} runs)")
+
+    best = {"settings": reference_settings, "time": reference_time, "dice": 1.0}
+    best_output_invariant = dict(best)
+    for settings in search_grid(batch_sizes, workers, overlaps, blend_modes):
+        try:
+            labels, computation_time = run_settings(model, config, data, device, settings, repeats)
+        except RuntimeError as e:
+            # For example, out of memory
+            print(f"  {settings}: failed ({e})")
+            continue
+        score = dice(labels, reference_labels)
+        acceptable = score >= min_dice
+        print(f"  {settings}: {computation_time:.2f} seconds, Dice {score:.4f}{'' if acceptable else ' (rejected)'}")
+        if not acceptable:
+            continue
+        if computation_time < best["time"]:
+            best = {"settings": settings, "time": computation_time, "dice": score}
+        output_invariant = all(settings[name] == reference_settings[name] for name in settings if name not in OUTPUT_INVARIANT_SETTINGS)
+        if output_invariant and computation_time < best_output_invariant["time"]:
+            best_output_invariant = {"settings": settings, "time": computation_time, "dice": score}
+    print(f"  Fastest: {best['settings']} {best['time']:.2f} seconds ({reference_time / best['time']:.1f}x speedup)")
+    print(f"  Fastest output-invariant: {best_output_invariant['settings']} {best_output_invariant['time']:.2f} seconds"
+          f" ({reference_time / best_output_invariant['time']:.1f}x speedup)")
+    best["output_invariant"] = best_output_invariant
+    return best
+
+
+def main(model_folder=None, model_file=None, tuning_file=None, image_file=None, batch_sizes=(1, 2, 4), workers=None,
+         overlaps=(0.625, 0.5, 0.25), blend_modes=("gaussian", "constant"), min_dice=0.95, synthetic_size=2.0, repeats=3):
+    """Tune all models (*.pt files) in model_folder, or a single model_file, and store the results in tuning_file"""
+    if tuning_file is None:
+        raise ValueError("tuning_file must be specified")
+    if model_file is not None:
+        model_files = [model_file]
+    elif model_folder is not None:
+        model_files = sorted(os.path.join(model_folder, name) for name in os.listdir(model_folder)
+                             if name.endswith(".pt") and not name.endswith(".mmap.pt"))
+    else:
+        raise ValueError("model_folder or model_file must be specified")
+
+    fingerprint = hardware_fingerprint()
+    for current_model_file in model_files:
+        best = tune_model(current_model_file, image_file, batch_sizes, workers, overlaps, blend_modes, min_dice, synthetic_size, repeats)
+        best["tuned"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        # Re-read the file before each update, as other models may have been tuned in the meantime
+        tuning = read_tuning_file(tuning_file)
+        tuning["settings"][f"{model_key(current_model_file)}|{fingerprint}"] = best
+        write_tuning_file(tuning_file, tuning)
+
+    print(f"Tuning results saved in {tuning_file}")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
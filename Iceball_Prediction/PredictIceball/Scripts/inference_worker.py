@@ -0,0 +1,75 @@
+"""Persistent inference process, that keeps models loaded between runs.
+
+Each run of auto3dseg_segresnet_inference.py in a new process spends several seconds with importing torch and MONAI
+and loading the model, before the input is even read. The worker runs the inference script (with the same command-line
+arguments) for each request in the same process, therefore modules are only imported once and each model is only
+loaded once (it is loaded again if the model file is modified).
+
+The worker is started by the module logic (see InferenceWorker in PredictIceballLib):
+
+    PythonSlicer inference_worker.py
+
+It listens on a local port and prints its address ("INFERENCE_WORKER_ADDRESS <host>:<port>"). Requests are received
+over this connection, which is authenticated by the key in the PREDICTICEBALL_WORKER_AUTHKEY environment variable
+(hexadecimal). Requests are processed one after the other:
+
+    {"args": [...]}: run the inference script with these command-line arguments
+    {"load_models": [...]}: load the models in advance, so that the first run that uses them does not wait for loading
+
+Each request is answered by {"returnCode": ..., "error": ...} (return code 0 means success) after its output is flushed.
+Output of the runs is written to the standard output. The worker exits when the connection is closed.
+"""
+
+import os
+import sys
+from multiprocessing.connection import Listener
+
+ADDRESS_PREFIX = "INFERENCE_WORKER_ADDRESS"
+AUTHKEY_ENVIRONMENT_VARIABLE = "PREDICTICEBALL_WORKER_AUTHKEY"
+
+
+def handle_request(inference, request):
+    """Process a request, returns the response"""
+    import traceback
+    try:
+        if "load_models" in request:
+            device = inference.inference_device()
+            for model_file in request["load_models"]:
+                print(f"Loading model {model_file}...")
+                inference.get_model(model_file, device)
+        else:
+            import fire
+            fire.Fire(inference.main, command=[str(arg) for arg in request["args"]])
+        return {"returnCode": 0}
+    except SystemExit as e:
+        # fire exits if the arguments are invalid
+        return_code = e.code if isinstance(e.code, int) else 1
+        return {"returnCode": return_code, "error": f"Exited with return code {return_code}" if return_code else None}
+    except Exception as e:
+        traceback.print_exc()
+        return {"returnCode": 1, "error": str(e)}
+
+
+def main():
+    authkey = bytes.fromhex(os.environ[AUTHKEY_ENVIRONMENT_VARIABLE])
+    with Listener(("127.0.0.1", 0), authkey=authkey) as listener:
+        host, port = listener.address
+        # Address is reported before importing the inference script, so that the client can connect while modules are imported
+        print(f"{ADDRESS_PREFIX} {host}:{port}", flush=True)
+        with listener.accept() as connection:
+            import auto3dseg_segresnet_inference as inference
+            inference.keep_models_loaded = True
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    # Client closed the connection
+                    break
+                response = handle_request(inference, request)
+                sys.stdout.flush()
+                sys.stderr.flush()
+                connection.send(response)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""Iceball prediction for multiple candidate probe layouts of the same scan, in one inference pass.
+
+The input of the iceball model is the scan with the needle and urethra masks added to it (composited input).
+Each layout is specified by a uint8 label volume (1 = needle, 2 = urethra), the composited input of the layout
+is image + 1000 * layout. The composited inputs are stored as channels of one image, so that loading the scan
+and computing the spatial transforms (cropping, resampling) is only done once. For inference, the channels are moved
+to the batch dimension: each network call evaluates the same windows for all layouts.
+
+Layouts are only processed together if this gives the same result as processing each of them alone:
+the foreground cropping box (computed from the composited input) must be the same for all layouts of a group,
+and the intensity normalization must be computed for each channel separately. Layouts that have a different cropping
+box are processed in separate groups, and if the normalization mode is not channel-wise then each layout is processed
+alone.
+
+Usage:
+
+    PythonSlicer layout_inference.py --model-file <file> --image-file <file> --layout-files <file1>,<file2>,... --result-files <file1>,<file2>,...
+"""
+
+import time
+script_start_time = time.time()
+
+import numpy as np
+import torch
+from monai.data import list_data_collate
+from monai.transforms import Compose, Invertd
+from monai.utils import MetaKeys
+
+import auto3dseg_segresnet_inference as inference
+
+
+def split_file_list(files):
+    """Get list of files from a comma-separated string (or from a list, as fire may parse the argument as a tuple)"""
+    if isinstance(files, str):
+        files = files.split(",")
+    return [str(file) for file in files]
+
+
+# Normalization modes that are computed for each channel (or voxel) separately
+CHANNEL_WISE_NORMALIZE_MODES = ["none", "range", "ct", "meanstd", "mri", "meanstdtanh"]
+
+
+def layout_groups(image, config):
+    """Group layouts (channels of image) that can be processed together, with the same preprocessing as each layout alone.
+    :return: list of lists of channel indices
+    """
+    channel_count = image.shape[0]
+    if config["normalize_mode"] not in CHANNEL_WISE_NORMALIZE_MODES:
+        print(f"Normalization mode {config['normalize_mode']} is not channel-wise, layouts are processed one by one")
+        return [[channel] for channel in range(channel_count)]
+    if not config.get("crop_foreground", True):
+        return [list(range(channel_count))]
+    from monai.transforms.utils import generate_spatial_bounding_box
+    groups = {}
+    for channel in range(channel_count):
+        # Same bounding box as CropForegroundd computes in the preprocessing transform (reorientation changes the box
+        # of all channels the same way, so layouts that have the same box here have the same box after reorientation)
+        box_start, box_end = generate_spatial_bounding_box(image[channel:channel + 1], margin=10, allow_smaller=True)
+        groups.setdefault((tuple(box_start), tuple(box_end)), []).append(channel)
+    return list(groups.values())
+
+
+def load_layouts(image_file, layout_files):
+    """Load composited inputs of all layouts as a multi-channel image (one channel for each layout)"""
+    image = inference.load_images({"image1": image_file})["image1"]
+    channels = [inference.composite_layout(image, layout_file) for layout_file in layout_files]
+    return {"image1": torch.cat(channels, dim=0)}
+
+
+@torch.no_grad()
+def main(model_file=None, image_file=None, layout_files=None, result_files=None, weights_cache=True, sw_workers=None,
+         aggregation="labels", accumulator_dtype="float32", foreground_threshold=None, sw_batch_size=None, overlap=None,
+         blend_mode=None, tuning_file=None, tuning_accuracy_settings=False, crop_output=False, **kwargs):
+    start_time = script_start_time
+    timing_checkpoints = [("Importing modules", time.time())]
+    if model_file is None or image_file is None or layout_files is None or result_files is None:
+        raise ValueError("model_file, image_file, layout_files, and result_files must be specified")
+    layout_files = split_file_list(layout_files)
+    result_files = split_file_list(result_files)
+    if len(layout_files) != len(result_files):
+        raise ValueError(f"Number of layout files ({len(layout_files)}) and result files ({len(result_files)}) must be the same")
+    if kwargs:
+        print(f"Options not used for layout evaluation: {', '.join(kwargs.keys())}")
+
+    device = torch.device("cpu") if torch.cuda.device_count() == 0 else torch.device(0)
+    model, config, _ = inference.load_model(model_file, device, use_weights_cache=weights_cache)
+    if config["network"].get("in_channels", 1) != 1 or config.get("sigmoid", False):
+        raise ValueError("Layout evaluation requires a model with a single input channel and softmax output")
+    if tuning_file is not None:
+        from inference_tuning import tuned_settings
+        # Overlap and blending mode change the output, they are only used if tuning_accuracy_settings is enabled
+        settings = tuned_settings(tuning_file, model_file, tuning_accuracy_settings)
+        if settings:
+            print(f"Using tuned inference settings: {settings}")
+            sw_batch_size = sw_batch_size if sw_batch_size is not None else settings.get("sw_batch_size")
+            sw_workers = sw_workers if sw_workers is not None else settings.get("sw_workers")
+            overlap = overlap if overlap is not None else settings.get("overlap")
+            blend_mode = blend_mode if blend_mode is not None else settings.get("blend_mode")
+    timing_checkpoints.append(inference.stage_checkpoint("Loading model"))
+
+    images_loaded = load_layouts(image_file, layout_files)
+    groups = layout_groups(images_loaded["image1"], config)
+    timing_checkpoints.append(inference.stage_checkpoint(f"Loading volumes ({len(layout_files)} layouts, {len(groups)} groups)"))
+
+    inf_transform = inference.make_inference_transform(config, ["image1"])
+    # Windows are evaluated in parallel inferer, which supports batches and label aggregation
+    sliding_inferrer = inference.make_sliding_inferrer(config["roi_size"], sw_workers, aggregation, accumulator_dtype,
+                                                       skip_windows=True, sw_batch_size=sw_batch_size, overlap=overlap,
+                                                       blend_mode=blend_mode)
+    post_transforms = Compose([Invertd(keys="pred", orig_keys="image", transform=inf_transform, nearest_interp=True)])
+    for group in groups:
+        batch_data = inf_transform([{"image1": images_loaded["image1"][group]}])
+        batch_data = list_data_collate([batch_data])
+        # Layouts (channels) are moved to the batch dimension
+        data = batch_data["image"].as_subclass(torch.Tensor)[0][:, None].to(memory_format=torch.channels_last_3d, device=device)
+        timing_checkpoints.append(inference.stage_checkpoint(f"Preprocessing ({len(group)} layouts)"))
+
+        # Windows are skipped only if they contain no foreground in any of the layouts
+        mask = inference.foreground_mask(data, foreground_threshold=foreground_threshold)
+        if mask is not None:
+            mask = mask.any(dim=0, keepdim=True)
+        pred = inference.predict_labels(sliding_inferrer, data, model, device, False, timing_checkpoints, mask)
+        data = None
+
+        # Layouts are moved back to the channel dimension for inverting the preprocessing transforms
+        pred = inference.invert_prediction(pred.movedim(0, 1), batch_data, post_transforms)[0]
+        timing_checkpoints.append(inference.stage_checkpoint("Preds"))
+
+        nrrd_header = inference.result_header(image_file, batch_data["image"].meta[MetaKeys.ORIGINAL_AFFINE][0])
+        for group_index, layout_index in enumerate(group):
+            inference.write_labelmap(result_files[layout_index], pred[group_index].cpu().numpy().astype(np.uint8), nrrd_header, crop_output)
+        timing_checkpoints.append(inference.stage_checkpoint("Save"))
+    images_loaded = None
+
+    inference.print_timing_checkpoints(start_time, timing_checkpoints)
+    print(f"ALL DONE, results of {len(result_files)} layouts saved")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,156 @@
+"""Choosing inference settings that fit into a memory budget.
+
+Memory usage of each processing stage is estimated from the volume size, window size, and network size.
+Inference levels are ordered from the fastest (most memory) to the slowest (least memory).
+The planner chooses the first level that fits into the budget, and if a stage still runs out of memory
+then processing can be retried at the next level. Levels with float16 accumulator are only used when the float32 levels
+do not fit, as they may change labels where the class scores are close.
+
+The budget applies to the memory of the device where inference runs (GPU memory if CUDA is used, system memory otherwise).
+"""
+
+import math
+
+import torch
+
+
+# Estimated peak size of network activations, for each window voxel and each filter of the first network layer.
+# Measured on SegResNetDS, it is about 6 full-resolution float32 feature maps.
+ACTIVATION_BYTES_PER_VOXEL_PER_FILTER = 24
+
+
+def is_out_of_memory_error(e):
+    """Returns True if the exception is caused by running out of CPU or GPU memory"""
+    if isinstance(e, MemoryError):
+        return True
+    if isinstance(e, RuntimeError):
+        message = str(e).lower()
+        return "out of memory" in message or "can't allocate memory" in message or "not enough memory" in message
+    return False
+
+
+def format_bytes(size):
+    return f"{size / 1024 / 1024:.0f}MB"
+
+
+class InferenceLevel:
+    """Settings of sliding window inference, for one level of memory usage"""
+
+    def __init__(self, sw_batch_size, accumulator_dtype, output_device, window_device):
+        self.sw_batch_size = sw_batch_size
+        self.accumulator_dtype = accumulator_dtype
+        self.output_device = torch.device(output_device)
+        self.window_device = torch.device(window_device)
+
+    def __str__(self):
+        return (f"batch size {self.sw_batch_size}, {str(self.accumulator_dtype).replace('torch.', '')} accumulator"
+                f" on {self.output_device.type}, windows on {self.window_device.type}")
+
+
+def inference_levels(device):
+    """Get list of inference levels, from the fastest to the least memory"""
+    if device.type == "cuda":
+        return [
+            InferenceLevel(4, torch.float32, device, device),
+            InferenceLevel(2, torch.float32, device, device),
+            InferenceLevel(1, torch.float16, device, device),
+            # Offload aggregation to CPU
+            InferenceLevel(1, torch.float16, "cpu", device),
+            # Run everything on CPU
+            InferenceLevel(1, torch.float16, "cpu", "cpu"),
+            ]
+    # On CPU, larger window batches are not faster, the first level is the same as inference without a memory budget
+    return [
+        InferenceLevel(1, torch.float32, device, device),
+        InferenceLevel(1, torch.float16, device, device),
+        ]
+
+
+class MemoryPlanner:
+    """Estimates memory usage of inference stages and chooses the inference level.
+
+    :param budget: memory budget in bytes
+    :param device: device where inference runs
+    :param roi_size: sliding window size
+    :param image_shape: spatial shape of the preprocessed volume
+    :param original_shape: spatial shape of the input volume
+    :param input_channels: number of input channels of the network
+    :param output_channels: number of output channels of the network
+    :param init_filters: number of filters of the first network layer
+    :param model_bytes: size of the network parameters
+    :param baseline_bytes: memory that is measured to be in use on the inference device when planning
+      (process resident memory on CPU, allocated memory on GPU). It includes the network and the preprocessed input,
+      which are already loaded. If None then only the estimated size of the network and the input is used.
+    """
+
+    def __init__(self, budget, device, roi_size, image_shape, original_shape, input_channels=1, output_channels=2,
+                 init_filters=32, model_bytes=0, baseline_bytes=None):
+        self.budget = int(budget)
+        self.device = device
+        self.roi_size = list(roi_size)
+        self.image_shape = list(image_shape)
+        self.original_shape = list(original_shape)
+        self.input_channels = input_channels
+        self.output_channels = output_channels
+        self.init_filters = init_filters
+        self.model_bytes = model_bytes
+        self.baseline_bytes = baseline_bytes
+        self.levels = inference_levels(device)
+        self.level_index = 0
+
+    def estimate(self, level):
+        """Get estimated peak memory usage of each stage on the inference device, dict of stage name -> bytes"""
+        padded_voxels = math.prod(max(image_length, roi_length) for image_length, roi_length in zip(self.image_shape, self.roi_size))
+        original_voxels = math.prod(self.original_shape)
+        roi_voxels = math.prod(self.roi_size)
+        float_size = 4
+        accumulator_size = torch.finfo(level.accumulator_dtype).bits // 8
+        on_inference_device = lambda device: device.type == self.device.type
+
+        estimates = {}
+        # Loaded volume, normalized copy, resampled copy
+        estimates["Preprocessing"] = (3 * original_voxels + padded_voxels) * self.input_channels * float_size if self.device.type == "cpu" else 0
+
+        if self.baseline_bytes is not None:
+            # Measured memory usage already includes the network and the input
+            loaded_bytes = self.baseline_bytes
+        else:
+            model_bytes = self.model_bytes if on_inference_device(level.window_device) else 0
+            input_bytes = padded_voxels * self.input_channels * float_size if on_inference_device(level.window_device) else 0
+            loaded_bytes = model_bytes + input_bytes
+        estimates["Window batch"] = loaded_bytes + (level.sw_batch_size * roi_voxels
+            * (self.init_filters * ACTIVATION_BYTES_PER_VOXEL_PER_FILTER + (self.input_channels + self.output_channels) * float_size)
+            if on_inference_device(level.window_device) else 0)
+        estimates["Aggregation"] = loaded_bytes + (padded_voxels * (self.output_channels * accumulator_size + 1)
+            if on_inference_device(level.output_device) else 0)
+        # Labels are resampled to the input volume in float precision
+        estimates["Inversion"] = (self.baseline_bytes or 0) + ((padded_voxels + 2 * original_voxels * float_size)
+            if on_inference_device(level.output_device) else 0)
+        return estimates
+
+    def level(self):
+        return self.levels[self.level_index]
+
+    def choose_level(self):
+        """Choose the fastest level where all stages fit into the budget.
+        If none of them fits then the level with the smallest memory usage is chosen.
+        """
+        for index, level in enumerate(self.levels):
+            if max(self.estimate(level).values()) <= self.budget:
+                self.level_index = index
+                return True
+        self.level_index = len(self.levels) - 1
+        return False
+
+    def degrade(self):
+        """Switch to the next level (that uses less memory). Returns False if there are no more levels."""
+        if self.level_index + 1 >= len(self.levels):
+            return False
+        self.level_index += 1
+        return True
+
+    def describe(self):
+        estimates = self.estimate(self.level())
+        baseline = f"measured memory usage {format_bytes(self.baseline_bytes)}, " if self.baseline_bytes is not None else ""
+        return f"{self.level()} ({baseline}estimated peak memory: " + ", ".join(
+            f"{stage} {format_bytes(size)}" for stage, size in estimates.items()) + ")"
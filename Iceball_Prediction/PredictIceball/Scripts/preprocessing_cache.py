@@ -0,0 +1,120 @@
+"""Cache of preprocessed network inputs, shared between models.
+
+Several models of the module (prostate, urethra, iceball, ...) use the same input volume and often the same
+preprocessing (orientation, foreground cropping, resampling, normalization). The preprocessed tensor is stored
+in the cache, keyed by the content of the input files and the preprocessing settings of the model config,
+so that the next model that uses the same preprocessing can skip loading and preprocessing.
+
+The cached tensor is a MetaTensor that contains the list of applied transforms, which is needed for inverting
+the preprocessing (Invertd). Invertd normally checks that the transforms were applied by the same transform
+objects, which is not the case when the tensor is loaded from the cache. Therefore transform IDs are cleared
+in the cached transform list, which makes MONAI skip this check.
+"""
+
+import hashlib
+import json
+import os
+
+import torch
+
+
+CACHE_VERSION = 1
+
+# Model config entries that affect the preprocessed tensor
+PREPROCESSING_CONFIG_KEYS = ["orientation_ras", "crop_foreground", "resample_resolution", "normalize_mode", "intensity_bounds"]
+
+
+def file_hash(file_path, chunk_size=16 * 1024 * 1024):
+    """Hash of the file content, or of all files in a directory (such as a DICOM series)"""
+    hasher = hashlib.sha256()
+    if os.path.isdir(file_path):
+        from dicom_series import series_files
+        for series_file in series_files(file_path):
+            hasher.update(os.path.relpath(series_file, file_path).encode("utf-8"))
+            hasher.update(file_hash(series_file, chunk_size).encode("ascii"))
+        return hasher.hexdigest()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def preprocessing_config(config, input_count):
+    """Get preprocessing settings of the model config, with default values filled in, in a canonical form"""
+    preprocessing = {key: config.get(key) for key in PREPROCESSING_CONFIG_KEYS}
+    preprocessing["orientation_ras"] = bool(config.get("orientation_ras", False))
+    preprocessing["crop_foreground"] = bool(config.get("crop_foreground", True))
+    if preprocessing["resample_resolution"] is not None:
+        preprocessing["resample_resolution"] = [float(value) for value in preprocessing["resample_resolution"]]
+    if preprocessing["intensity_bounds"] is not None:
+        preprocessing["intensity_bounds"] = [float(value) for value in preprocessing["intensity_bounds"]]
+    if input_count > 1:
+        preprocessing["extra_modalities"] = list(config["extra_modalities"].items())[:input_count - 1]
+    return preprocessing
+
+
+def clear_transform_ids(applied_operations):
+    """Replace transform IDs in the list of applied transforms (recursively) so that Invertd does not check them"""
+    from monai.utils import TraceKeys
+    for operation in applied_operations:
+        if isinstance(operation, dict):
+            if TraceKeys.ID in operation:
+                operation[TraceKeys.ID] = TraceKeys.NONE
+            clear_transform_ids(operation.values())
+        elif isinstance(operation, (list, tuple)):
+            clear_transform_ids(operation)
+
+
+class PreprocessingCache:
+    """Stores preprocessed inputs in a folder, one file per input and preprocessing configuration.
+
+    :param cache_dir: folder where preprocessed inputs are stored
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, image_files, config, roi_mask_file=None, layout_file=None):
+        """Get cache key for the list of input files and model config (and probe layout that is composited into the first input)"""
+        import monai
+        items = {
+            "version": CACHE_VERSION,
+            "monai": monai.__version__,
+            "images": [file_hash(image_file) for image_file in image_files],
+            "roi": file_hash(roi_mask_file) if roi_mask_file is not None else None,
+            "layout": file_hash(layout_file) if layout_file is not None else None,
+            "preprocessing": preprocessing_config(config, len(image_files)),
+            }
+        return hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+
+    def file_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def load(self, key):
+        """Get preprocessed data (dict of MetaTensors) from the cache. Returns None if it is not found."""
+        try:
+            data = torch.load(self.file_path(key), map_location="cpu", weights_only=False)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Corrupted or incompatible file, it will be overwritten
+            print(f"Failed to read preprocessing cache file {self.file_path(key)}: {e}")
+            return None
+        for value in data.values():
+            clear_transform_ids(value.applied_operations)
+        return data
+
+    def save(self, key, data):
+        """Store preprocessed data (dict of MetaTensors) in the cache.
+        The file is written atomically, so that other processes never read a partially written file.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_file = f"{self.file_path(key)}.{os.getpid()}.tmp"
+        try:
+            torch.save({name: value.cpu() for name, value in data.items()}, temp_file)
+            os.replace(temp_file, self.file_path(key))
+        except OSError as e:
+            # The cache is optional
+            print(f"Failed to write preprocessing cache file {self.file_path(key)}: {e}")
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
@@ -0,0 +1,275 @@
+"""Sliding window inference with windows evaluated in parallel.
+
+The window grid and the blending weights are the same as in monai.inferers.SlidingWindowInfererAdapt,
+therefore the results are the same (up to floating-point rounding). The difference is that the windows
+are split into groups and the groups are evaluated by multiple workers at the same time.
+
+On CPU, a single small window does not keep all the cores busy. Each worker is a thread that runs
+the network, and the cores are divided between the workers: the torch intra-op thread count is a process-wide
+setting, so it is set once, before the workers are started, and restored after inference.
+Workers share the network (weights are not copied), the input tensor, and the output accumulator.
+Peak memory usage grows with the number of workers, as each worker holds the network activations of its own
+window batch (on a test volume, peak memory was 696MB with 1 worker and 1019MB with 4 workers).
+
+To reduce memory usage, the output can be a uint8 label map instead of the blended logits.
+In this mode the weighted logits are accumulated (optionally in reduced precision) and converted to labels
+directly, without normalizing by the sum of weights, and without softmax.
+
+Windows that do not overlap with a foreground mask can be skipped, their output is set to background logits.
+Evaluation can also be limited to windows that overlap with an update region (for incremental prediction):
+the output is exact inside the region, as all windows that cover the region are evaluated.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn.functional as F
+from monai.data.utils import compute_importance_map, dense_patch_slices
+
+
+def scan_interval(image_size, roi_size, overlap):
+    """Distance between neighbor windows, computed the same way as in MONAI sliding window inference"""
+    interval = []
+    for image_length, roi_length in zip(image_size, roi_size):
+        if roi_length == image_length:
+            interval.append(int(roi_length))
+        else:
+            interval.append(max(int(roi_length * (1 - overlap)), 1))
+    return tuple(interval)
+
+
+def window_slices(image_size, roi_size, overlap):
+    """Get list of windows (tuple of slices, one for each spatial dimension).
+    Windows are sorted by their position along the first spatial axis.
+    """
+    slices = dense_patch_slices(image_size, roi_size, scan_interval(image_size, roi_size, overlap), return_slice=True)
+    return sorted(slices, key=lambda window: tuple(s.start for s in window))
+
+
+def cpu_core_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ParallelSlidingWindowInferer:
+    """Sliding window inference that evaluates windows with multiple workers.
+
+    :param roi_size: window size
+    :param sw_batch_size: number of windows that a worker passes to the network at once
+    :param overlap: overlap between neighbor windows (0.0-1.0)
+    :param mode: blending mode ("gaussian" or "constant")
+    :param workers: number of parallel workers, 0 means one worker per CPU core.
+      Inputs on GPU are always processed by a single worker. Each worker increases the peak memory usage.
+    :param threads_per_worker: number of torch threads of each worker, 0 means the cores are divided between the workers
+    :param output: "logits" returns blended logits, "labels" returns uint8 label map (argmax, or thresholded channels if sigmoid is True)
+    :param sigmoid: network output is converted to labels by sigmoid instead of softmax
+    :param accumulator_dtype: data type of the output accumulator, float16 halves the memory usage
+      but the labels are not exactly the same as with float32 (they may differ where the class scores are close)
+    :param output_device: device where the output is accumulated (None = device of the inputs).
+      Setting it to "cpu" for GPU inputs reduces GPU memory usage.
+    :param background_logit: magnitude of the logits that are used as output of skipped windows (see mask in __call__)
+    :param progress: print progress bar
+    """
+
+    def __init__(self, roi_size, sw_batch_size=1, overlap=0.625, mode="gaussian", sigma_scale=0.125,
+                 workers=0, threads_per_worker=0, output="logits", sigmoid=False, accumulator_dtype=torch.float32,
+                 output_device=None, background_logit=10.0, progress=False):
+        if output not in ["logits", "labels"]:
+            raise ValueError(f"Invalid output type: {output}")
+        self.roi_size = tuple(roi_size)
+        self.sw_batch_size = sw_batch_size
+        self.overlap = overlap
+        self.mode = mode
+        self.sigma_scale = sigma_scale
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.output = output
+        self.sigmoid = sigmoid
+        self.accumulator_dtype = accumulator_dtype
+        self.output_device = output_device
+        self.background_logit = background_logit
+        self.progress = progress
+        # Statistics of the last run, for reporting
+        self.window_count = 0
+        self.skipped_window_count = 0
+        self.used_worker_count = 0
+
+    def worker_count(self, inputs, window_count):
+        if inputs.is_cuda:
+            # Windows are already evaluated in parallel on the GPU
+            return 1
+        workers = self.workers if self.workers > 0 else cpu_core_count()
+        return max(1, min(workers, window_count))
+
+    def __call__(self, inputs, network, mask=None, region=None):
+        """Run network on inputs (batch, channel, spatial dimensions) and return blended output.
+
+        If mask (1, 1, spatial dimensions) is specified then windows that do not contain any nonzero mask voxel
+        are not evaluated, the background logits are used as their output instead.
+        If region (1, 1, spatial dimensions) is specified then only windows that contain a nonzero region voxel
+        are evaluated. The output is only valid inside the region.
+        """
+        batch_size, _, *image_size = inputs.shape
+        spatial_dims = len(image_size)
+        if len(self.roi_size) != spatial_dims:
+            raise ValueError(f"roi_size {self.roi_size} does not match input shape {tuple(inputs.shape)}")
+
+        # Pad input if it is smaller than the window (same way as in MONAI)
+        padded_size = [max(image_size[i], self.roi_size[i]) for i in range(spatial_dims)]
+        pad = []
+        for i in reversed(range(spatial_dims)):
+            diff = padded_size[i] - image_size[i]
+            pad.extend([diff // 2, diff - diff // 2])
+        if any(pad):
+            inputs = F.pad(inputs, pad=pad, mode="constant", value=0)
+            if mask is not None:
+                mask = F.pad(mask, pad=pad, mode="constant", value=0)
+            if region is not None:
+                region = F.pad(region, pad=pad, mode="constant", value=0)
+
+        slices = window_slices(padded_size, self.roi_size, self.overlap)
+        importance_map = compute_importance_map(self.roi_size, mode=self.mode, sigma_scale=self.sigma_scale,
+                                                device=inputs.device, dtype=torch.float32)[None, None]
+        output_device = torch.device(self.output_device) if self.output_device is not None else inputs.device
+
+        evaluated_slices = slices
+        skipped_slices = []
+        if mask is not None or region is not None:
+            evaluated_slices = []
+            for window in slices:
+                window_slice = (slice(None), slice(None)) + window
+                if (mask is None or mask[window_slice].any()) and (region is None or region[window_slice].any()):
+                    evaluated_slices.append(window)
+                else:
+                    skipped_slices.append(window)
+            if not evaluated_slices:
+                # At least one window is needed for getting the number of output channels
+                evaluated_slices.append(skipped_slices.pop(0))
+
+        worker_count = self.worker_count(inputs, len(evaluated_slices))
+        self.window_count = len(slices)
+        self.skipped_window_count = len(skipped_slices)
+        self.used_worker_count = worker_count
+        # Split windows into contiguous groups, so that the workers usually write into different parts of the output
+        groups = [evaluated_slices[len(evaluated_slices) * i // worker_count: len(evaluated_slices) * (i + 1) // worker_count]
+                  for i in range(worker_count)]
+
+        # Output accumulator, allocated when the number of output channels is known (when the first window is evaluated)
+        accumulator = {}
+        accumulator_lock = threading.Lock()
+
+        progress_bar = None
+        if self.progress:
+            try:
+                from tqdm import tqdm
+                progress_bar = tqdm(total=len(evaluated_slices))
+            except ImportError:
+                pass
+
+        if worker_count == 1:
+            self._blend_windows(inputs, network, groups[0], importance_map, output_device, accumulator, accumulator_lock, progress_bar)
+        else:
+            threads_per_worker = self.threads_per_worker or max(1, cpu_core_count() // worker_count)
+            previous_thread_count = torch.get_num_threads()
+            grad_enabled = torch.is_grad_enabled()
+
+            def run_worker(group):
+                # Grad mode is thread-local, it has to be set in each worker
+                with torch.set_grad_enabled(grad_enabled):
+                    self._blend_windows(inputs, network, group, importance_map, output_device, accumulator, accumulator_lock, progress_bar)
+
+            # Thread count is process-wide, it is set once for all the workers
+            torch.set_num_threads(threads_per_worker)
+            try:
+                with ThreadPoolExecutor(max_workers=worker_count) as executor:
+                    list(executor.map(run_worker, groups))
+            finally:
+                torch.set_num_threads(previous_thread_count)
+
+        if progress_bar is not None:
+            progress_bar.close()
+
+        output = accumulator["output"]
+        if skipped_slices:
+            self._blend_background(output, skipped_slices, importance_map.to(output_device))
+
+        if any(pad):
+            # Remove padding
+            crop = [slice(None), slice(None)]
+            for i in range(spatial_dims):
+                pad_before = pad[2 * (spatial_dims - 1 - i)]
+                crop.append(slice(pad_before, pad_before + image_size[i]))
+            output = output[tuple(crop)]
+
+        if self.output == "labels":
+            return self._labels(output)
+
+        # Normalize by the sum of weights. The sum only depends on the window positions, the network does not have to be evaluated.
+        count_map = torch.zeros([1, 1] + padded_size, dtype=torch.float32, device=output_device)
+        output_importance_map = importance_map.to(output_device)
+        for window in slices:
+            count_map[(slice(None), slice(None)) + window] += output_importance_map
+        if any(pad):
+            count_map = count_map[tuple(crop)]
+        output /= count_map
+        return output
+
+    def _blend_windows(self, inputs, network, windows, importance_map, output_device, accumulator, accumulator_lock, progress_bar=None):
+        """Evaluate windows and add them, weighted by the importance map, to the output accumulator on output_device"""
+        batch_size = inputs.shape[0]
+        for batch_start in range(0, len(windows), self.sw_batch_size):
+            batch_windows = windows[batch_start:batch_start + self.sw_batch_size]
+            window_data = torch.cat([inputs[(slice(None), slice(None)) + window] for window in batch_windows])
+            window_output = network(window_data)
+            if isinstance(window_output, (list, tuple)):
+                window_output = window_output[0]
+            # Weighting is done outside the lock, only the addition has to be serialized
+            weighted_outputs = [(window, (window_output[window_index * batch_size:(window_index + 1) * batch_size].float()
+                * importance_map).to(device=output_device, dtype=self.accumulator_dtype)) for window_index, window in enumerate(batch_windows)]
+            window_output = None
+            with accumulator_lock:
+                if "output" not in accumulator:
+                    accumulator["output"] = torch.zeros([batch_size, weighted_outputs[0][1].shape[1]] + list(inputs.shape[2:]),
+                                                        dtype=self.accumulator_dtype, device=output_device)
+                for window, weighted_output in weighted_outputs:
+                    accumulator["output"][(slice(None), slice(None)) + window] += weighted_output
+            if progress_bar is not None:
+                progress_bar.update(len(batch_windows))
+
+    def background_logits(self, channels):
+        """Output of the network in regions that contain no foreground"""
+        logits = torch.zeros(channels, dtype=torch.float32)
+        if self.sigmoid:
+            logits[:] = -self.background_logit
+        else:
+            logits[0] = self.background_logit
+        return logits
+
+    def _blend_background(self, output, windows, importance_map):
+        """Add background logits, weighted by the importance map, to the output accumulator for each window"""
+        background = self.background_logits(output.shape[1]).to(output.device).reshape([1, -1] + [1] * len(self.roi_size))
+        weighted_background = (importance_map * background).to(self.accumulator_dtype)
+        for window in windows:
+            output[(slice(None), slice(None)) + window] += weighted_background
+
+    def _labels(self, accumulator, chunk_size=16):
+        """Convert accumulated weighted logits to a uint8 label map.
+
+        The sum of weights is positive at every voxel, so dividing by it would not change the result:
+        argmax of the weighted sum is the same as argmax of the blended logits (softmax is not needed either),
+        and for sigmoid output the sign of the weighted sum tells if the probability is at least 0.5.
+        The conversion is done in chunks along the first spatial axis, so that no full-size temporary volume is allocated.
+        """
+        batch_size, channels, *image_size = accumulator.shape
+        label_channels = channels if self.sigmoid else 1
+        labels = torch.empty([batch_size, label_channels] + image_size, dtype=torch.uint8, device=accumulator.device)
+        for chunk_start in range(0, image_size[0], chunk_size):
+            chunk = (slice(None), slice(None), slice(chunk_start, chunk_start + chunk_size))
+            if self.sigmoid:
+                labels[chunk] = accumulator[chunk] >= 0
+            else:
+                labels[chunk] = torch.argmax(accumulator[chunk], dim=1, keepdim=True)
+        return labels
@@ -0,0 +1,43 @@
+"""Headless daemon that predicts the iceball for each new series that appears in a folder.
+
+The segmentation (<series>-iceball.seg.nrrd) and the timing report (<series>-timing.json) are written next to each series.
+This script runs in the Slicer application (not in PythonSlicer), as it uses the module logic:
+
+    Slicer --no-main-window --python-script watch_folder.py <folder> [--model <model>] [--cpu] [--settle-time 5]
+"""
+
+import argparse
+import sys
+
+import slicer
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Predict iceball for each new series in a folder")
+    parser.add_argument("folder", help="folder where new series (volume files or DICOM folders) appear")
+    parser.add_argument("--model", default=None, help="model ID (default model is used if not specified)")
+    parser.add_argument("--cpu", action="store_true", help="use CPU even if a GPU is available")
+    parser.add_argument("--settle-time", type=float, default=5.0, help="a series is processed if its files have not changed for this many seconds")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="time between checking the folder, in seconds")
+    parser.add_argument("--max-series", type=int, default=None, help="exit after processing this many series")
+    parser.add_argument("--timeout", type=float, default=None, help="exit after this many seconds")
+    parser.add_argument("--no-early-prediction", action="store_true", help="do not predict series before their files have settled")
+    args = parser.parse_args(argv)
+
+    from PredictIceball import PredictIceballLogic
+    logic = PredictIceballLogic()
+    logic.logCallback = lambda text: print(text, flush=True)
+    logic.earlySeriesPrediction = not args.no_early_prediction
+    logic.setupPythonRequirements()
+    logic.watchFolder(args.folder, model=args.model, cpu=args.cpu, pollIntervalSec=args.poll_interval,
+                      settleTimeSec=args.settle_time, maximumSeriesCount=args.max_series, timeoutSec=args.timeout)
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv[1:])
+        exitCode = 0
+    except Exception as e:
+        print(f"Error: {e}", flush=True)
+        exitCode = 1
+    slicer.util.exit(exitCode)